@@ -6,7 +6,8 @@ from typing import Annotated
 
 import typer
 
-from .pipeline import DecompBackend
+# The pipeline imports the backends; it is only imported when the command runs.
+from .utils import DecompBackend
 
 
 # Must maintain declaration order
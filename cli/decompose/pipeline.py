@@ -1,5 +1,4 @@
 import re
-from enum import Enum
 from typing import Literal, TypedDict
 
 from typing_extensions import NotRequired
@@ -20,6 +19,7 @@ from .prompt_modules import (
 from .prompt_modules.subtask_constraint_assign import SubtaskPromptConstraintsItem
 from .prompt_modules.subtask_list import SubtaskItem
 from .prompt_modules.subtask_prompt_generator import SubtaskPromptItem
+from .utils import DecompBackend
 
 
 class ConstraintResult(TypedDict):
@@ -46,12 +46,6 @@ class DecompPipelineResult(TypedDict):
     final_response: NotRequired[str]
 
 
-class DecompBackend(str, Enum):
-    ollama = "ollama"
-    openai = "openai"
-    rits = "rits"
-
-
 RE_JINJA_VAR = re.compile(r"\{\{\s*(.*?)\s*\}\}")
 
 
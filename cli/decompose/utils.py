@@ -1,3 +1,12 @@
+from enum import Enum
+
+
+class DecompBackend(str, Enum):
+    ollama = "ollama"
+    openai = "openai"
+    rits = "rits"
+
+
 def validate_filename(candidate_str: str) -> bool:
     import re
 
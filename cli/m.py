@@ -5,6 +5,7 @@ import typer
 from cli.alora.commands import alora_app
 from cli.decompose import app as decompose_app
 from cli.serve.app import serve
+from cli.templates.commands import templates_app
 
 cli = typer.Typer(name="m", no_args_is_help=True)
 
@@ -25,3 +26,4 @@ cli.command(name="serve")(serve)
 # as documented: https://typer.tiangolo.com/tutorial/subcommands/add-typer/#put-them-together.
 cli.add_typer(alora_app)
 cli.add_typer(decompose_app)
+cli.add_typer(templates_app)
@@ -7,16 +7,6 @@ import time
 import uuid
 
 import typer
-import uvicorn
-from fastapi import FastAPI
-
-from .models import ChatCompletion, ChatCompletionMessage, ChatCompletionRequest, Choice
-
-app = FastAPI(
-    title="M serve OpenAI API Compatible Server",
-    description="M programs that run as a simple OpenAI API-compatible server",
-    version="0.1.0",
-)
 
 
 def load_module_from_path(path: str):
@@ -31,6 +21,12 @@ def load_module_from_path(path: str):
 
 def make_chat_endpoint(module):
     """Makes a chat endpoint using a custom module."""
+    from .models import (
+        ChatCompletion,
+        ChatCompletionMessage,
+        ChatCompletionRequest,
+        Choice,
+    )
 
     async def endpoint(request: ChatCompletionRequest) -> ChatCompletion:
         completion_id = f"chatcmpl-{uuid.uuid4().hex[:29]}"
@@ -72,6 +68,17 @@ def serve(
     port: int = typer.Option(8080, help="Port to bind to"),
 ):
     """Serve a FastAPI endpoint for a given script."""
+    # Imported here so that other `m` commands don't pay for the server's imports.
+    import uvicorn
+    from fastapi import FastAPI
+
+    from .models import ChatCompletion
+
+    app = FastAPI(
+        title="M serve OpenAI API Compatible Server",
+        description="M programs that run as a simple OpenAI API-compatible server",
+        version="0.1.0",
+    )
     module = load_module_from_path(script_path)
     route_path = "/v1/chat/completions"
 
@@ -0,0 +1 @@
+"""templates command group package for precompiling jinja2 templates."""
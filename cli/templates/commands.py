@@ -0,0 +1,37 @@
+"""Commands for precompiling the jinja2 templates of components."""
+
+import typer
+
+templates_app = typer.Typer(
+    name="templates", help="Manage the jinja2 templates that format components."
+)
+
+
+def templates_compile(
+    template_dirs: list[str] = typer.Argument(
+        None,
+        help="User template directories to compile, as passed to `TemplateFormatter(template_path=...)`",
+    ),
+    package: list[str] = typer.Option(
+        ["mellea"], help="Packages whose templates to compile"
+    ),
+    cache_dir: str = typer.Option(
+        None,
+        help="Directory of the bytecode cache; defaults to $MELLEA_TEMPLATE_CACHE_DIR or ~/.cache/mellea/templates",
+    ),
+):
+    """Precompile templates into a bytecode cache so that new processes don't compile them on first use."""
+    from mellea.helpers.template_helpers import (
+        compile_templates,
+        default_template_cache_dir,
+    )
+
+    if cache_dir is None:
+        cache_dir = default_template_cache_dir()
+    compiled = compile_templates(
+        template_dirs or [], packages=package, cache_dir=cache_dir
+    )
+    typer.echo(f"Compiled {len(compiled)} templates into {cache_dir}")
+
+
+templates_app.command("compile")(templates_compile)
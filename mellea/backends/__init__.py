@@ -57,6 +57,42 @@ class Backend(abc.ABC):
         """
         ...
 
+    def generate_n_from_context(
+        self,
+        action: Component | CBlock,
+        ctx: Context,
+        *,
+        n: int,
+        format: type[BaseModelSubclass] | None = None,
+        model_options: dict | None = None,
+        tool_calls: bool = False,
+    ) -> list[tuple[ModelOutputThunk, Context]]:
+        """Generates `n` independent samples for the same action and context. This must be called from a running event loop.
+
+        Backends that can share work between the samples (e.g., sending or prefilling the prompt once) override this. The default implementation makes `n` `generate_from_context` calls; each one creates its own task, so the samples are still generated concurrently.
+
+        Args:
+            action: See `generate_from_context`.
+            ctx: See `generate_from_context`.
+            n: The number of samples to generate.
+            format: See `generate_from_context`.
+            model_options: See `generate_from_context`.
+            tool_calls: See `generate_from_context`.
+
+        Returns:
+            a list of `n` (ModelOutputThunk, Context) tuples, one per sample.
+        """
+        return [
+            self.generate_from_context(
+                action,
+                ctx,
+                format=format,
+                model_options=model_options,
+                tool_calls=tool_calls,
+            )
+            for _ in range(n)
+        ]
+
     @abc.abstractmethod
     def _generate_from_raw(
         self,
@@ -1,12 +1,12 @@
 from __future__ import annotations
 
 import inspect
-from collections.abc import Callable
+from collections.abc import Callable, Mapping
 from typing import Any, Literal
 
 from mellea.backends.aloras import Alora
 from mellea.backends.formatter import Formatter
-from mellea.backends.tools import parse_tools
+from mellea.backends.tools import IncrementalToolCallParser
 from mellea.helpers.fancy_logger import FancyLogger
 from mellea.stdlib.base import CBlock, Component, Context, ModelToolCall
 from mellea.stdlib.chat import Message
@@ -81,27 +81,55 @@ def use_alora(
         return False
 
 
+class StreamingToolCalls:
+    """Extracts the tool calls from a response while it is streamed.
+
+    `feed` every chunk of the response; each tool call is returned (and added to `tool_calls`) as soon as its json object is closed, so the tool can be called before the model has finished generating. Call `finish` once the response is complete.
+    """
+
+    def __init__(self, tools: dict[str, Callable]):
+        """Initializes the parser with the tools that the model may call."""
+        self.tools = tools
+        self.tool_calls: dict[str, ModelToolCall] = dict()
+        self._parser = IncrementalToolCallParser()
+
+    def feed(self, chunk: str) -> list[ModelToolCall]:
+        """Adds a chunk of the response and returns the tool calls that it completed."""
+        return self._add(self._parser.feed(chunk))
+
+    def finish(self) -> dict[str, ModelToolCall] | None:
+        """Adds the tool calls that can only be found once the response is complete and returns all tool calls, or `None` if there are none."""
+        self._add(self._parser.finish())
+        if len(self.tool_calls) > 0:
+            return self.tool_calls
+        return None
+
+    def _add(self, calls: list[tuple[str, Mapping]]) -> list[ModelToolCall]:
+        model_tool_calls = []
+        for tool_name, tool_args in calls:
+            func = self.tools.get(tool_name)
+            if func is None:
+                FancyLogger.get_logger().warning(
+                    f"model attempted to call a non-existing function: {tool_name}"
+                )
+                continue
+
+            # Clean up the function args slightly. Some models seem to
+            # hallucinate parameters when none are required.
+            sig = inspect.signature(func)
+            if len(sig.parameters) == 0:
+                tool_args = {}
+
+            model_tool_call = ModelToolCall(tool_name, func, tool_args)
+            self.tool_calls[tool_name] = model_tool_call
+            model_tool_calls.append(model_tool_call)
+        return model_tool_calls
+
+
 def to_tool_calls(
     tools: dict[str, Callable], decoded_result: str
 ) -> dict[str, ModelToolCall] | None:
     """Parse a tool call string."""
-    model_tool_calls: dict[str, ModelToolCall] = dict()
-    for tool_name, tool_args in parse_tools(decoded_result):
-        func = tools.get(tool_name)
-        if func is None:
-            FancyLogger.get_logger().warning(
-                f"model attempted to call a non-existing function: {tool_name}"
-            )
-            continue
-
-        # Clean up the function args slightly. Some models seem to
-        # hallucinate parameters when none are required.
-        sig = inspect.signature(func)
-        if len(sig.parameters) == 0:
-            tool_args = {}
-
-        model_tool_calls[tool_name] = ModelToolCall(tool_name, func, tool_args)
-
-    if len(model_tool_calls) > 0:
-        return model_tool_calls
-    return None
+    parser = StreamingToolCalls(tools)
+    parser.feed(decoded_result)
+    return parser.finish()
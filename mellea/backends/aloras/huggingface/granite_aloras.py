@@ -1,21 +1,34 @@
 """Huggingface implementations for IBM's "starter pack" of Activated LoRAs."""
 
 import asyncio
+import dataclasses
 import functools
-from copy import deepcopy
+from collections.abc import Coroutine
+from typing import Any
 
 import torch
-from transformers.generation.utils import GenerateDecoderOnlyOutput
+from transformers import DynamicCache
 
-from mellea.backends.huggingface import HFAlora, HFAloraCacheInfo, LocalHFBackend
+from mellea.backends.huggingface import HFAlora, LocalHFBackend, branch_kv_cache
 from mellea.backends.types import ModelOption
-from mellea.helpers.async_helpers import send_to_queue
+from mellea.helpers.async_helpers import get_item, send_to_queue
 from mellea.helpers.fancy_logger import FancyLogger
 from mellea.stdlib.base import GenerateType, ModelOutputThunk
 
 
+@dataclasses.dataclass
+class ConstraintCheckOutput:
+    """The output of checking one constraint of a batch."""
+
+    sequences: torch.Tensor
+    """The prompt and the generated token, with a batch size of 1."""
+
+    yn_logits: tuple[float, float] | None = None
+    """The logits of "Y" and "N" if the answer is forced to be one of them; read for the whole batch at once."""
+
+
 class HFConstraintAlora(HFAlora):
-    """The Requirement Checking ALora for Granite checks if the specified requirement was satisfied by the most recent model generation. Only one requirement is checked at a time.
+    """The Requirement Checking ALora for Granite checks if the specified requirement was satisfied by the most recent model generation. Concurrent checks of the same generation are batched together.
 
     Currently supports [Granite 3.2 8B](https://huggingface.co/ibm-granite/granite-3.2-8b-alora-requirement-check) and [Granite 3.3 8B](https://huggingface.co/ibm-granite/granite-3.3-8b-alora-requirement-check) by default.
     """
@@ -52,6 +65,18 @@ class HFConstraintAlora(HFAlora):
         # We do a lot of logging for ALoras because this is an experimental feature. Maybe we should tag these log messages?
         self._logger = FancyLogger.get_logger()
 
+        # Used to read the answer from the logits when `force_yn` is set.
+        self._yn_token_ids: list[int] = [
+            self._backend._tokenizer("Y", add_special_tokens=False)["input_ids"][0],  # type: ignore
+            self._backend._tokenizer("N", add_special_tokens=False)["input_ids"][0],  # type: ignore
+        ]
+
+        # Checks for the same (input, response, force_yn) that are started in the same event loop iteration (e.g., by `avalidate`) are run as one batch.
+        # Key: (input, response, force_yn) -> Value: (constraints, task that checks them).
+        self._pending_checks: dict[
+            tuple[str, str, bool], tuple[list[str], asyncio.Task]
+        ] = {}
+
     def generate_using_strings(
         self,
         input: str,
@@ -60,61 +85,73 @@ class HFConstraintAlora(HFAlora):
         force_yn: bool = True,
         stream: bool = False,
     ) -> ModelOutputThunk:
-        """Generates a constraint response from the ALora. Must be run in a running event loop."""
+        """Generates a constraint response from the ALora. Must be run in a running event loop.
+
+        Calls for the same `input` and `response` that are made in the same event loop iteration are batched together; see `generate_using_strings_batch`.
+        """
         assert self._backend.alora_model is not None
         # Go ahead and do runtime type-checking because passing CBlocks into this function is a common error.
         assert type(input) is str
         assert type(response) is str
         assert type(constraint) is str
-        self._backend.alora_model.set_adapter(self.name)
-        cache_hit = self._backend.cache_get(response)
 
         if stream:
             self._logger.warning(
                 "`HFConstraintAlora` cannot stream output; defaulting to non-streaming approach."
             )
 
-        generate_kwargs = {}
-        if cache_hit:
-            self._logger.debug(
-                f"using cache for alora {self.__class__} and response '{response}'"
-            )
-            generate_kwargs["past_key_values"] = deepcopy(cache_hit.kv_cache)
-            input_combined = self._generate_using_cache(cache_hit, constraint, force_yn)
-
+        key = (input, response, force_yn)
+        pending = self._pending_checks.get(key, None)
+        if pending is None:
+            constraints: list[str] = []
+            batch = asyncio.create_task(self._run_pending_checks(key, constraints))
+            self._pending_checks[key] = (constraints, batch)
         else:
-            self._logger.debug(
-                f"not using cache for alora {self.__class__} and response '{response}'"
-            )
-            input_combined = self._generate_not_using_cache(
-                input, response, constraint, force_yn
+            constraints, batch = pending
+
+        constraints.append(constraint)
+        return self._make_output(get_item(batch, len(constraints) - 1), force_yn)
+
+    def generate_using_strings_batch(
+        self, input: str, response: str, constraints: list[str], force_yn: bool = True
+    ) -> list[ModelOutputThunk]:
+        """Checks several constraints against the same input and response. Must be run in a running event loop.
+
+        The input and response are only prefilled once (or not at all if the backend has their kv cache), and all constraints are then checked in a single batched generate call.
+
+        Returns:
+            one ModelOutputThunk per constraint, in the same order as `constraints`.
+        """
+        assert self._backend.alora_model is not None
+        assert type(input) is str
+        assert type(response) is str
+        assert all(type(constraint) is str for constraint in constraints)
+
+        batch = asyncio.create_task(
+            asyncio.to_thread(
+                self._check_constraints, input, response, constraints, force_yn
             )
+        )
+        return [
+            self._make_output(get_item(batch, i), force_yn)
+            for i in range(len(constraints))
+        ]
 
-        if not self._include_constraint_in_alora_offset:
-            alora_offsets = [self._generation_prompt_tokens["input_ids"].shape[1] - 1]
-        else:
-            # Get the constraint tokens separately so that we can calculate the alora offsets.
-            constraint_tokens = self._backend._tokenizer(
-                self._constraint_prompt.format(constraint), return_tensors="pt"
-            ).to(self._backend._device)
-
-            alora_offsets = [
-                constraint_tokens["input_ids"].shape[1]
-                + self._generation_prompt_tokens["input_ids"].shape[1]
-                - 2
-            ]
-
-        chat_response = asyncio.to_thread(
-            self._backend.alora_model.generate,
-            input_combined["input_ids"].to(self._backend._device),
-            attention_mask=input_combined["attention_mask"].to(self._backend._device),
-            max_new_tokens=1,
-            return_dict_in_generate=True,
-            alora_offsets=alora_offsets,
-            output_scores=True,
-            **generate_kwargs,
+    async def _run_pending_checks(
+        self, key: tuple[str, str, bool], constraints: list[str]
+    ) -> list[ConstraintCheckOutput]:
+        """Runs all checks that were collected for `key` as a single batch."""
+        # Yield once so that the other checks started in this event loop iteration can join the batch.
+        await asyncio.sleep(0)
+        del self._pending_checks[key]
+        input, response, force_yn = key
+        return await asyncio.to_thread(
+            self._check_constraints, input, response, constraints, force_yn
         )
 
+    def _make_output(
+        self, chat_response: Coroutine, force_yn: bool
+    ) -> ModelOutputThunk:
         output = ModelOutputThunk(None)
         output._meta["alora_name"] = self.name
 
@@ -126,60 +163,131 @@ class HFConstraintAlora(HFAlora):
         )
         output._post_process = functools.partial(post_processing, backend=self._backend)
 
-        try:
-            # To support lazy computation, will need to remove this create_task and store just the unexecuted coroutine.
-            # We can also support synchronous calls by adding a flag and changing this ._generate function.
+        # This function should always be called from a running event loop so we don't have to worry about
+        # scheduling the task to a specific event loop here.
+        output._generate = asyncio.create_task(
+            send_to_queue(chat_response, output._async_queue)
+        )
+        output._generate_type = GenerateType.ASYNC
+        return output
+
+    def _check_constraints(
+        self, input: str, response: str, constraints: list[str], force_yn: bool
+    ) -> list[ConstraintCheckOutput]:
+        """Checks every constraint with the aLoRA and returns one output per constraint. Blocks; run it in a worker thread."""
+        assert self._backend.alora_model is not None
+        self._backend.alora_model.set_adapter(self.name)
+        tokenizer = self._backend._tokenizer
+        device = self._backend._device
+
+        prefix_ids, prefix_attention, prefix_kv = self._get_prefix(
+            input, response, prefill=len(constraints) > 1
+        )
 
-            # This function should always be called from a running event loop so we don't have to worry about
-            # scheduling the task to a specific event loop here.
-            output._generate = asyncio.create_task(
-                send_to_queue(chat_response, output._async_queue)  # type: ignore
+        suffixes: list[torch.Tensor] = []
+        # Rows are grouped by their alora offset. Key: offset -> Value: row indices.
+        groups: dict[int, list[int]] = {}
+        for i, constraint in enumerate(constraints):
+            # Must tokenize the constraint here since the requirement isn't known at initialization.
+            constraint_ids = tokenizer(
+                self._constraint_prompt.format(constraint), return_tensors="pt"
+            )["input_ids"][0].to(device)
+            suffixes.append(
+                torch.cat(
+                    [constraint_ids, self._generation_prompt_tokens["input_ids"][0]]
+                )
             )
-            output._generate_type = GenerateType.ASYNC
-        except RuntimeError as e:
-            # Most likely cause is running this function without an event loop present.
-            raise e
 
-        return output
+            if not self._include_constraint_in_alora_offset:
+                offset = self._generation_prompt_tokens["input_ids"].shape[1] - 1
+            else:
+                offset = (
+                    constraint_ids.shape[0]
+                    + self._generation_prompt_tokens["input_ids"].shape[1]
+                    - 2
+                )
+            groups.setdefault(offset, []).append(i)
+
+        pad_token_id = tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = tokenizer.eos_token_id
+
+        outputs: list[ConstraintCheckOutput] = [None] * len(constraints)  # type: ignore
+        # The aLoRA applies its adapter to the last `offset` tokens of every row, so rows are left-padded. Rows with different offsets go into separate batches because the adapter isn't scaled correctly when offsets differ within a batch.
+        for offset, rows in groups.items():
+            width = max(suffixes[i].shape[0] for i in rows)
+            suffix_ids = torch.full(
+                (len(rows), width), pad_token_id, dtype=prefix_ids.dtype, device=device
+            )
+            suffix_attention = torch.zeros(
+                (len(rows), width), dtype=prefix_attention.dtype, device=device
+            )
+            for row, i in enumerate(rows):
+                length = suffixes[i].shape[0]
+                suffix_ids[row, width - length :] = suffixes[i]
+                suffix_attention[row, width - length :] = 1
+
+            input_ids = torch.cat([prefix_ids.expand(len(rows), -1), suffix_ids], dim=1)
+            attention_mask = torch.cat(
+                [prefix_attention.expand(len(rows), -1), suffix_attention], dim=1
+            )
+            self._logger.debug(
+                f"Prompt for aLoRA({self.name}):\n {tokenizer.decode(input_ids[0])}"
+            )
+
+            generate_kwargs = {}
+            if prefix_kv is not None:
+                # Branching shares the prefix instead of copying it; generate never writes into the shared tensors.
+                generate_kwargs["past_key_values"] = branch_kv_cache(
+                    prefix_kv, batch_size=len(rows)
+                )
+
+            output = self._backend.alora_model.generate(
+                input_ids,
+                attention_mask=attention_mask,
+                max_new_tokens=1,
+                return_dict_in_generate=True,
+                alora_offsets=[offset],
+                output_scores=force_yn,
+                **generate_kwargs,
+            )
+
+            # Read the Y/N logits of every row at once; reading them per row syncs with the device for every constraint.
+            yn_logits = (
+                output.scores[-1][:, self._yn_token_ids].tolist()  # type: ignore
+                if force_yn
+                else None
+            )
+            for row, i in enumerate(rows):
+                outputs[i] = ConstraintCheckOutput(
+                    sequences=output.sequences[row : row + 1],  # type: ignore
+                    yn_logits=None if yn_logits is None else tuple(yn_logits[row]),  # type: ignore
+                )
+
+        return outputs
 
-    def _generate_using_cache(
-        self, cache_hit: HFAloraCacheInfo, constraint: str, force_yn: bool
-    ) -> dict:
-        """Returns the input object used for generation."""
-        # Must tokenize the constraint here since the requirement isn't known at initialization.
-        constraint_tokens = self._backend._tokenizer(
-            self._constraint_prompt.format(constraint), return_tensors="pt"
-        ).to(self._backend._device)
-
-        input_combined = {
-            "input_ids": torch.cat(
-                [
-                    cache_hit.merged_token_ids.unsqueeze(0),
-                    constraint_tokens["input_ids"],
-                    self._generation_prompt_tokens["input_ids"],
-                ],
-                dim=1,
-            ),
-            "attention_mask": torch.cat(
-                [
-                    cache_hit.merged_attention.unsqueeze(0),
-                    constraint_tokens["attention_mask"],
-                    self._generation_prompt_tokens["attention_mask"],
-                ],
-                dim=1,
-            ),
-        }
+    def _get_prefix(
+        self, input: str, response: str, prefill: bool
+    ) -> tuple[torch.Tensor, torch.Tensor, DynamicCache | None]:
+        """Returns the token ids, attention mask and kv cache of the input and response. The kv cache covers all but the last token.
+
+        The kv cache comes from the backend's cache if possible. Otherwise, it's only computed if `prefill` is set and None is returned if not.
+        """
+        cache_hit = self._backend.cache_get(response)
+        if cache_hit is not None:
+            self._logger.debug(
+                f"using cache for alora {self.__class__} and response '{response}'"
+            )
+            return (
+                cache_hit.merged_token_ids.unsqueeze(0),
+                cache_hit.merged_attention.unsqueeze(0),
+                cache_hit.kv_cache,
+            )
 
         self._logger.debug(
-            f"Prompt for cached aLoRA({self.name}):\n {self._backend._tokenizer.decode(input_combined['input_ids'][0])}"
+            f"not using cache for alora {self.__class__} and response '{response}'"
         )
 
-        return input_combined
-
-    def _generate_not_using_cache(
-        self, input: str, response: str, constraint: str, force_yn: bool
-    ) -> dict:
-        """Returns the input object used for generation."""
         # Params aren't needed when just getting the backend args.
         backend_model_opts = self._backend._simplify_and_merge(None)
         sys_prompt = backend_model_opts.get(ModelOption.SYSTEM_PROMPT, None)
@@ -193,37 +301,30 @@ class HFConstraintAlora(HFAlora):
         templatized = self._backend._tokenizer.apply_chat_template(chat, tokenize=False)
         assert type(templatized) is str
 
-        # Must tokenize the constraint here since the requirement isn't known at initialization.
-        templatized = templatized + self._constraint_prompt.format(constraint)
-
         tokenized = self._backend._tokenizer(templatized, return_tensors="pt").to(
             self._backend._device
         )
+        if not prefill:
+            return tokenized["input_ids"], tokenized["attention_mask"], None
 
-        input_combined = {
-            "input_ids": torch.cat(
-                [tokenized["input_ids"], self._generation_prompt_tokens["input_ids"]],
-                dim=1,
-            ),
-            "attention_mask": torch.cat(
-                [
-                    tokenized["attention_mask"],
-                    self._generation_prompt_tokens["attention_mask"],
-                ],
-                dim=1,
-            ),
-        }
-
-        self._logger.debug(
-            f"Prompt for non-cached aLoRA({self.name}):\n{self._backend._tokenizer.decode(input_combined['input_ids'][0])}"
+        # The prefix is computed by the base model, like the kv cache from the backend's cache, so its kv cache can be shared by every constraint.
+        assert self._backend.alora_model is not None
+        with torch.no_grad(), self._backend.alora_model.disable_adapter():
+            prefilled = self._backend.alora_model(
+                input_ids=tokenized["input_ids"][:, :-1],
+                attention_mask=tokenized["attention_mask"][:, :-1],
+                use_cache=True,
+            )
+        return (
+            tokenized["input_ids"],
+            tokenized["attention_mask"],
+            prefilled.past_key_values,
         )
 
-        return input_combined
-
 
 async def processing(
     mot: ModelOutputThunk,
-    chunk: GenerateDecoderOnlyOutput,
+    chunk: ConstraintCheckOutput,
     backend: LocalHFBackend,
     force_yn: bool,
     gen_prompt: str,
@@ -233,14 +334,11 @@ async def processing(
         mot._underlying_value = ""
 
     # Don't support async for HFConstraintAlora. Means we can process the output here.
-    assert isinstance(chunk, GenerateDecoderOnlyOutput)
+    assert isinstance(chunk, ConstraintCheckOutput)
 
     if force_yn:
-        last_logits = chunk.scores[-1].squeeze(0)  # type: ignore
-        token_Y = backend._tokenizer("Y", add_special_tokens=False)["input_ids"][0]  # type: ignore
-        token_N = backend._tokenizer("N", add_special_tokens=False)["input_ids"][0]  # type: ignore
-        logit_Y = last_logits[token_Y].item()
-        logit_N = last_logits[token_N].item()
+        assert chunk.yn_logits is not None
+        logit_Y, logit_N = chunk.yn_logits
         mot._underlying_value = "Y" if logit_Y > logit_N else "N"
     else:
         output_text = backend._tokenizer.decode(chunk.sequences[0])
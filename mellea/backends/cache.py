@@ -1,7 +1,14 @@
 """Caching strategies."""
 
+from __future__ import annotations
+
 import abc
+import sqlite3
+import threading
+import time
+import types
 from collections import OrderedDict
+from collections.abc import Sequence
 from typing import Any
 
 
@@ -61,3 +68,356 @@ class SimpleLRUCache(Cache):
             self.cache.popitem(last=False)
         # Add the new key-value pair to the end (most recent)
         self.cache[key] = value
+
+
+class ByteSizeLRUCache(Cache):
+    """An LRU cache that evicts based on the memory footprint of its values instead of the number of entries.
+
+    The footprint of a value is the size of all tensors reachable from it (e.g., the key/value tensors of a kv cache and the token ids in an `HFAloraCacheInfo`), grouped by the device the tensors live on. Whenever the bytes used on a device exceed that device's budget, the least recently used entries are evicted until it fits again. A value that does not fit into a budget on its own is not cached.
+    """
+
+    def __init__(self, max_bytes: int | dict[str, int]):
+        """Initializes the cache with a byte budget.
+
+        Args:
+            max_bytes: either a single budget that applies to every device, or a budget per device (e.g., `{"cuda:0": 8 * 2**30, "cpu": 32 * 2**30}`). Devices without a budget in the dict are unbounded.
+        """
+        self.max_bytes = max_bytes
+        self.cache: OrderedDict[str, tuple[Any, dict[str, int]]] = OrderedDict()
+        self._bytes: dict[str, int] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def current_size(self) -> int:
+        """Returns the number of entries in the cache."""
+        return len(self.cache)
+
+    def current_bytes(self, device: str | None = None) -> int:
+        """Returns the number of bytes used on a device, or across all devices if `device` is None."""
+        if device is None:
+            return sum(self._bytes.values())
+        return self._bytes.get(device, 0)
+
+    def get(self, key: str) -> Any | None:
+        """Gets a value from the cache."""
+        if key not in self.cache:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        entry = self.cache.pop(key)
+        self.cache[key] = entry
+        return entry[0]
+
+    def put(self, key: str, value: Any):
+        """Puts a value into the cache, then evicts least recently used entries until every device is within budget."""
+        if key in self.cache:
+            self._remove(key)
+
+        sizes = tensor_bytes_by_device(value)
+        if any(n_bytes > self._budget(device) for device, n_bytes in sizes.items()):
+            # The value can't fit by itself; don't evict everything else for it.
+            return
+
+        self.cache[key] = (value, sizes)
+        for device, n_bytes in sizes.items():
+            self._bytes[device] = self._bytes.get(device, 0) + n_bytes
+
+        for device in sizes:
+            while self._bytes.get(device, 0) > self._budget(device):
+                # Evict the least recently used entry that actually uses this device.
+                lru_key = next(k for k, (_, s) in self.cache.items() if device in s)
+                self._remove(lru_key)
+                self.evictions += 1
+
+    def _budget(self, device: str) -> float:
+        if isinstance(self.max_bytes, dict):
+            return self.max_bytes.get(device, float("inf"))
+        return self.max_bytes
+
+    def _remove(self, key: str):
+        _, sizes = self.cache.pop(key)
+        for device, n_bytes in sizes.items():
+            self._bytes[device] -= n_bytes
+            if self._bytes[device] == 0:
+                del self._bytes[device]
+
+
+class SqliteCache(Cache):
+    """A persistent LRU cache of strings backed by a [sqlite](https://sqlite.org) database file.
+
+    Several processes can share the same file (e.g., the workers of a batch job); sqlite serializes their writes. Values must be strings, so structured values should be serialized (e.g., to json) before they are put into the cache.
+    """
+
+    def __init__(self, path: str, capacity: int | None = None, timeout: float = 30.0):
+        """Opens (or creates) the cache database.
+
+        Args:
+            path: the path of the database file.
+            capacity: the maximum number of entries; the least recently used entries are evicted beyond it. Unbounded if `None`.
+            timeout: the number of seconds to wait for another process to release a lock on the database.
+        """
+        self.path = path
+        self.capacity = capacity
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        with self._lock, self._conn:
+            # Write-ahead logging lets readers in other processes proceed while an entry is written.
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)"
+            )
+
+    def current_size(self) -> int:
+        """Returns the number of entries in the database."""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def get(self, key: str) -> str | None:
+        """Returns the value for `key` and marks it as recently used, or returns `None`."""
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT value FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE cache SET accessed = ? WHERE key = ?", (time.time(), key)
+            )
+            return row[0]
+
+    def put(self, key: str, value: str):
+        """Inserts or replaces the value for `key`. May evict the least recently used entries."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, accessed) VALUES (?, ?, ?)",
+                (key, value, time.time()),
+            )
+            if self.capacity is not None:
+                self._conn.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.capacity,),
+                )
+
+    def remove(self, key: str):
+        """Removes the entry for `key` if there is one."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def close(self):
+        """Closes the connection to the database."""
+        with self._lock:
+            self._conn.close()
+
+
+def tensor_bytes_by_device(value: Any) -> dict[str, int]:
+    """Returns the number of bytes of all tensors reachable from `value`, grouped by device.
+
+    Traverses lists, tuples, dicts and object attributes. Tensors that share the same underlying storage (e.g., views or slices) are only counted once, and are counted with the size of the full storage since that is the memory they keep alive.
+    """
+    sizes: dict[str, int] = {}
+    seen_objects: set[int] = set()
+    seen_storages: set[tuple[str, int]] = set()
+
+    stack = [value]
+    while stack:
+        obj = stack.pop()
+        if obj is None or isinstance(obj, str | bytes | int | float | bool):
+            continue
+        if id(obj) in seen_objects:
+            continue
+        seen_objects.add(id(obj))
+
+        # Duck-type tensors so that this module doesn't depend on torch.
+        if hasattr(obj, "untyped_storage") and hasattr(obj, "device"):
+            device = str(obj.device)
+            storage = obj.untyped_storage()
+            storage_key = (device, storage.data_ptr())
+            if storage_key not in seen_storages:
+                seen_storages.add(storage_key)
+                sizes[device] = sizes.get(device, 0) + storage.nbytes()
+        elif isinstance(obj, dict):
+            stack.extend(obj.values())
+        elif isinstance(obj, list | tuple | set):
+            stack.extend(obj)
+        elif hasattr(obj, "__dict__") and not isinstance(
+            obj, type | types.ModuleType | types.FunctionType | types.MethodType
+        ):
+            stack.extend(vars(obj).values())
+
+    return sizes
+
+
+class _PrefixTreeNode:
+    """A node in a radix tree over token ids."""
+
+    __slots__ = ("children", "key")
+
+    def __init__(self):
+        # Key: first token of the edge -> Value: (edge tokens, child node).
+        self.children: dict[int, tuple[tuple[int, ...], _PrefixTreeNode]] = {}
+        # The full token sequence of the entry ending at this node, if there is one.
+        self.key: tuple[int, ...] | None = None
+
+
+class TokenPrefixCache:
+    """An LRU cache keyed by token id sequences that supports longest-prefix lookups.
+
+    The keys are indexed by a [radix tree](https://en.wikipedia.org/wiki/Radix_tree). A lookup returns the entry that shares the longest prefix with the queried sequence, together with the length of that shared prefix. The queried sequence does not need to extend an entry's key; sharing part of a key is enough. This makes it possible to reuse the model state (e.g., kv cache) of a previous request for the common prefix of a new request.
+    """
+
+    def __init__(self, capacity: int):
+        """Initializes the cache with a maximum number of entries."""
+        self.capacity = capacity
+        self.cache: OrderedDict[tuple[int, ...], Any] = OrderedDict()
+        self._root = _PrefixTreeNode()
+
+        self.hits = 0
+        self.misses = 0
+
+    def current_size(self) -> int:
+        """Returns the number of entries in the cache."""
+        return len(self.cache)
+
+    def put(self, tokens: Sequence[int], value: Any):
+        """Inserts a value for a token sequence. May result in eviction of the least recently used entry."""
+        key = tuple(tokens)
+        if key in self.cache:
+            self.cache.pop(key)
+        else:
+            if len(self.cache) >= self.capacity:
+                evicted_key, _ = self.cache.popitem(last=False)
+                self._remove(evicted_key)
+            self._insert(key)
+        self.cache[key] = value
+
+    def get(self, tokens: Sequence[int]) -> Any | None:
+        """Returns the value for exactly this token sequence, or `None`."""
+        key = tuple(tokens)
+        if key not in self.cache:
+            return None
+        value = self.cache.pop(key)
+        self.cache[key] = value
+        return value
+
+    def get_longest_prefix(
+        self, tokens: Sequence[int], max_length: int | None = None
+    ) -> tuple[int, Any | None]:
+        """Finds the entry sharing the longest prefix with `tokens`.
+
+        Args:
+            tokens: the token sequence to look up.
+            max_length: if set, the returned prefix length will be at most this long.
+
+        Returns:
+            a tuple of (prefix length, value). The first `prefix length` tokens of the value's key match `tokens`. Returns `(0, None)` on a miss.
+        """
+        query = tuple(tokens)
+        if max_length is not None:
+            query = query[:max_length]
+
+        node = self._root
+        matched = 0
+        subtree = None
+        while matched < len(query):
+            edge = node.children.get(query[matched], None)
+            if edge is None:
+                break
+            label, child = edge
+            common = _common_prefix_length(label, query, matched)
+            matched += common
+            if common < len(label):
+                # The query diverges in the middle of this edge. Every key below this child still shares `matched` tokens.
+                subtree = child
+                break
+            node = child
+
+        if subtree is None:
+            subtree = node
+        key = _any_key(subtree) if matched > 0 else None
+        if key is None:
+            self.misses += 1
+            return 0, None
+
+        self.hits += 1
+        value = self.cache.pop(key)
+        self.cache[key] = value
+        return matched, value
+
+    def _insert(self, key: tuple[int, ...]):
+        node = self._root
+        i = 0
+        while i < len(key):
+            edge = node.children.get(key[i], None)
+            if edge is None:
+                leaf = _PrefixTreeNode()
+                node.children[key[i]] = (key[i:], leaf)
+                node = leaf
+                i = len(key)
+                break
+
+            label, child = edge
+            common = _common_prefix_length(label, key, i)
+            if common < len(label):
+                # Split the edge.
+                middle = _PrefixTreeNode()
+                middle.children[label[common]] = (label[common:], child)
+                node.children[key[i]] = (label[:common], middle)
+                child = middle
+            node = child
+            i += common
+        node.key = key
+
+    def _remove(self, key: tuple[int, ...]):
+        # Walk down while remembering the path so that empty nodes can be pruned.
+        path: list[tuple[_PrefixTreeNode, int]] = []
+        node = self._root
+        i = 0
+        while i < len(key):
+            label, child = node.children[key[i]]
+            path.append((node, key[i]))
+            node = child
+            i += len(label)
+        node.key = None
+
+        # Prune or merge nodes that no longer carry information.
+        while path:
+            parent, first_token = path.pop()
+            label, child = parent.children[first_token]
+            if child.key is not None:
+                break
+            if len(child.children) == 0:
+                del parent.children[first_token]
+                continue
+            if len(child.children) == 1:
+                ((child_label, grandchild),) = child.children.values()
+                parent.children[first_token] = (label + child_label, grandchild)
+            break
+
+
+def _common_prefix_length(
+    label: tuple[int, ...], seq: tuple[int, ...], offset: int
+) -> int:
+    """Returns the number of leading tokens of `label` that match `seq` starting at `offset`."""
+    n = min(len(label), len(seq) - offset)
+    i = 0
+    while i < n and label[i] == seq[offset + i]:
+        i += 1
+    return i
+
+
+def _any_key(node: _PrefixTreeNode) -> tuple[int, ...] | None:
+    """Returns the key of any entry in the subtree rooted at `node`."""
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        if current.key is not None:
+            return current.key
+        stack.extend(child for _, child in current.children.values())
+    return None
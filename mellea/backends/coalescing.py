@@ -0,0 +1,242 @@
+"""A backend wrapper that coalesces identical in-flight requests.
+
+When many coroutines send the same request at the same time (e.g., the same LLMaJ requirement validated against the same output for every sample of a sampling strategy, or the same `@generative` call fanned out by a web server), each of them would start its own generation. The `CoalescingBackend` only sends the first one to the wrapped backend; identical requests that arrive while it is still being generated follow its stream instead (single-flight).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+from collections.abc import Callable
+from typing import Any
+
+from mellea.backends import Backend, BaseModelSubclass
+from mellea.backends.formatter import FormatterBackend, TemplateFormatter
+from mellea.backends.tools import (
+    add_tools_from_context,
+    add_tools_from_context_actions,
+    add_tools_from_model_options,
+    convert_tools_to_json,
+)
+from mellea.backends.types import ModelOption
+from mellea.helpers.async_helpers import ModelOutputThunkRelay
+from mellea.stdlib.base import CBlock, Component, Context, GenerateLog, ModelOutputThunk
+
+
+class CoalescingBackend(FormatterBackend):
+    """Wraps a backend and coalesces identical requests that are in flight at the same time.
+
+    A request is keyed by the model id, the fully rendered conversation, the model options (without options that don't change the response, like streaming), the json schema of the format and the json schemas of the available tools. While a request is being generated, identical requests don't call the wrapped backend: every caller gets its own `ModelOutputThunk` that streams the same response. `coalesced` counts the requests that were answered this way. Nothing is kept once a request is done; see `CachingBackend` to also answer later requests.
+
+    By default, only deterministic requests (temperature 0 or a fixed seed) are coalesced. Coalescing sampled requests makes all of them return the same sample, which defeats sampling strategies that send several identical requests at once; set `only_deterministic=False` if every identical request should get the same response anyway (e.g., duplicate requests from a web server). Requests that are not coalesced are passed through to the wrapped backend unchanged.
+    """
+
+    def __init__(self, backend: Backend, *, only_deterministic: bool = True):
+        """Wraps `backend`.
+
+        Args:
+            backend: the backend to wrap.
+            only_deterministic: if True, only requests with a temperature of 0 or a seed are coalesced.
+        """
+        formatter = (
+            backend.formatter
+            if isinstance(backend, FormatterBackend)
+            else TemplateFormatter(model_id=backend.model_id)
+        )
+        super().__init__(
+            backend.model_id, formatter, model_options=backend.model_options
+        )
+        self.backend = backend
+        self.only_deterministic = only_deterministic
+
+        # Requests that are currently being generated, by key.
+        self._in_flight: dict[str, ModelOutputThunkRelay] = {}
+
+        self.coalesced = 0
+
+    def generate_from_context(
+        self,
+        action: Component | CBlock,
+        ctx: Context,
+        *,
+        format: type[BaseModelSubclass] | None = None,
+        model_options: dict | None = None,
+        tool_calls: bool = False,
+    ) -> tuple[ModelOutputThunk, Context]:
+        """Follows an identical in-flight request, or generates the response with the wrapped backend."""
+        merged_options = self._simplify_and_merge(model_options)
+        linearized_ctx = ctx.view_for_generation()
+        if linearized_ctx is None or not self._is_shareable(merged_options):
+            return self.backend.generate_from_context(
+                action,
+                ctx,
+                format=format,
+                model_options=model_options,
+                tool_calls=tool_calls,
+            )
+
+        tools: dict[str, Callable] = dict()
+        if tool_calls and format is None:
+            add_tools_from_model_options(tools, merged_options)
+            add_tools_from_context(tools, ctx)
+            add_tools_from_context_actions(tools, [action])
+
+        key = self._key(linearized_ctx, action, merged_options, format, tools)
+        mot = self._lookup(key, action, linearized_ctx, merged_options, tools)
+        if mot is not None:
+            return mot, ctx.add(action).add(mot)
+
+        relay = self._in_flight.get(key, None)
+        if relay is not None:
+            # An identical request is already being generated; follow it instead of generating again.
+            self.coalesced += 1
+            mot = relay.subscribe(action, linearized_ctx, merged_options)
+            return mot, ctx.add(action).add(mot)
+
+        source, new_ctx = self.backend.generate_from_context(
+            action,
+            ctx,
+            format=format,
+            model_options=model_options,
+            tool_calls=tool_calls,
+        )
+        if source.is_computed():
+            self._completed(key, source)
+            return source, new_ctx
+
+        relay = ModelOutputThunkRelay(source)
+        self._in_flight[key] = relay
+        relay.task = asyncio.create_task(self._drive(key, relay))
+        mot = relay.subscribe(action, linearized_ctx, merged_options)
+        return mot, ctx.add(action).add(mot)
+
+    def generate_n_from_context(
+        self,
+        action: Component | CBlock,
+        ctx: Context,
+        *,
+        n: int,
+        format: type[BaseModelSubclass] | None = None,
+        model_options: dict | None = None,
+        tool_calls: bool = False,
+    ) -> list[tuple[ModelOutputThunk, Context]]:
+        """Passes sampled requests through to the wrapped backend so that it generates `n` different samples together."""
+        merged_options = self._simplify_and_merge(model_options)
+        if ctx.view_for_generation() is None or not (
+            self._is_shareable(merged_options)
+            and self._is_deterministic(merged_options)
+        ):
+            return self.backend.generate_n_from_context(
+                action,
+                ctx,
+                n=n,
+                format=format,
+                model_options=model_options,
+                tool_calls=tool_calls,
+            )
+        return super().generate_n_from_context(
+            action,
+            ctx,
+            n=n,
+            format=format,
+            model_options=model_options,
+            tool_calls=tool_calls,
+        )
+
+    def _generate_from_raw(
+        self,
+        actions: list[Component | CBlock],
+        *,
+        format: type[BaseModelSubclass] | None = None,
+        model_options: dict | None = None,
+        generate_logs: list[GenerateLog] | None = None,
+    ) -> list[ModelOutputThunk]:
+        """Passes raw generation through to the wrapped backend; raw requests are not coalesced."""
+        return self.backend._generate_from_raw(
+            actions,
+            format=format,
+            model_options=model_options,
+            generate_logs=generate_logs,
+        )
+
+    def _lookup(
+        self,
+        key: str,
+        action: Component | CBlock,
+        linearized_ctx: list[Component | CBlock],
+        model_options: dict[str, Any],
+        tools: dict[str, Callable],
+    ) -> ModelOutputThunk | None:
+        """Returns an already computed response for the request, if there is one. Nothing is kept by default."""
+        return None
+
+    def _completed(self, key: str, mot: ModelOutputThunk):
+        """Called with the computed response of every request that was sent to the wrapped backend."""
+
+    def _simplify_and_merge(
+        self, model_options: dict[str, Any] | None
+    ) -> dict[str, Any]:
+        """Merges the wrapped backend's model options with `model_options`, like the backend does, with backend-specific keys (e.g., ollama's "seed") replaced by their `ModelOption` keys. Equivalent requests therefore get the same key, however their options are spelled."""
+        # Requests from contexts are chat requests for the backends that distinguish them.
+        remap = getattr(
+            self.backend,
+            "to_mellea_model_opts_map",
+            getattr(self.backend, "to_mellea_model_opts_map_chats", {}),
+        )
+        return ModelOption.merge_model_options(
+            ModelOption.replace_keys(self.backend.model_options, remap),
+            ModelOption.replace_keys(model_options or {}, remap),
+        )
+
+    @staticmethod
+    def _is_deterministic(model_options: dict[str, Any]) -> bool:
+        return (
+            model_options.get(ModelOption.TEMPERATURE, None) == 0
+            or model_options.get(ModelOption.SEED, None) is not None
+        )
+
+    def _is_shareable(self, model_options: dict[str, Any]) -> bool:
+        """Returns whether identical requests with these options may get the same response."""
+        return not self.only_deterministic or self._is_deterministic(model_options)
+
+    def _key(
+        self,
+        linearized_ctx: list[Component | CBlock],
+        action: Component | CBlock,
+        model_options: dict[str, Any],
+        format: type[BaseModelSubclass] | None,
+        tools: dict[str, Callable],
+    ) -> str:
+        """Hashes everything that determines the response to a request."""
+        messages = self.formatter.to_chat_messages([*linearized_ctx, action])
+        options = {
+            str(k): v
+            for k, v in model_options.items()
+            # Streaming doesn't change the response, and tools are keyed by their schemas below.
+            if k not in (ModelOption.STREAM, ModelOption.TOOLS) and not callable(v)
+        }
+        request = {
+            "model_id": str(self.model_id),
+            "messages": [
+                {"role": m.role, "content": m.content, "images": m.images}
+                for m in messages
+            ],
+            "model_options": options,
+            "format": None if format is None else format.model_json_schema(),
+            "tools": convert_tools_to_json(tools),
+        }
+        serialized = json.dumps(request, sort_keys=True, default=repr)
+        return hashlib.sha256(serialized.encode()).hexdigest()
+
+    async def _drive(self, key: str, relay: ModelOutputThunkRelay):
+        """Generates the response of an in-flight request."""
+        try:
+            await relay.consume()
+            self._completed(key, relay.source)
+            relay.finish()
+        except Exception as e:
+            relay.finish(e)
+        finally:
+            if self._in_flight.get(key, None) is relay:
+                del self._in_flight[key]
@@ -1,14 +1,15 @@
 """Abstract interfaces for Formatters."""
 
+from __future__ import annotations
+
 import abc
 import os
 import re
 import sys
-from collections.abc import Iterable, Mapping
+import weakref
+from collections.abc import Hashable, Iterable, Mapping
 from dataclasses import fields
-from typing import Any
-
-import jinja2
+from typing import TYPE_CHECKING, Any
 
 from mellea.backends import Backend
 from mellea.backends.cache import SimpleLRUCache
@@ -19,9 +20,14 @@ from mellea.stdlib.base import (
     Component,
     ModelOutputThunk,
     TemplateRepresentation,
+    render_version,
 )
 from mellea.stdlib.chat import Message, ToolMessage
 
+if TYPE_CHECKING:
+    # jinja2 is imported when the first template is loaded.
+    import jinja2
+
 
 class Formatter(abc.ABC):
     """A Formatter converts `Component`s into strings and parses `ModelOutputThunk`s into `Component`s (or `CBlock`s)."""
@@ -79,6 +85,34 @@ class Formatter(abc.ABC):
         return [_to_msg(c) for c in cs]
 
 
+class RenderMemo:
+    """Remembers a value per object and render version (see `render_version`), e.g., the rendering of a component. Holds weak references to the objects."""
+
+    def __init__(self):
+        """Initializes an empty memo."""
+        self._entries: weakref.WeakKeyDictionary[Any, tuple[Hashable, Any]] = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def get(self, obj: Any, version: Hashable) -> Any | None:
+        """Returns the value remembered for `obj` at `version`, or `None`."""
+        try:
+            entry = self._entries.get(obj, None)
+        except TypeError:
+            # Unhashable objects and objects without weak references can't be remembered.
+            return None
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        return None
+
+    def put(self, obj: Any, version: Hashable, value: Any):
+        """Remembers `value` for `obj` at `version`."""
+        try:
+            self._entries[obj] = (version, value)
+        except TypeError:
+            pass
+
+
 class TemplateFormatter(Formatter, abc.ABC):
     """Formatter that uses jinja2 templates."""
 
@@ -94,7 +128,7 @@ class TemplateFormatter(Formatter, abc.ABC):
         Args:
             model_id: Describes the model for which templates will be looked up. Should match the template dir structure.
             template_path: Specify an alternate location where templates can be found. Will be preferred over all other template dirs even if a less exact match is found.
-            use_template_cache: Cache the location of the most recent templates so that future lookups don't need to be performed. Set to false if you plan on changing the model_id or template_path after the TemplateFormatter has been created.
+            use_template_cache: Cache the location of the most recent templates so that future lookups don't need to be performed, index the template directories once per process instead of searching them on every lookup, and reuse the renderings of components that haven't changed. Set to false if you plan on changing the model_id or template_path after the TemplateFormatter has been created, or on adding templates while the process runs.
         """
         self.model_id = model_id
         self._template_path: str = template_path
@@ -104,6 +138,16 @@ class TemplateFormatter(Formatter, abc.ABC):
         # Key: obj.__class__.__name___ -> Value: jinja2.Template
         self._template_cache = SimpleLRUCache(10) if self._use_template_cache else None
 
+        # The renderings and chat messages of components that haven't changed are reused across turns.
+        self._renderings = RenderMemo()
+        self._messages = RenderMemo()
+
+        if self._use_template_cache:
+            # Index the template directories now so that template lookups don't walk the file system.
+            if self._template_path != "":
+                self._template_index(self._template_path)
+            self._template_index(_package_loader("mellea")._template_root)
+
     def parse(
         self, source_component: Component | CBlock, result: ModelOutputThunk
     ) -> ModelOutputThunk:
@@ -193,23 +237,14 @@ class TemplateFormatter(Formatter, abc.ABC):
                 return c.value
 
             case Component():
-                representation = c.format_for_llm()
-                if type(representation) is str:
-                    return representation
-                else:
-                    assert isinstance(representation, TemplateRepresentation)
-                    stringified_template_args = {}
-                    for key, val in representation.args.items():
-                        stringified_template_args[key] = self._stringify(val)
-
-                    if representation.obj is None:
-                        FancyLogger.get_logger().warning(
-                            f"template formatter encountered a TemplateRepresentation with no obj when stringifying {c.__class__}; setting obj to {c}"
-                        )
-                        representation.obj = c
-                    return self._load_template(representation).render(
-                        stringified_template_args
-                    )
+                version = render_version(c) if self._use_template_cache else None
+                if version is not None:
+                    rendering = self._renderings.get(c, version)
+                    if rendering is None:
+                        rendering = self._render(c)
+                        self._renderings.put(c, version, rendering)
+                    return rendering
+                return self._render(c)
 
             case c if isinstance(c, Mapping):
                 stringified_template_args = {}
@@ -231,10 +266,49 @@ class TemplateFormatter(Formatter, abc.ABC):
                 )
                 return str(c)
 
+    def _render(self, c: Component) -> str:
+        """Renders `c` with its template."""
+        representation = c.format_for_llm()
+        if type(representation) is str:
+            return representation
+        else:
+            assert isinstance(representation, TemplateRepresentation)
+            stringified_template_args = {}
+            for key, val in representation.args.items():
+                stringified_template_args[key] = self._stringify(val)
+
+            if representation.obj is None:
+                FancyLogger.get_logger().warning(
+                    f"template formatter encountered a TemplateRepresentation with no obj when stringifying {c.__class__}; setting obj to {c}"
+                )
+                representation.obj = c
+            return self._load_template(representation).render(stringified_template_args)
+
     def print(self, c: Component | CBlock) -> str:
         """Uses a jinja2 template to pretty-print components."""
         return self._stringify(c)
 
+    def to_chat_messages(self, cs: list[Component | CBlock]) -> list[Message]:
+        """Converts a linearized chat history into a list of messages. The messages of components that haven't changed since a previous call are reused (see `render_version`)."""
+        if not self._use_template_cache:
+            return super().to_chat_messages(cs)
+
+        messages = []
+        for c in cs:
+            if isinstance(c, Message):
+                # Messages are used as they are.
+                messages.append(c)
+                continue
+
+            version = render_version(c)
+            message = self._messages.get(c, version) if version is not None else None
+            if message is None:
+                message = super().to_chat_messages([c])[0]
+                if version is not None:
+                    self._messages.put(c, version, message)
+            messages.append(message)
+        return messages
+
     def _load_template(self, repr: TemplateRepresentation) -> jinja2.Template:
         """This method makes an attempt at auto-loading a Template for the Component.
 
@@ -249,8 +323,15 @@ class TemplateFormatter(Formatter, abc.ABC):
         Raises:
             Exception: If there's an unexpected jinja error or the template cannot be found.
         """
+        import jinja2
+
+        from mellea.helpers.template_helpers import (
+            compile_template,
+            template_environment,
+        )
+
         if repr.template:
-            return jinja2.Environment().from_string(repr.template)  # type: ignore
+            return compile_template(repr.template)
 
         if repr.template_order is None:
             FancyLogger.get_logger().warning(
@@ -286,11 +367,15 @@ class TemplateFormatter(Formatter, abc.ABC):
                 # Default to Mellea if one can't be found.
                 package = _get_package_name(repr.obj.__class__.__module__)
                 try:
-                    loader = jinja2.PackageLoader(package)
+                    loader = (
+                        _package_loader(package)
+                        if self._use_template_cache
+                        else jinja2.PackageLoader(package)
+                    )
                 except Exception as e:
                     if package != "mellea":
                         # Mellea should always be available.
-                        loader = jinja2.PackageLoader("mellea")
+                        loader = _package_loader("mellea")
                     else:
                         raise ValueError(
                             f"could not find package for obj: {repr.obj}, exception: {e}"
@@ -313,9 +398,12 @@ class TemplateFormatter(Formatter, abc.ABC):
         try:
             # If we get here, we know the loader is populated and we have found a file that
             # contains the template for the object.
-            env = jinja2.Environment(
-                loader=loader, autoescape=jinja2.select_autoescape()
-            )
+            assert loader is not None
+            if self._use_template_cache:
+                # Shared environments keep their compiled templates across formatters and lookups.
+                env = _environment(loader)
+            else:
+                env = template_environment(loader)
             tmpl = env.get_template(qualified_tmpl_name)
 
         except (jinja2.TemplateNotFound, ValueError) as tnf:
@@ -333,44 +421,24 @@ class TemplateFormatter(Formatter, abc.ABC):
         return tmpl
 
     def _get_template(self, root_path: str, template_name: str) -> str:
-        """Attempts to walk the provided directory structure to find the best matching template.
+        """Returns the path (relative to `root_path`) of the best matching template for the formatter's model id, or an empty string if there is none. See `_index_templates`."""
+        return self._template_index(root_path).get(template_name.lower(), "")
 
-        Prefers the most exact match (meaning deepest directory tree) by:
-        1. Looking for directory names matching the model name
-        2. Looking in the `prompts/default/` directory for a template
+    def _template_index(self, root_path: str) -> dict[str, str]:
+        """Returns the template index of `root_path` for the formatter's model id.
 
-        Assumes that only one directory at each level matches.
+        Indexes are built once and shared by all formatters in the process. Without the template cache, the directory is indexed again on every lookup so that changes to the templates are picked up.
         """
-        # Simplify the provided model to make matching easier.
-        model_id = self._get_model_id()
-        simplified_model_id = _simplify_model_string(model_id)
-
-        # Traverse the directory structure to find the most specific template.
-        path_offset = len(root_path)  # Used to get the template name used by Jinja2.
-        candidate_template = ""
-        for root, dirs, files in os.walk(top=root_path, topdown=True):
-            # Only look at the default templates if a candidate hasn't yet been chosen.
-            # Otherwise, we already have a more specific template.
-            is_default = root.rsplit("/")[-1].lower() == "default"
-            candidate_found = candidate_template != ""
-            if not (is_default and candidate_found):
-                for file in files:
-                    if file.lower() == template_name.lower():
-                        template_path = root[path_offset:].lstrip(os.path.sep)
-                        candidate_template = os.path.join(template_path, file).replace(
-                            os.path.sep, "/"
-                        )
+        simplified_model_id = _simplify_model_string(self._get_model_id())
+        if not self._use_template_cache:
+            return _index_templates(root_path, simplified_model_id)
 
-            # Only traverse file paths that are in the model id or are prompts/default.
-            for dir in dirs:
-                if dir.lower() == "prompts" or dir.lower() == "default":
-                    continue
-
-                # Simplify the directory as well for matching names.
-                if _simplify_model_string(dir.lower()) not in simplified_model_id:
-                    dirs.remove(dir)
-
-        return candidate_template
+        key = (root_path, simplified_model_id)
+        index = _template_indexes.get(key, None)
+        if index is None:
+            index = _index_templates(root_path, simplified_model_id)
+            _template_indexes[key] = index
+        return index
 
     def _get_model_id(self) -> str:
         """Gets a string representation of the formatter's model id."""
@@ -397,6 +465,88 @@ def _simplify_model_string(input: str) -> str:
     return re.sub(remove_chars, "", input.lower())
 
 
+# Key: (template root, simplified model id) -> Value: template index. See `_index_templates`.
+_template_indexes: dict[tuple[str, str], dict[str, str]] = {}
+
+# Key: package name -> Value: the package's template loader, or `None` if the package has no templates.
+_package_loaders: dict[str, jinja2.PackageLoader | None] = {}
+
+# Key: template root -> Value: the environment that loads templates from it.
+_environments: dict[str, jinja2.Environment] = {}
+
+
+def _index_templates(root_path: str, simplified_model_id: str) -> dict[str, str]:
+    """Walks the directory structure once and returns the best matching template for every template name (lower cased).
+
+    Prefers the most exact match (meaning deepest directory tree) by:
+    1. Looking for directory names matching the model name
+    2. Looking in the `prompts/default/` directory for a template
+
+    Assumes that only one directory at each level matches. The paths are relative to `root_path` and use `/` as separator, like the template names used by Jinja2.
+    """
+    index: dict[str, str] = {}
+    path_offset = len(root_path)  # Used to get the template name used by Jinja2.
+    for root, dirs, files in os.walk(top=root_path, topdown=True):
+        # Only look at the default templates if a candidate hasn't yet been chosen.
+        # Otherwise, we already have a more specific template.
+        is_default = root.rsplit("/")[-1].lower() == "default"
+        template_path = root[path_offset:].lstrip(os.path.sep)
+        for file in files:
+            if not (is_default and file.lower() in index):
+                index[file.lower()] = os.path.join(template_path, file).replace(
+                    os.path.sep, "/"
+                )
+
+        # Only traverse file paths that are in the model id or are prompts/default.
+        # Simplify the directory as well for matching names.
+        dirs[:] = [
+            dir
+            for dir in dirs
+            if dir.lower() in ("prompts", "default")
+            or _simplify_model_string(dir.lower()) in simplified_model_id
+        ]
+
+    return index
+
+
+def _package_loader(package: str) -> jinja2.PackageLoader:
+    """Returns the shared template loader of `package`. Raises a `ValueError` if the package has no templates."""
+    import jinja2
+
+    if package not in _package_loaders:
+        try:
+            _package_loaders[package] = jinja2.PackageLoader(package)
+        except Exception:
+            _package_loaders[package] = None
+    loader = _package_loaders[package]
+    if loader is None:
+        raise ValueError(f"package {package} has no templates")
+    return loader
+
+
+def _environment(
+    loader: jinja2.PackageLoader | jinja2.FileSystemLoader,
+) -> jinja2.Environment:
+    """Returns the shared environment for the templates of `loader`'s directory. It loads templates from the bytecode cache that `m templates compile` creates, if there is one."""
+    import jinja2
+
+    from mellea.helpers.template_helpers import (
+        default_bytecode_cache,
+        template_environment,
+    )
+
+    root = (
+        loader._template_root
+        if isinstance(loader, jinja2.PackageLoader)
+        else os.pathsep.join(loader.searchpath)
+    )
+    env = _environments.get(root, None)
+    if env is None:
+        env = template_environment(loader, default_bytecode_cache())
+        _environments[root] = env
+    return env
+
+
 def _get_package_name(module: str) -> str:
     """Given a module, attempts to get the package and verifies it exists."""
     package = module.split(".")[0]
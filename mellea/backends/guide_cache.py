@@ -0,0 +1,179 @@
+"""A process-wide cache for the regex guides used by constrained decoding.
+
+Constrained decoding with outlines compiles a json schema into a regex and then into an index over the whole vocabulary of the tokenizer. That compilation can take seconds for non-trivial pydantic models. The `GuideCache` memoizes both steps so that repeated structured-output requests (e.g., `@generative` slots) only pay for it once per (schema, tokenizer).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
+import weakref
+from typing import Any, cast
+
+import outlines
+import outlines_core
+from outlines.fsm.guide import Guide, RegexGuide
+from outlines.processors.structured import GuideLogitsProcessor
+
+from mellea.backends.cache import SimpleLRUCache
+from mellea.helpers.fancy_logger import FancyLogger
+
+assert outlines, "outlines needs to be present to make outlines_core work"
+
+
+class GuideCache:
+    """A size-bounded cache of json schema regexes and compiled `RegexGuide`s.
+
+    Guides are keyed by the regex and the identity of the (outlines) tokenizer they were compiled against. Guides are stateless, so a single guide can be shared by any number of concurrent requests; each request still needs its own logits processor. Use `logits_processor` to get one.
+
+    If `cache_dir` is set, compiled guides are also stored on disk so that restarted processes can skip compilation. On-disk entries are keyed by the regex and a fingerprint of the tokenizer's vocabulary. The guides are stored with pickle, and loading a pickle can run arbitrary code, so `cache_dir` must be a trusted directory that only trusted users can write to.
+    """
+
+    def __init__(self, capacity: int = 32, cache_dir: str | None = None):
+        """Initializes the cache.
+
+        Args:
+            capacity: the maximum number of regexes and guides to keep in memory.
+            cache_dir: if set, a trusted directory in which compiled guides are stored across processes.
+        """
+        self.capacity = capacity
+        self.cache_dir = cache_dir
+
+        # Key: schema json -> Value: regex.
+        self._regexes = SimpleLRUCache(capacity)
+        # Key: (regex, id(tokenizer)) -> Value: (tokenizer, RegexGuide).
+        self._guides = SimpleLRUCache(capacity)
+        # Key: id(tokenizer) -> Value: fingerprint of its vocabulary; entries are removed when the tokenizer is collected.
+        self._fingerprints: dict[int, str] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def regex_for_schema(self, schema_json: str) -> str:
+        """Returns the regex for a json schema."""
+        with self._lock:
+            regex = self._regexes.get(schema_json)
+        if regex is None:
+            regex = outlines_core.fsm.json_schema.build_regex_from_schema(  # type: ignore
+                schema_json
+            )
+            with self._lock:
+                self._regexes.put(schema_json, regex)
+        return regex
+
+    def get_guide(self, regex: str, tokenizer: Any) -> RegexGuide:
+        """Returns the compiled guide for a regex and an outlines tokenizer."""
+        key = (regex, id(tokenizer))
+        with self._lock:
+            entry = self._guides.get(key)  # type: ignore
+
+        # The tokenizer is kept in the entry so that its id can't be reused by another tokenizer.
+        if entry is not None and entry[0] is tokenizer:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        guide = self._load_from_disk(regex, tokenizer)
+        if guide is None:
+            guide = RegexGuide.from_regex(regex, tokenizer)
+            self._save_to_disk(regex, tokenizer, guide)
+
+        with self._lock:
+            self._guides.put(key, (tokenizer, guide))  # type: ignore
+        return guide
+
+    def logits_processor(
+        self, schema: dict[str, Any], tokenizer: Any
+    ) -> GuideLogitsProcessor:
+        """Returns a new logits processor that constrains generation to a json schema.
+
+        Args:
+            schema: the json schema; usually from `BaseModel.model_json_schema()`.
+            tokenizer: an outlines tokenizer (e.g., a `TransformerTokenizer`). Reuse the same object across calls to get cache hits.
+        """
+        regex = self.regex_for_schema(json.dumps(schema))
+        # outlines' own `RegexLogitsProcessor` passes a `RegexGuide` here too; it implements the `Guide` protocol of outlines_core but isn't a subclass of outlines' `Guide`.
+        guide = cast(Guide, self.get_guide(regex, tokenizer))
+        return GuideLogitsProcessor(tokenizer=tokenizer, guide=guide)
+
+    # region on-disk storage
+    def _tokenizer_fingerprint(self, tokenizer: Any) -> str:
+        """Returns a fingerprint of the tokenizer's vocabulary. It is computed once per tokenizer since hashing a vocabulary of 100k+ tokens is slow."""
+        # Keyed by id since outlines tokenizers hash their whole underlying tokenizer.
+        key = id(tokenizer)
+        with self._lock:
+            fingerprint = self._fingerprints.get(key)
+        if fingerprint is not None:
+            return fingerprint
+
+        fingerprint = hashlib.sha256(
+            json.dumps(sorted(tokenizer.vocabulary.items())).encode()
+            + str(tokenizer.eos_token_id).encode()
+        ).hexdigest()
+        try:
+            # Forget the fingerprint when the tokenizer is collected so that its id can't be reused by another tokenizer.
+            weakref.finalize(tokenizer, self._fingerprints.pop, key, None)
+        except TypeError:
+            # The tokenizer can't be weakly referenced; don't cache its fingerprint.
+            return fingerprint
+        with self._lock:
+            self._fingerprints[key] = fingerprint
+        return fingerprint
+
+    def _disk_path(self, regex: str, tokenizer: Any) -> str | None:
+        if self.cache_dir is None:
+            return None
+        # Pickled guides are only valid for the version of outlines_core that created them.
+        fingerprint = hashlib.sha256()
+        fingerprint.update(getattr(outlines_core, "__version__", "").encode())
+        fingerprint.update(regex.encode())
+        fingerprint.update(self._tokenizer_fingerprint(tokenizer).encode())
+        return os.path.join(self.cache_dir, f"{fingerprint.hexdigest()}.pkl")
+
+    def _load_from_disk(self, regex: str, tokenizer: Any) -> RegexGuide | None:
+        path = self._disk_path(regex, tokenizer)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            FancyLogger.get_logger().warning(
+                f"could not load cached guide from {path}: {e}"
+            )
+            return None
+
+    def _save_to_disk(self, regex: str, tokenizer: Any, guide: RegexGuide):
+        path = self._disk_path(regex, tokenizer)
+        if path is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)  # type: ignore
+            # Write to a temporary file first so that other processes never read partial files.
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(guide, f)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            FancyLogger.get_logger().warning(
+                f"could not store compiled guide in {path}: {e}"
+            )
+
+    # endregion
+
+
+# Shared by all backends in the process.
+_guide_cache = GuideCache(cache_dir=os.environ.get("MELLEA_GUIDE_CACHE_DIR", None))
+
+
+def get_guide_cache() -> GuideCache:
+    """Returns the process-wide `GuideCache`.
+
+    Set the `MELLEA_GUIDE_CACHE_DIR` environment variable to store compiled guides on disk. The directory must be trusted; see `GuideCache`.
+    """
+    return _guide_cache
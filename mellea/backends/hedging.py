@@ -0,0 +1,277 @@
+"""A backend wrapper that hedges slow requests to cut tail latency.
+
+If a request hasn't produced any output after the hedge delay, the `HedgingBackend` sends a duplicate request (to the same backend, or to a secondary backend), continues with whichever request produces output first and cancels the other one. The hedge delay adapts to the backend: it is a high percentile of the recently observed times to first output, so only the slowest few percent of requests are hedged.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import bisect
+import math
+import time
+from collections.abc import Callable
+
+from mellea.backends import Backend, BaseModelSubclass
+from mellea.backends.formatter import FormatterBackend, TemplateFormatter
+from mellea.helpers.async_helpers import ModelOutputThunkRelay
+from mellea.helpers.fancy_logger import FancyLogger
+from mellea.stdlib.base import CBlock, Component, Context, GenerateLog, ModelOutputThunk
+
+
+class LatencyHistogram:
+    """A histogram of latencies with logarithmically spaced buckets.
+
+    Percentiles are accurate to within a factor of `growth`. Once the histogram holds `max_count` measurements, all counts are halved so that percentiles follow changes in latency.
+    """
+
+    def __init__(
+        self,
+        min_latency: float = 0.001,
+        max_latency: float = 600.0,
+        growth: float = 1.2,
+        max_count: int = 1000,
+    ):
+        """Creates an empty histogram.
+
+        Args:
+            min_latency: the upper bound of the first bucket in seconds.
+            max_latency: the upper bound of the last bucket in seconds; longer latencies are counted in the last bucket.
+            growth: the ratio between the upper bounds of consecutive buckets.
+            max_count: the number of measurements after which old measurements are decayed.
+        """
+        self.bounds: list[float] = []
+        bound = min_latency
+        while bound < max_latency:
+            self.bounds.append(bound)
+            bound *= growth
+        self.bounds.append(max_latency)
+
+        self.counts = [0] * len(self.bounds)
+        self.count = 0
+        self.max_count = max_count
+
+    def record(self, latency: float):
+        """Adds a measurement in seconds."""
+        i = min(bisect.bisect_left(self.bounds, latency), len(self.bounds) - 1)
+        self.counts[i] += 1
+        self.count += 1
+        if self.count >= self.max_count:
+            self.counts = [c // 2 for c in self.counts]
+            self.count = sum(self.counts)
+
+    def percentile(self, q: float) -> float | None:
+        """Returns the upper bound of the bucket that holds the `q`-th percentile (0 <= q <= 100), or `None` if the histogram is empty."""
+        if self.count == 0:
+            return None
+        rank = max(1, math.ceil(q / 100 * self.count))
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.bounds[-1]
+
+
+class HedgingBackend(FormatterBackend):
+    """Sends a duplicate request when a request is slow to produce output.
+
+    The hedge delay is the `percentile`-th percentile of the times to first output that the backend has observed, clamped to [`min_delay`, `max_delay`]. `initial_delay` is used until `min_samples` measurements have been collected. Hedged requests put `hedged: True` in the `_meta` of their ModelOutputThunk; `hedges` and `hedge_wins` count the duplicate requests and the number of times a duplicate request won.
+
+    The race is decided by the first output, not by the full response, so the winner's output can be streamed while it is generated. Losing requests are cancelled; backends that generate in a thread (e.g., huggingface) finish the generation they already started in the background.
+    """
+
+    def __init__(
+        self,
+        backend: Backend,
+        *,
+        secondary: Backend | None = None,
+        percentile: float = 95.0,
+        initial_delay: float = 1.0,
+        min_delay: float = 0.05,
+        max_delay: float = 10.0,
+        min_samples: int = 20,
+        histogram: LatencyHistogram | None = None,
+    ):
+        """Wraps `backend`.
+
+        Args:
+            backend: the backend that receives every request.
+            secondary: the backend that receives the duplicate requests; defaults to `backend`. A `RouterBackend` as `backend` also sends duplicates to a different replica.
+            percentile: the percentile of the times to first output that is used as the hedge delay.
+            initial_delay: the hedge delay in seconds until `min_samples` measurements have been collected.
+            min_delay: the lower bound of the hedge delay in seconds.
+            max_delay: the upper bound of the hedge delay in seconds.
+            min_samples: the number of measurements needed before the hedge delay adapts.
+            histogram: the histogram of the times to first output; pass a histogram to share measurements between wrappers.
+        """
+        formatter = (
+            backend.formatter
+            if isinstance(backend, FormatterBackend)
+            else TemplateFormatter(model_id=backend.model_id)
+        )
+        super().__init__(
+            backend.model_id, formatter, model_options=backend.model_options
+        )
+
+        self.backend = backend
+        self.secondary = secondary if secondary is not None else backend
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self.histogram = histogram if histogram is not None else LatencyHistogram()
+
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def hedge_delay(self) -> float:
+        """Returns the number of seconds to wait for the first output before sending a duplicate request."""
+        if self.histogram.count < self.min_samples:
+            return self.initial_delay
+        delay = self.histogram.percentile(self.percentile)
+        assert delay is not None
+        return min(max(delay, self.min_delay), self.max_delay)
+
+    def generate_from_context(
+        self,
+        action: Component | CBlock,
+        ctx: Context,
+        *,
+        format: type[BaseModelSubclass] | None = None,
+        model_options: dict | None = None,
+        tool_calls: bool = False,
+    ) -> tuple[ModelOutputThunk, Context]:
+        """Generates with the wrapped backend and hedges the request if it is slow to produce output."""
+        primary, _ = self.backend.generate_from_context(
+            action,
+            ctx,
+            format=format,
+            model_options=model_options,
+            tool_calls=tool_calls,
+        )
+        if primary.is_computed():
+            return primary, ctx.add(action).add(primary)
+
+        def hedge() -> ModelOutputThunk:
+            return self.secondary.generate_from_context(
+                action,
+                ctx,
+                format=format,
+                model_options=model_options,
+                tool_calls=tool_calls,
+            )[0]
+
+        self.requests += 1
+        relay = ModelOutputThunkRelay(primary)
+        relay.task = asyncio.create_task(self._drive(relay, hedge))
+        mot = relay.subscribe(action, ctx.view_for_generation(), model_options)
+        return mot, ctx.add(action).add(mot)
+
+    def generate_n_from_context(
+        self,
+        action: Component | CBlock,
+        ctx: Context,
+        *,
+        n: int,
+        format: type[BaseModelSubclass] | None = None,
+        model_options: dict | None = None,
+        tool_calls: bool = False,
+    ) -> list[tuple[ModelOutputThunk, Context]]:
+        """Passes the request to the wrapped backend without hedging; duplicating a multi-sample request would duplicate all of its samples."""
+        return self.backend.generate_n_from_context(
+            action,
+            ctx,
+            n=n,
+            format=format,
+            model_options=model_options,
+            tool_calls=tool_calls,
+        )
+
+    def _generate_from_raw(
+        self,
+        actions: list[Component | CBlock],
+        *,
+        format: type[BaseModelSubclass] | None = None,
+        model_options: dict | None = None,
+        generate_logs: list[GenerateLog] | None = None,
+    ) -> list[ModelOutputThunk]:
+        """Passes the request to the wrapped backend. Raw requests are synchronous, so they aren't hedged."""
+        return self.backend._generate_from_raw(
+            actions,
+            format=format,
+            model_options=model_options,
+            generate_logs=generate_logs,
+        )
+
+    async def _drive(
+        self, relay: ModelOutputThunkRelay, hedge: Callable[[], ModelOutputThunk]
+    ):
+        try:
+            relay.source = await self._race(relay.source, hedge)
+            await relay.consume()
+        except Exception as e:
+            relay.finish(e)
+            return
+        relay.finish()
+
+    async def _race(
+        self, primary: ModelOutputThunk, hedge: Callable[[], ModelOutputThunk]
+    ) -> ModelOutputThunk:
+        """Returns the first request to produce output and cancels the other one. Raises the last error if every request fails."""
+        attempts = {asyncio.create_task(primary.astream()): (primary, time.monotonic())}
+        done, _ = await asyncio.wait(attempts, timeout=self.hedge_delay())
+
+        hedged = len(done) == 0
+        if hedged:
+            self.hedges += 1
+            FancyLogger.get_logger().debug(
+                f"No output after {self.hedge_delay():.3f} seconds; sending a hedge request."
+            )
+            try:
+                duplicate = hedge()
+                attempts[asyncio.create_task(duplicate.astream())] = (
+                    duplicate,
+                    time.monotonic(),
+                )
+            except Exception as e:
+                FancyLogger.get_logger().warning(f"Sending a hedge request failed: {e}")
+
+        pending = set(attempts)
+        error: BaseException | None = None
+        while len(pending) > 0:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                error = task.exception()
+                if error is not None:
+                    continue
+
+                winner, started = attempts[task]
+                now = time.monotonic()
+                self.histogram.record(now - started)
+                for other in pending:
+                    other.cancel()
+                    loser, loser_started = attempts[other]
+                    _cancel(loser)
+                    if loser is primary:
+                        # A lower bound of the primary's latency; leaving it out would bias the hedge delay toward fast requests.
+                        self.histogram.record(now - loser_started)
+
+                if winner is not primary:
+                    self.hedge_wins += 1
+                if hedged:
+                    winner._meta["hedged"] = True
+                return winner
+
+        assert error is not None
+        raise error
+
+
+def _cancel(mot: ModelOutputThunk):
+    """Cancels the tasks generating `mot`."""
+    for task in (mot._generate, mot._generate_extra):
+        if task is not None:
+            task.cancel()
@@ -11,10 +11,11 @@ import dataclasses
 import datetime
 import functools
 import inspect
-import json
+import threading
 from collections.abc import Callable, Coroutine
-from typing import TYPE_CHECKING, Any
+from typing import TYPE_CHECKING, Any, cast
 
+import numpy as np
 import outlines
 import outlines_core
 import torch
@@ -22,27 +23,31 @@ from transformers import (
     AsyncTextIteratorStreamer,
     AutoModelForCausalLM,
     AutoTokenizer,
+    BatchEncoding,
     DynamicCache,
     PreTrainedModel,
     PreTrainedTokenizer,
     set_seed,
 )
+from transformers.generation.streamers import BaseStreamer
 from transformers.generation.utils import GenerateDecoderOnlyOutput
 
 from mellea.backends import BaseModelSubclass
-from mellea.backends._utils import to_chat, to_tool_calls, use_alora
+from mellea.backends._utils import StreamingToolCalls, to_chat, use_alora
 from mellea.backends.aloras import Alora, AloraBackendMixin
-from mellea.backends.cache import Cache, SimpleLRUCache
+from mellea.backends.cache import Cache, SimpleLRUCache, TokenPrefixCache
 from mellea.backends.formatter import Formatter, FormatterBackend, TemplateFormatter
+from mellea.backends.guide_cache import get_guide_cache
 from mellea.backends.model_ids import ModelIdentifier
 from mellea.backends.process_reward_models import PRM
 from mellea.backends.tools import (
+    add_tools_from_context,
     add_tools_from_context_actions,
     add_tools_from_model_options,
     convert_tools_to_json,
 )
 from mellea.backends.types import ModelOption
-from mellea.helpers.async_helpers import send_to_queue
+from mellea.helpers.async_helpers import get_item, send_to_queue
 from mellea.helpers.fancy_logger import FancyLogger
 from mellea.stdlib.base import (
     CBlock,
@@ -80,6 +85,37 @@ class HFAloraCacheInfo:
     q_end: int = -1
 
 
+@dataclasses.dataclass
+class HFTopLogprobs:
+    """The log probabilities kept for a generation when `ModelOption.LOGPROBS` is set. Every array has one row per generated token.
+
+    They are the model's own distribution, computed from the raw logits: temperature, top-k/top-p, repetition penalties and constrained decoding change which token is sampled, but not these values.
+    """
+
+    token_ids: np.ndarray
+    """The ids of the k most likely tokens at each step, most likely first. Shape (steps, k)."""
+
+    logprobs: np.ndarray
+    """The log probabilities of `token_ids`. Shape (steps, k)."""
+
+    sampled_logprobs: np.ndarray
+    """The log probability of the token that was actually generated at each step. Shape (steps,)."""
+
+    @classmethod
+    def from_logits(
+        cls, logits: tuple[torch.Tensor, ...], generated_ids: torch.Tensor, k: int
+    ) -> HFTopLogprobs:
+        """Computes the top-k log probabilities from the (batch size 1) raw logits returned by `generate(..., output_logits=True)`."""
+        logprobs = torch.log_softmax(torch.cat(logits).float(), dim=-1)
+        top = torch.topk(logprobs, k=min(k, logprobs.shape[-1]), dim=-1)
+        sampled = logprobs.gather(-1, generated_ids[: logprobs.shape[0], None])
+        return cls(
+            token_ids=top.indices.cpu().numpy().astype(np.int32),
+            logprobs=top.values.cpu().numpy(),
+            sampled_logprobs=sampled[:, 0].cpu().numpy(),
+        )
+
+
 class LocalHFBackend(FormatterBackend, AloraBackendMixin):
     """The LocalHFBackend uses Huggingface's transformers library for inference, and uses a Formatter to convert `Component`s into prompts. This backend also supports Activated LoRAs (ALoras)](https://arxiv.org/pdf/2504.12397).
 
@@ -95,9 +131,12 @@ class LocalHFBackend(FormatterBackend, AloraBackendMixin):
         *,
         use_caches: bool = True,
         cache: Cache | None = None,
+        prefix_cache: TokenPrefixCache | None = None,
         custom_config: TransformersTorchConfig | None = None,
         default_to_constraint_checking_alora: bool = True,
         model_options: dict | None = None,
+        max_batch_size: int = 1,
+        max_batch_wait: float = 0.01,
     ):
         """Attempt to load model weights using the model_id by default, or using `custom_config` if provided.
 
@@ -107,10 +146,13 @@ class LocalHFBackend(FormatterBackend, AloraBackendMixin):
             model_id (str | ModelIdentifier): Used to load the model *and tokenizer* via transformers Auto* classes, and then moves the model to the best available device (cuda > mps > cpu). If loading the model and/or tokenizer from a string will not work, or if you want to use a different device string, then you can use custom_config.
             formatter (Formatter): A mechanism for turning `stdlib` stuff into strings. Experimental Span-based models should use `mellea.backends.span.*` backends.
             use_caches (bool): If set to False, then caching will not be used even if a Cache is provided.
-            cache (Optional[Cache]): The caching strategy to use. If None, `LRUCache(3)` will be used.
+            cache (Optional[Cache]): The caching strategy to use. If None, `LRUCache(3)` will be used. Use a `ByteSizeLRUCache` to bound the cache by the memory used by kv caches instead of by the number of entries, or a `TieredKVCache` to offload evicted kv caches to CPU memory and disk.
+            prefix_cache (Optional[TokenPrefixCache]): If set, the kv caches of previous generations are stored here, and new requests only prefill the tokens after the longest cached prefix of their prompt. Useful for multi-turn conversations and repair loops.
             custom_config (Optional[TransformersTorchConfig]): Overrides loading from the `model_id`. If set, then the specified tokenizer/model/device will be used instead of auto-loading from the model_id.
             default_to_constraint_checking_alora: If set to False then aloras will be deactivated. This is primarily for performance benchmarking and debugging.
             model_options (Optional[dict]): Default model options.
+            max_batch_size (int): If greater than 1, concurrent generation requests with the same generation options are collected and run as a single batched `generate` call of up to this many requests.
+            max_batch_wait (float): The number of seconds to wait for additional requests before running a batch that isn't full. Only used if `max_batch_size` is greater than 1.
         """
         formatter = (
             formatter if formatter is not None else TemplateFormatter(model_id=model_id)
@@ -168,6 +210,22 @@ class LocalHFBackend(FormatterBackend, AloraBackendMixin):
 
         self._use_caches = use_caches
         self._cache = cache if cache is not None else SimpleLRUCache(3)
+        self._prefix_cache = prefix_cache
+
+        # Created on first use of structured outputs. Reusing the same object lets compiled guides be cached.
+        self._outlines_tokenizer: Any = None
+
+        # Used to batch concurrent generation requests together.
+        self._batch_scheduler: HFBatchScheduler | None = (
+            HFBatchScheduler(
+                self._model,
+                self._tokenizer,
+                max_batch_size=max_batch_size,
+                max_wait=max_batch_wait,
+            )
+            if max_batch_size > 1
+            else None
+        )
 
         # Used when running aLoRAs with this backend.
         self._alora_model: "aLoRAPeftModelForCausalLM | None" = None  # noqa: UP037
@@ -214,9 +272,52 @@ class LocalHFBackend(FormatterBackend, AloraBackendMixin):
                 _format=format,
                 model_options=model_opts,
                 tool_calls=tool_calls,
-            )
+            )[0]
             return mot, ctx.add(action).add(mot)
 
+    def generate_n_from_context(
+        self,
+        action: Component | CBlock,
+        ctx: Context,
+        *,
+        n: int,
+        format: type[BaseModelSubclass] | None = None,
+        model_options: dict | None = None,
+        tool_calls: bool = False,
+    ) -> list[tuple[ModelOutputThunk, Context]]:
+        """Generates `n` samples with a single `generate` call that shares the prefill of the prompt.
+
+        Streaming requests and requests that are answered by an alora fall back to `n` separate generations.
+        """
+        model_opts = self._simplify_and_merge(model_options)
+        if (
+            n == 1
+            or model_opts.get(ModelOption.STREAM, False)
+            or use_alora(
+                action,
+                self.get_alora("constraint"),
+                self.default_to_constraint_checking_alora,
+            )
+        ):
+            return super().generate_n_from_context(
+                action,
+                ctx,
+                n=n,
+                format=format,
+                model_options=model_options,
+                tool_calls=tool_calls,
+            )
+
+        mots = self._generate_from_context_standard(
+            action,
+            ctx,
+            _format=format,
+            model_options=model_opts,
+            tool_calls=tool_calls,
+            n=n,
+        )
+        return [(mot, ctx.add(action).add(mot)) for mot in mots]
+
     def _generate_from_context_alora(
         self,
         action: Component | CBlock,
@@ -272,7 +373,11 @@ class LocalHFBackend(FormatterBackend, AloraBackendMixin):
         _format: type[BaseModelSubclass] | None = None,
         model_options: dict[str, Any],
         tool_calls: bool = False,
-    ) -> ModelOutputThunk:
+        n: int = 1,
+    ) -> list[ModelOutputThunk]:
+        """Generates `n` ModelOutputThunks for the action. Streaming is only supported for a single sample."""
+        assert n == 1 or not model_options.get(ModelOption.STREAM, False)
+
         # Construct input.
         # If the Context is a ChatHistory then we will pretty-print each content as a message and then use apply_chat_template.
         # Otherwise, we will linearize the context and treat it as a raw input.
@@ -289,9 +394,7 @@ class LocalHFBackend(FormatterBackend, AloraBackendMixin):
                     )
                 else:
                     add_tools_from_model_options(tools, model_options)
-                    add_tools_from_context_actions(
-                        tools, ctx.actions_for_available_tools()
-                    )
+                    add_tools_from_context(tools, ctx)
 
                     # Add the tools from the action for this generation last so that
                     # they overwrite conflicting names.
@@ -302,32 +405,36 @@ class LocalHFBackend(FormatterBackend, AloraBackendMixin):
             if seed is not None:
                 set_seed(seed)
 
-            input_ids = self._tokenizer.apply_chat_template(  # type: ignore
+            # Logits are only needed to compute logprobs; they are one vocabulary-sized tensor per generated token.
+            top_logprobs = model_options.get(ModelOption.LOGPROBS, None)
+
+            tokenized = self._tokenizer.apply_chat_template(  # type: ignore
                 ctx_as_chat,
                 tools=convert_tools_to_json(tools),  # type: ignore
                 add_generation_prompt=True,  # If we change this, must modify huggingface granite guardian.
                 return_tensors="pt",
                 **self._make_backend_specific_and_remove(model_options),
             ).to(self._device)  # type: ignore
+            # The ids are returned in a `BatchEncoding` if the chat template options ask for a dict.
+            input_ids = (
+                tokenized["input_ids"]
+                if isinstance(tokenized, BatchEncoding)
+                else tokenized
+            )
+            assert isinstance(input_ids, torch.Tensor)
 
             format_kwargs = {}
             if _format:
                 # outlines.generate.json always parses the resulting json into a python dict.
                 # We however want to keep it as a json string for later storing it in ModelOutputThunk
                 schema: dict[str, Any] = _format.model_json_schema()
-                schema_json: str = json.dumps(schema)
-                regex_str: str = outlines_core.fsm.json_schema.build_regex_from_schema(  # type: ignore
-                    schema_json
-                )
 
-                from outlines.models.transformers import TransformerTokenizer
-                from outlines.processors.structured import RegexLogitsProcessor
                 from transformers import LogitsProcessorList
 
                 format_kwargs["logits_processor"] = LogitsProcessorList(
                     [
-                        RegexLogitsProcessor(
-                            regex_str, tokenizer=TransformerTokenizer(self._tokenizer)
+                        get_guide_cache().logits_processor(
+                            schema, self._get_outlines_tokenizer()
                         )
                     ]
                 )
@@ -357,65 +464,165 @@ class LocalHFBackend(FormatterBackend, AloraBackendMixin):
             # Filter out chat template-only options before passing to generate()
             generate_options = self._filter_chat_template_only_options(model_options)
 
-            chat_response = asyncio.to_thread(
-                self._model.generate,  # type: ignore
-                input_ids,
-                return_dict_in_generate=True,
-                output_scores=True,
-                **self._make_backend_specific_and_remove(generate_options),
-                **streaming_kwargs,  # type: ignore
-                **format_kwargs,  # type: ignore
-            )
-
-            output = ModelOutputThunk(None)
-            output._context = ctx.view_for_generation()
-            output._action = action
-            output._model_options = model_options
-
-            # Processing functions only pass the ModelOutputThunk (and current chunk of response). Bind the other vars necessary for
-            # each processing step.
-            output._process = functools.partial(self.processing, input_ids=input_ids)
-            output._post_process = functools.partial(
-                self.post_processing,
-                conversation=ctx_as_chat,
-                input_ids=input_ids,
-                _format=_format,
-                tool_calls=tool_calls,
-                tools=tools,
-                seed=seed,
-            )
+            # Reuse the kv cache of the longest previously computed prefix of this prompt.
+            prefix_kwargs = {}
+            if self._use_caches and self._prefix_cache is not None:
+                # At least one token must be left to prefill.
+                prefix_length, prefix_kv = self._prefix_cache.get_longest_prefix(
+                    input_ids[0].tolist(), max_length=input_ids.shape[1] - 1
+                )
+                if prefix_kv is not None:
+                    prefix_kwargs["past_key_values"] = branch_kv_cache(
+                        prefix_kv, prefix_length
+                    )
 
-            try:
-                # To support lazy computation, will need to remove this create_task and store just the unexecuted coroutine.
-                # We can also support synchronous calls by adding a flag and changing this ._generate function.
+            chat_response: Coroutine
+            if n > 1:
+                # The samples share the prompt, so it is prefilled once and every sample branches off its kv cache.
+                chat_response = asyncio.to_thread(
+                    self._generate_n,
+                    input_ids,
+                    n,
+                    prefix_kv=prefix_kwargs.get("past_key_values", None),
+                    output_logits=top_logprobs is not None,
+                    **self._make_backend_specific_and_remove(generate_options),
+                    **format_kwargs,  # type: ignore
+                )
+            elif (
+                self._batch_scheduler is not None
+                and _format is None
+                and seed is None
+                and len(prefix_kwargs) == 0
+            ):
+                # Structured outputs, seeded requests and requests with a cached prefix can't share a batch with other requests.
+                chat_response = self._batch_scheduler.generate(
+                    input_ids,
+                    streamer=streamer,
+                    output_logits=top_logprobs is not None,
+                    **self._make_backend_specific_and_remove(generate_options),
+                )
+            else:
+                chat_response = asyncio.to_thread(
+                    self._model.generate,  # type: ignore
+                    input_ids,
+                    return_dict_in_generate=True,
+                    output_logits=top_logprobs is not None,
+                    **self._make_backend_specific_and_remove(generate_options),
+                    **streaming_kwargs,  # type: ignore
+                    **format_kwargs,  # type: ignore
+                    **prefix_kwargs,  # type: ignore
+                )
 
-                response: AsyncTextIteratorStreamer | Coroutine = chat_response
-                if stream and streamer is not None:
-                    # For streaming, we want to pass the AsyncIterator to the function. Unlike other backends,
-                    # this isn't returned by the chat_response coroutine. So we handle it here.
-                    response = streamer
+            responses: list[Coroutine] = [chat_response]
+            if n > 1:
+                # Each ModelOutputThunk awaits its own row of the shared generate call.
+                samples = asyncio.create_task(chat_response)
+                responses = [get_item(samples, i) for i in range(n)]
+
+            outputs = []
+            for sample_response in responses:
+                output = ModelOutputThunk(None)
+                output._context = ctx.view_for_generation()
+                output._action = action
+                output._model_options = model_options
+
+                # Processing functions only pass the ModelOutputThunk (and current chunk of response). Bind the other vars necessary for
+                # each processing step.
+                # Only scan for tools if we are not doing structured output and tool calls were provided to the model.
+                tool_parser = (
+                    StreamingToolCalls(tools)
+                    if _format is None and tool_calls
+                    else None
+                )
+                output._process = functools.partial(
+                    self.processing, input_ids=input_ids, tool_parser=tool_parser
+                )
+                output._post_process = functools.partial(
+                    self.post_processing,
+                    conversation=ctx_as_chat,
+                    input_ids=input_ids,
+                    _format=_format,
+                    tool_parser=tool_parser,
+                    tools=tools,
+                    seed=seed,
+                    top_logprobs=top_logprobs,
+                )
 
-                    # Since the async iterator isn't returned by the chat_response coroutine, we have to create a separate
-                    # task for it here so that it runs in the background. Attach it to the ModelOutputThunk.
-                    output._generate_extra = asyncio.create_task(chat_response)
+                try:
+                    # To support lazy computation, will need to remove this create_task and store just the unexecuted coroutine.
+                    # We can also support synchronous calls by adding a flag and changing this ._generate function.
+
+                    response: AsyncTextIteratorStreamer | Coroutine = sample_response
+                    if stream and streamer is not None:
+                        # For streaming, we want to pass the AsyncIterator to the function. Unlike other backends,
+                        # this isn't returned by the chat_response coroutine. So we handle it here.
+                        response = streamer
+
+                        # Since the async iterator isn't returned by the chat_response coroutine, we have to create a separate
+                        # task for it here so that it runs in the background. Attach it to the ModelOutputThunk.
+                        output._generate_extra = asyncio.create_task(sample_response)
+
+                    # This function should always be called from a running event loop so we don't have to worry about
+                    # scheduling the task to a specific event loop here.
+                    output._generate = asyncio.create_task(
+                        send_to_queue(response, output._async_queue)  # type: ignore
+                    )
+                    output._generate_type = GenerateType.ASYNC
+                except RuntimeError as e:
+                    # Most likely cause is running this function without an event loop present.
+                    raise e
 
-                # This function should always be called from a running event loop so we don't have to worry about
-                # scheduling the task to a specific event loop here.
-                output._generate = asyncio.create_task(
-                    send_to_queue(response, output._async_queue)  # type: ignore
-                )
-                output._generate_type = GenerateType.ASYNC
-            except RuntimeError as e:
-                # Most likely cause is running this function without an event loop present.
-                raise e
+                outputs.append(output)
 
-            return output
+            return outputs
 
         else:
             raise Exception("Does not yet support non-chat contexts.")
 
+    def _generate_n(
+        self,
+        input_ids: torch.Tensor,
+        n: int,
+        *,
+        prefix_kv: DynamicCache | None = None,
+        **generate_kwargs,
+    ) -> list[GenerateDecoderOnlyOutput]:
+        """Prefills the prompt once and then generates `n` sequences that branch off its kv cache."""
+        kv = prefix_kv
+        start = 0 if kv is None else kv.get_seq_length()
+        # The last prompt token is left for `generate` so that it computes the logits of the first generated token.
+        if start < input_ids.shape[1] - 1:
+            with torch.no_grad():
+                kv = self._model(  # type: ignore
+                    input_ids[:, start:-1], past_key_values=kv, use_cache=True
+                ).past_key_values
+
+        prefill_kwargs = {}
+        if kv is not None:
+            prefill_kwargs["past_key_values"] = branch_kv_cache(kv, batch_size=n)
+
+        output = self._model.generate(  # type: ignore
+            input_ids.expand(n, -1),
+            attention_mask=torch.ones(
+                (n, input_ids.shape[1]), dtype=torch.long, device=input_ids.device
+            ),
+            return_dict_in_generate=True,
+            **prefill_kwargs,
+            **generate_kwargs,
+        )
+        return _split_generate_output(
+            output,
+            input_ids.shape[1],
+            [input_ids.shape[1]] * n,
+            _eos_token_ids(self._model, self._tokenizer),
+        )
+
     async def processing(
-        self, mot: ModelOutputThunk, chunk: str | GenerateDecoderOnlyOutput, input_ids
+        self,
+        mot: ModelOutputThunk,
+        chunk: str | GenerateDecoderOnlyOutput,
+        input_ids,
+        tool_parser: StreamingToolCalls | None = None,
     ):
         """Process the returned chunks or the complete response."""
         if mot._underlying_value is None:
@@ -424,23 +631,29 @@ class LocalHFBackend(FormatterBackend, AloraBackendMixin):
         # Because we use the AsyncTextIteratorStreamer, streaming responses are of type str;
         # and already decoded.
         if isinstance(chunk, str):
-            mot._underlying_value += chunk
+            text = chunk
         else:
             # Otherwise, it's a non-streaming request. Decode it here.
             mot._meta["hf_output"] = chunk
-            mot._underlying_value += self._tokenizer.decode(
+            text = self._tokenizer.decode(
                 chunk.sequences[0, input_ids.shape[1] :], skip_special_tokens=True
             )
+        mot._underlying_value += text
+
+        # Tool calls are available as soon as their json is complete, before the rest of the response is generated.
+        if tool_parser is not None and len(tool_parser.feed(text)) > 0:
+            mot.tool_calls = dict(tool_parser.tool_calls)
 
     async def post_processing(
         self,
         mot: ModelOutputThunk,
         conversation: list[dict],
         _format: type[BaseModelSubclass] | None,
-        tool_calls: bool,
+        tool_parser: StreamingToolCalls | None,
         tools: dict[str, Callable],
         seed,
         input_ids,
+        top_logprobs: int | None = None,
     ):
         """Called when generation is done."""
         if mot._meta.get("hf_output", None) is None:
@@ -448,6 +661,8 @@ class LocalHFBackend(FormatterBackend, AloraBackendMixin):
                 full_output = await mot._generate_extra
                 assert isinstance(full_output, GenerateDecoderOnlyOutput)
                 mot._meta["hf_output"] = full_output
+                # The finished task would otherwise keep the full output alive.
+                mot._generate_extra = None
 
         # The ModelOutputThunk must be computed by this point.
         assert mot.value is not None
@@ -466,9 +681,27 @@ class LocalHFBackend(FormatterBackend, AloraBackendMixin):
 
             self.cache_put(mot.value, cache_info)
 
-        # Only scan for tools if we are not doing structured output and tool calls were provided to the model.
-        if _format is None and tool_calls:
-            mot.tool_calls = to_tool_calls(tools, mot.value)
+            if self._prefix_cache is not None and cache is not None:
+                # The kv cache covers every token except the last generated one.
+                self._prefix_cache.put(
+                    output_complete[: cache.get_seq_length()].tolist(), cache
+                )
+
+        hf_output: GenerateDecoderOnlyOutput = mot._meta["hf_output"]
+        if top_logprobs is not None and hf_output.logits is not None:
+            mot._meta["hf_top_logprobs"] = HFTopLogprobs.from_logits(
+                hf_output.logits,  # type: ignore
+                hf_output.sequences[0, input_ids.shape[1] :],
+                top_logprobs,
+            )
+
+        # Only keep the token ids. The logits can be tens of MB, and the kv cache is kept alive by the backend's caches if they are enabled.
+        mot._meta["hf_output"] = GenerateDecoderOnlyOutput(
+            sequences=hf_output.sequences
+        )
+
+        if tool_parser is not None:
+            mot.tool_calls = tool_parser.finish()
 
         assert mot._action is not None, (
             "ModelOutputThunks should have their action assigned during generation"
@@ -523,29 +756,21 @@ class LocalHFBackend(FormatterBackend, AloraBackendMixin):
                 input_ids=inputs["input_ids"],
                 attention_mask=inputs["attention_mask"],
                 return_dict_in_generate=True,
-                output_scores=True,
                 **self._make_backend_specific_and_remove(model_opts),
             )
         else:
             schema: dict[str, Any] = format.model_json_schema()
-            schema_json: str = json.dumps(schema)
-            regex_str: str = outlines_core.fsm.json_schema.build_regex_from_schema(
-                schema_json
-            )
 
-            from outlines.models.transformers import TransformerTokenizer
-            from outlines.processors import RegexLogitsProcessor
             from transformers import LogitsProcessorList
 
             outputs = self._model.generate(  # type: ignore
                 input_ids=inputs["input_ids"],
                 attention_mask=inputs["attention_mask"],
                 return_dict_in_generate=True,
-                output_scores=True,
                 logits_processor=LogitsProcessorList(
                     [
-                        RegexLogitsProcessor(
-                            regex_str, tokenizer=TransformerTokenizer(self._tokenizer)
+                        get_guide_cache().logits_processor(
+                            schema, self._get_outlines_tokenizer()
                         )
                     ]
                 ),
@@ -586,6 +811,14 @@ class LocalHFBackend(FormatterBackend, AloraBackendMixin):
 
         return results
 
+    def _get_outlines_tokenizer(self) -> Any:
+        """Returns the outlines wrapper around this backend's tokenizer."""
+        if self._outlines_tokenizer is None:
+            from outlines.models.transformers import TransformerTokenizer
+
+            self._outlines_tokenizer = TransformerTokenizer(self._tokenizer)
+        return self._outlines_tokenizer
+
     # region cache management
     def cache_get(self, id: str) -> HFAloraCacheInfo | None:
         """Retrieve from cache."""
@@ -710,6 +943,307 @@ class LocalHFBackend(FormatterBackend, AloraBackendMixin):
     # endregion
 
 
+@dataclasses.dataclass
+class _BatchedRequest:
+    """A single generation request waiting to be run as part of a batch."""
+
+    input_ids: torch.Tensor
+    streamer: AsyncTextIteratorStreamer | None
+    future: asyncio.Future
+
+
+@dataclasses.dataclass
+class _PendingBatch:
+    """Requests that share the same generation options and can be run together."""
+
+    generate_kwargs: dict[str, Any]
+    requests: list[_BatchedRequest] = dataclasses.field(default_factory=list)
+
+
+class _BatchStreamer(BaseStreamer):
+    """Splits the output of a batched `generate` call into the streamers of the individual requests."""
+
+    def __init__(
+        self, streamers: list[AsyncTextIteratorStreamer | None], eos_token_ids: set[int]
+    ):
+        self._streamers = streamers
+        self._eos_token_ids = eos_token_ids
+        self._finished = [False] * len(streamers)
+        self._is_prompt = True
+
+    def put(self, value):
+        """Receives the prompt tokens and then the next token of every sequence in the batch."""
+        if self._is_prompt:
+            # The streamers of the individual requests are created with `skip_prompt=True`;
+            # they still need to see the prompt to know that the next tokens are generated.
+            self._is_prompt = False
+            for i, streamer in enumerate(self._streamers):
+                if streamer is not None:
+                    streamer.put(value[i : i + 1])
+            return
+
+        for i, streamer in enumerate(self._streamers):
+            if self._finished[i]:
+                continue
+
+            token = value[i : i + 1]
+            if streamer is not None:
+                streamer.put(token)
+
+            if int(token[0]) in self._eos_token_ids:
+                self._finished[i] = True
+                if streamer is not None:
+                    streamer.end()
+
+    def end(self):
+        """Ends the streams of all requests that haven't finished yet."""
+        for i, streamer in enumerate(self._streamers):
+            if not self._finished[i] and streamer is not None:
+                streamer.end()
+            self._finished[i] = True
+
+
+class HFBatchScheduler:
+    """Collects concurrent generation requests to a huggingface model and runs them as a single batched `generate` call.
+
+    Only requests with identical generation options are batched together. A batch is run as soon as it has `max_batch_size` requests or `max_wait` seconds after its first request arrived. Prompts are left-padded, and the batched output is split back into one `GenerateDecoderOnlyOutput` per request (with the padding removed) so that the rest of the backend can treat it like an unbatched result.
+    """
+
+    def __init__(
+        self,
+        model: PreTrainedModel,
+        tokenizer: PreTrainedTokenizer,
+        *,
+        max_batch_size: int = 8,
+        max_wait: float = 0.01,
+    ):
+        """Initializes a batch scheduler for a model.
+
+        Args:
+            model: the model to generate with.
+            tokenizer: the tokenizer for the model; used for padding.
+            max_batch_size: the maximum number of requests in a single batch.
+            max_wait: the number of seconds to wait for additional requests before running a batch that isn't full.
+        """
+        self._model = model
+        self._tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self._pending: dict[str, _PendingBatch] = {}
+        self._lock = threading.Lock()
+
+        # Counters that are mostly useful for debugging and benchmarking.
+        self.batches_run = 0
+        self.requests_run = 0
+
+    async def generate(
+        self,
+        input_ids: torch.Tensor,
+        *,
+        streamer: AsyncTextIteratorStreamer | None = None,
+        **generate_kwargs,
+    ) -> GenerateDecoderOnlyOutput:
+        """Queues a single (batch size 1) request and returns its output once its batch has been run.
+
+        If a streamer is provided, it must be created with `skip_prompt=True`.
+        """
+        loop = asyncio.get_running_loop()
+        request = _BatchedRequest(
+            input_ids=input_ids[0], streamer=streamer, future=loop.create_future()
+        )
+
+        key = repr(sorted(generate_kwargs.items()))
+        with self._lock:
+            batch = self._pending.get(key, None)
+            if batch is None:
+                batch = _PendingBatch(generate_kwargs)
+                self._pending[key] = batch
+                loop.call_later(self.max_wait, self._dispatch, key, batch)
+            batch.requests.append(request)
+            is_full = len(batch.requests) >= self.max_batch_size
+
+        if is_full:
+            self._dispatch(key, batch)
+
+        return await request.future
+
+    def _dispatch(self, key: str, batch: _PendingBatch):
+        """Runs the batch in a separate thread unless it has already been dispatched."""
+        with self._lock:
+            if self._pending.get(key, None) is not batch:
+                return
+            del self._pending[key]
+
+        asyncio.get_running_loop().run_in_executor(None, self._run, batch)
+
+    def _run(self, batch: _PendingBatch):
+        """Runs the batch and routes the outputs back to the requests' event loops."""
+        try:
+            outputs = self._generate(batch)
+        except Exception as e:
+            for request in batch.requests:
+                if request.streamer is not None:
+                    request.streamer.end()
+                request.future.get_loop().call_soon_threadsafe(
+                    _set_future_exception, request.future, e
+                )
+            return
+
+        for request, output in zip(batch.requests, outputs):
+            request.future.get_loop().call_soon_threadsafe(
+                _set_future_result, request.future, output
+            )
+
+    def _generate(self, batch: _PendingBatch) -> list[GenerateDecoderOnlyOutput]:
+        requests = batch.requests
+        self.batches_run += 1
+        self.requests_run += len(requests)
+
+        pad_token_id = self._tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = self._tokenizer.eos_token_id
+
+        # Left-pad all prompts to the same length.
+        lengths = [len(r.input_ids) for r in requests]
+        max_len = max(lengths)
+        first_ids = requests[0].input_ids
+        input_ids = torch.full(
+            (len(requests), max_len),
+            pad_token_id,
+            dtype=first_ids.dtype,
+            device=first_ids.device,
+        )
+        attention_mask = torch.zeros(
+            (len(requests), max_len), dtype=torch.long, device=first_ids.device
+        )
+        for i, request in enumerate(requests):
+            input_ids[i, max_len - lengths[i] :] = request.input_ids
+            attention_mask[i, max_len - lengths[i] :] = 1
+
+        eos_token_ids = _eos_token_ids(self._model, self._tokenizer)
+        streaming_kwargs = {}
+        if any(r.streamer is not None for r in requests):
+            streaming_kwargs["streamer"] = _BatchStreamer(
+                [r.streamer for r in requests], eos_token_ids
+            )
+
+        generate_kwargs = {"pad_token_id": pad_token_id, **batch.generate_kwargs}
+        output = self._model.generate(  # type: ignore
+            input_ids,
+            attention_mask=attention_mask,
+            return_dict_in_generate=True,
+            **streaming_kwargs,
+            **generate_kwargs,
+        )
+
+        return _split_generate_output(output, max_len, lengths, eos_token_ids)
+
+
+def _eos_token_ids(model: PreTrainedModel, tokenizer: PreTrainedTokenizer) -> set[int]:
+    config = model.generation_config
+    eos = config.eos_token_id if config is not None else None
+    eos_ids = set(eos if isinstance(eos, list) else [eos] if eos is not None else [])
+    if tokenizer.eos_token_id is not None:
+        eos_ids.add(tokenizer.eos_token_id)
+    return eos_ids
+
+
+def _split_generate_output(
+    output: GenerateDecoderOnlyOutput,
+    max_len: int,
+    lengths: list[int],
+    eos_token_ids: set[int],
+) -> list[GenerateDecoderOnlyOutput]:
+    """Splits the output of a batched `generate` call into one output per row.
+
+    The prompts must have been left-padded to `max_len`; `lengths` are their unpadded lengths.
+    """
+    legacy_cache = None
+    if isinstance(output.past_key_values, DynamicCache):
+        legacy_cache = output.past_key_values.to_legacy_cache()
+
+    outputs = []
+    for i in range(len(lengths)):
+        # Strip the left padding and anything generated after this sequence finished.
+        generated = output.sequences[i, max_len:].tolist()
+        n_generated = len(generated)
+        for j, token in enumerate(generated):
+            if token in eos_token_ids:
+                n_generated = j + 1
+                break
+        start, end = max_len - lengths[i], max_len + n_generated
+
+        row_cache = None
+        if legacy_cache is not None:
+            # The kv cache never contains the last generated token.
+            row_cache = DynamicCache.from_legacy_cache(
+                # transformers annotates the legacy cache as a tuple of exactly one layer.
+                cast(
+                    Any,
+                    tuple(
+                        (
+                            k[i : i + 1, :, start : end - 1],
+                            v[i : i + 1, :, start : end - 1],
+                        )
+                        for k, v in legacy_cache
+                    ),
+                )
+            )
+
+        outputs.append(
+            GenerateDecoderOnlyOutput(
+                sequences=cast(
+                    torch.LongTensor, output.sequences[i : i + 1, start:end]
+                ),
+                scores=None
+                if output.scores is None
+                else tuple(s[i : i + 1] for s in output.scores[:n_generated]),  # type: ignore
+                logits=None
+                if output.logits is None
+                else tuple(s[i : i + 1] for s in output.logits[:n_generated]),  # type: ignore
+                past_key_values=row_cache,  # type: ignore
+            )
+        )
+    return outputs
+
+
+def branch_kv_cache(
+    cache: DynamicCache, length: int | None = None, batch_size: int = 1
+) -> DynamicCache:
+    """Returns a new kv cache that starts with the first `length` positions of `cache`, repeated `batch_size` times, without copying them.
+
+    The new cache holds views of the tensors in `cache`. Generating with it never modifies `cache` because `DynamicCache` concatenates new keys and values into fresh tensors instead of writing into existing ones. This lets any number of requests branch off a shared prefix (copy-on-write) instead of each deep-copying it.
+    """
+    legacy = tuple(
+        (
+            k[:, :, :length].expand(batch_size, -1, -1, -1),
+            v[:, :, :length].expand(batch_size, -1, -1, -1),
+        )
+        for k, v in cache.to_legacy_cache()
+    )
+    branch = DynamicCache.from_legacy_cache(
+        tuple((k[:, :, :0], v[:, :, :0]) for k, v in legacy)  # type: ignore
+    )
+    if hasattr(branch, "layers"):
+        # Newer versions of transformers copy tensors when filling a cache, so the views are set on the layers directly.
+        for layer, (k, v) in zip(branch.layers, legacy):
+            layer.keys, layer.values = k, v  # type: ignore
+    else:
+        branch = DynamicCache.from_legacy_cache(legacy)  # type: ignore
+    return branch
+
+
+def _set_future_result(future: asyncio.Future, result: Any):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_future_exception(future: asyncio.Future, e: Exception):
+    if not future.done():
+        future.set_exception(e)
+
+
 class HFAlora(Alora, abc.ABC):
     """ALoras that work with the local huggingface backend."""
 
@@ -17,6 +17,7 @@ from mellea.backends import BaseModelSubclass
 from mellea.backends.formatter import Formatter, FormatterBackend, TemplateFormatter
 from mellea.backends.openai import OpenAIBackend
 from mellea.backends.tools import (
+    add_tools_from_context,
     add_tools_from_context_actions,
     add_tools_from_model_options,
     convert_tools_to_json,
@@ -467,7 +468,7 @@ class LiteLLMBackend(FormatterBackend):
                 )
             else:
                 add_tools_from_model_options(tools, model_opts)
-                add_tools_from_context_actions(tools, ctx.actions_for_available_tools())
+                add_tools_from_context(tools, ctx)
 
                 # Add the tools from the action for this generation last so that
                 # they overwrite conflicting names.
@@ -14,6 +14,7 @@ from mellea.backends import BaseModelSubclass
 from mellea.backends.formatter import Formatter, FormatterBackend, TemplateFormatter
 from mellea.backends.model_ids import ModelIdentifier
 from mellea.backends.tools import (
+    add_tools_from_context,
     add_tools_from_context_actions,
     add_tools_from_model_options,
 )
@@ -334,7 +335,7 @@ class OllamaModelBackend(FormatterBackend):
                 )
             else:
                 add_tools_from_model_options(tools, model_opts)
-                add_tools_from_context_actions(tools, ctx.actions_for_available_tools())
+                add_tools_from_context(tools, ctx)
 
                 # Add the tools from the action for this generation last so that
                 # they overwrite conflicting names.
@@ -6,7 +6,7 @@ import datetime
 import functools
 import inspect
 import json
-from collections.abc import Callable, Coroutine
+from collections.abc import Awaitable, Callable, Coroutine
 from enum import Enum
 from typing import TYPE_CHECKING, Any
 from urllib.parse import urlparse
@@ -24,6 +24,7 @@ from mellea.backends.aloras import Alora, AloraBackendMixin
 from mellea.backends.formatter import Formatter, FormatterBackend, TemplateFormatter
 from mellea.backends.model_ids import ModelIdentifier
 from mellea.backends.tools import (
+    add_tools_from_context,
     add_tools_from_context_actions,
     add_tools_from_model_options,
     convert_tools_to_json,
@@ -76,6 +77,13 @@ def _server_type(url: str) -> _ServerType | None:
     return None
 
 
+async def _get_choice(completion: Awaitable[ChatCompletion], i: int) -> ChatCompletion:
+    """Returns a copy of the completion that only holds its `i`-th choice."""
+    response = await completion
+    choice = next(c for c in response.choices if c.index == i)
+    return response.model_copy(update={"choices": [choice]})
+
+
 class OpenAIBackend(FormatterBackend, AloraBackendMixin):
     """A generic OpenAI compatible backend."""
 
@@ -322,20 +330,10 @@ class OpenAIBackend(FormatterBackend, AloraBackendMixin):
         tool_calls: bool = False,
     ) -> ModelOutputThunk:
         """Generates a new completion from the provided Context using this backend's `Formatter`."""
-        if issubclass(type(action), Requirement):
-            # The general rule is that we reroute to the alora if it exists.
-            reroute_to_alora = self.get_alora("constraint") is not None
-            # However, there are some exceptions:
-            if not self.default_to_constraint_checking_alora:
-                reroute_to_alora = False
-            if issubclass(type(action), LLMaJRequirement):
-                reroute_to_alora = False
-            if issubclass(type(action), ALoraRequirement):
-                reroute_to_alora = True
-            if reroute_to_alora:
-                return self._generate_from_chat_context_alora(
-                    action, ctx, _format=_format, model_options=model_options
-                )
+        if self._reroutes_to_alora(action):
+            return self._generate_from_chat_context_alora(
+                action, ctx, _format=_format, model_options=model_options
+            )
 
         return self._generate_from_chat_context_standard(
             action,
@@ -343,7 +341,65 @@ class OpenAIBackend(FormatterBackend, AloraBackendMixin):
             _format=_format,
             model_options=model_options,
             tool_calls=tool_calls,
+        )[0]
+
+    def generate_n_from_context(
+        self,
+        action: Component | CBlock,
+        ctx: Context,
+        *,
+        n: int,
+        format: type[BaseModelSubclass] | None = None,
+        model_options: dict | None = None,
+        tool_calls: bool = False,
+    ) -> list[tuple[ModelOutputThunk, Context]]:
+        """Generates `n` samples with a single chat completions request that sets `n`.
+
+        Streaming requests and requests that are rerouted to an alora fall back to `n` separate requests.
+        """
+        assert ctx.is_chat_context, NotImplementedError(
+            "The Openai backend only supports chat-like contexts."
+        )
+        model_opts = self._simplify_and_merge(model_options, is_chat_context=True)
+        if (
+            n == 1
+            or model_opts.get(ModelOption.STREAM, False)
+            or self._reroutes_to_alora(action)
+        ):
+            return super().generate_n_from_context(
+                action,
+                ctx,
+                n=n,
+                format=format,
+                model_options=model_options,
+                tool_calls=tool_calls,
+            )
+
+        mots = self._generate_from_chat_context_standard(
+            action,
+            ctx,
+            _format=format,
+            model_options=model_options,
+            tool_calls=tool_calls,
+            n=n,
         )
+        return [(mot, ctx.add(action).add(mot)) for mot in mots]
+
+    def _reroutes_to_alora(self, action: Component | CBlock) -> bool:
+        """Returns whether the action is a requirement that is checked by the constraint alora instead of the model."""
+        if not issubclass(type(action), Requirement):
+            return False
+
+        # The general rule is that we reroute to the alora if it exists.
+        reroute_to_alora = self.get_alora("constraint") is not None
+        # However, there are some exceptions:
+        if not self.default_to_constraint_checking_alora:
+            reroute_to_alora = False
+        if issubclass(type(action), LLMaJRequirement):
+            reroute_to_alora = False
+        if issubclass(type(action), ALoraRequirement):
+            reroute_to_alora = True
+        return reroute_to_alora
 
     def _generate_from_chat_context_alora(
         self,
@@ -440,10 +496,13 @@ class OpenAIBackend(FormatterBackend, AloraBackendMixin):
         | None = None,  # Type[BaseModelSubclass] is a class object of a subclass of BaseModel
         model_options: dict | None = None,
         tool_calls: bool = False,
-    ) -> ModelOutputThunk:
+        n: int = 1,
+    ) -> list[ModelOutputThunk]:
+        """Generates `n` ModelOutputThunks for the action. Streaming is only supported for a single sample."""
         model_opts = self._simplify_and_merge(
             model_options, is_chat_context=ctx.is_chat_context
         )
+        assert n == 1 or not model_opts.get(ModelOption.STREAM, False)
         linearized_context = ctx.view_for_generation()
         assert linearized_context is not None, (
             "Cannot generate from a non-linear context in a FormatterBackend."
@@ -486,7 +545,7 @@ class OpenAIBackend(FormatterBackend, AloraBackendMixin):
                 )
             else:
                 add_tools_from_model_options(tools, model_opts)
-                add_tools_from_context_actions(tools, ctx.actions_for_available_tools())
+                add_tools_from_context(tools, ctx)
 
                 # Add the tools from the action for this generation last so that
                 # they overwrite conflicting names.
@@ -501,6 +560,9 @@ class OpenAIBackend(FormatterBackend, AloraBackendMixin):
         formatted_tools = convert_tools_to_json(tools)
         use_tools = len(formatted_tools) > 0
 
+        # Only ask for several choices when needed; not every openai-compatible server supports `n`.
+        n_kwargs = {} if n == 1 else {"n": n}
+
         chat_response: Coroutine[
             Any, Any, ChatCompletion | openai.AsyncStream[ChatCompletionChunk]
         ] = self._async_client.chat.completions.create(
@@ -513,40 +575,51 @@ class OpenAIBackend(FormatterBackend, AloraBackendMixin):
             **self._make_backend_specific_and_remove(
                 model_opts, is_chat_context=ctx.is_chat_context
             ),
+            **n_kwargs,
         )  # type: ignore
 
-        output = ModelOutputThunk(None)
-        output._context = linearized_context
-        output._action = action
-        output._model_options = model_opts
-
-        # Processing functions only pass the ModelOutputThunk (and current chunk of response). Bind the other vars necessary for
-        # each processing step.
-        output._process = self.processing
-        output._post_process = functools.partial(
-            self.post_processing,
-            tools=tools,
-            conversation=conversation,
-            thinking=thinking,
-            seed=model_opts.get(ModelOption.SEED, None),
-            _format=_format,
-        )
+        responses: list[Coroutine] = [chat_response]
+        if n > 1:
+            # Each ModelOutputThunk awaits its own choice of the shared response.
+            completion = asyncio.create_task(chat_response)
+            responses = [_get_choice(completion, i) for i in range(n)]  # type: ignore
+
+        outputs = []
+        for response in responses:
+            output = ModelOutputThunk(None)
+            output._context = linearized_context
+            output._action = action
+            output._model_options = model_opts
+
+            # Processing functions only pass the ModelOutputThunk (and current chunk of response). Bind the other vars necessary for
+            # each processing step.
+            output._process = self.processing
+            output._post_process = functools.partial(
+                self.post_processing,
+                tools=tools,
+                conversation=conversation,
+                thinking=thinking,
+                seed=model_opts.get(ModelOption.SEED, None),
+                _format=_format,
+            )
 
-        try:
-            # To support lazy computation, will need to remove this create_task and store just the unexecuted coroutine.
-            # We can also support synchronous calls by adding a flag and changing this ._generate function.
+            try:
+                # To support lazy computation, will need to remove this create_task and store just the unexecuted coroutine.
+                # We can also support synchronous calls by adding a flag and changing this ._generate function.
 
-            # This function should always be called from a running event loop so we don't have to worry about
-            # scheduling the task to a specific event loop here.
-            output._generate = asyncio.create_task(
-                send_to_queue(chat_response, output._async_queue)
-            )
-            output._generate_type = GenerateType.ASYNC
-        except RuntimeError as e:
-            # Most likely cause is running this function without an event loop present
-            raise e
+                # This function should always be called from a running event loop so we don't have to worry about
+                # scheduling the task to a specific event loop here.
+                output._generate = asyncio.create_task(
+                    send_to_queue(response, output._async_queue)
+                )
+                output._generate_type = GenerateType.ASYNC
+            except RuntimeError as e:
+                # Most likely cause is running this function without an event loop present
+                raise e
+
+            outputs.append(output)
 
-        return output
+        return outputs
 
     async def processing(
         self, mot: ModelOutputThunk, chunk: ChatCompletion | ChatCompletionChunk
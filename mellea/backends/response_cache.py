@@ -0,0 +1,241 @@
+"""A backend wrapper that caches completed model responses.
+
+Identical requests (same model, rendered conversation, model options, format and tools) are answered from the cache instead of calling the model again. The cache has an in-memory LRU tier and an optional persistent tier (e.g., a `SqliteCache`) that can be shared across processes. Like the `CoalescingBackend` it is built on, identical requests that are in flight at the same time are coalesced into a single backend call.
+"""
+
+from __future__ import annotations
+
+import datetime
+import importlib
+import json
+import time
+from collections.abc import Callable
+from typing import Any
+
+import pydantic
+
+from mellea.backends import Backend
+from mellea.backends.cache import Cache, SimpleLRUCache
+from mellea.backends.coalescing import CoalescingBackend
+from mellea.helpers.fancy_logger import FancyLogger
+from mellea.stdlib.base import (
+    CBlock,
+    Component,
+    GenerateLog,
+    ModelOutputThunk,
+    ModelToolCall,
+)
+
+
+class CachingBackend(CoalescingBackend):
+    """Wraps a backend and answers repeated requests from a response cache.
+
+    Requests are keyed like in `CoalescingBackend`. A cache hit returns an already computed `ModelOutputThunk` with the value, thinking, tool calls and the json-serializable part of `_meta` of the original response; the response is parsed again with the formatter, so `parsed_repr` is the same as for the original response.
+
+    Identical requests that arrive while the first one is still being generated are coalesced (see `CoalescingBackend`); `coalesced` counts them.
+
+    By default, only deterministic requests (temperature 0 or a fixed seed) are cached, since caching sampled responses would change the behavior of sampling strategies. Requests that are not cached are passed through to the wrapped backend unchanged.
+    """
+
+    def __init__(
+        self,
+        backend: Backend,
+        *,
+        capacity: int = 1024,
+        persistent_cache: Cache | None = None,
+        ttl: float | None = None,
+        only_deterministic: bool = True,
+    ):
+        """Wraps `backend` with a response cache.
+
+        Args:
+            backend: the backend to wrap.
+            capacity: the number of responses to keep in memory. If 0, completed responses are only kept in the persistent cache (if there is one); identical in-flight requests are still coalesced.
+            persistent_cache: an optional second tier that stores responses as json strings, e.g., a `SqliteCache` shared by several worker processes.
+            ttl: if set, responses older than this many seconds are treated as missing.
+            only_deterministic: if True, only requests with a temperature of 0 or a seed are cached.
+        """
+        super().__init__(backend, only_deterministic=only_deterministic)
+        self.ttl = ttl
+
+        self._memory_cache = SimpleLRUCache(capacity)
+        self._persistent_cache = persistent_cache
+
+        self.hits: dict[str, int] = {"memory": 0, "persistent": 0}
+        self.misses = 0
+
+    def current_size(self) -> int:
+        """Returns the number of responses in the in-memory cache."""
+        return self._memory_cache.current_size()
+
+    def _lookup(
+        self,
+        key: str,
+        action: Component | CBlock,
+        linearized_ctx: list[Component | CBlock],
+        model_options: dict[str, Any],
+        tools: dict[str, Callable],
+    ) -> ModelOutputThunk | None:
+        """Returns the cached response for the request, if there is one."""
+        found = self._get(key)
+        if found is not None:
+            entry, tier = found
+            mot = self._to_model_output_thunk(
+                entry, action, linearized_ctx, model_options, tools
+            )
+            if mot is not None:
+                self.hits[tier] += 1
+                return mot
+        if key not in self._in_flight:
+            self.misses += 1
+        return None
+
+    def _completed(self, key: str, mot: ModelOutputThunk):
+        self._put(key, mot)
+
+    def _get(self, key: str) -> tuple[dict[str, Any], str] | None:
+        """Looks up an entry in memory first and then in the persistent cache. Returns the entry and the tier it was found in."""
+        entry = self._memory_cache.get(key)
+        tier = "memory"
+        if entry is None and self._persistent_cache is not None:
+            serialized = self._persistent_cache.get(key)
+            if serialized is not None:
+                entry = json.loads(serialized)
+                tier = "persistent"
+
+        if entry is None:
+            return None
+        if self.ttl is not None and time.time() - entry["created"] > self.ttl:
+            return None
+
+        if tier == "persistent" and self._memory_cache.capacity > 0:
+            self._memory_cache.put(key, entry)
+        return entry, tier
+
+    def _put(self, key: str, mot: ModelOutputThunk):
+        entry = {
+            "created": time.time(),
+            "value": mot.value,
+            "thinking": mot._thinking,
+            "tool_calls": None
+            if mot.tool_calls is None
+            else {name: dict(call.args) for name, call in mot.tool_calls.items()},
+            "meta": _encode_meta(mot._meta),
+            "backend": None if mot._generate_log is None else mot._generate_log.backend,
+        }
+        if self._memory_cache.capacity > 0:
+            self._memory_cache.put(key, entry)
+        if self._persistent_cache is not None:
+            try:
+                self._persistent_cache.put(key, json.dumps(entry))
+            except (TypeError, ValueError) as e:
+                # Tool call arguments are the only values that might not be json-serializable.
+                FancyLogger.get_logger().warning(
+                    f"Could not store a response in the persistent cache: {e}"
+                )
+
+    def _to_model_output_thunk(
+        self,
+        entry: dict[str, Any],
+        action: Component | CBlock,
+        linearized_ctx: list[Component | CBlock],
+        model_options: dict[str, Any],
+        tools: dict[str, Callable],
+    ) -> ModelOutputThunk | None:
+        """Rebuilds a computed ModelOutputThunk from a cache entry. Returns `None` if a cached tool call refers to a tool that is no longer available or the entry's `_meta` can't be restored; the request is then generated again."""
+        tool_calls = None
+        if entry["tool_calls"] is not None:
+            tool_calls = {}
+            for name, args in entry["tool_calls"].items():
+                if name not in tools:
+                    return None
+                tool_calls[name] = ModelToolCall(name, tools[name], args)
+
+        try:
+            meta = _decode_meta(entry["meta"])
+        except ValueError as e:
+            FancyLogger.get_logger().warning(
+                f"Ignoring a cached response that can't be restored: {e}"
+            )
+            return None
+
+        mot = ModelOutputThunk(value=entry["value"], meta=meta, tool_calls=tool_calls)
+        mot._thinking = entry["thinking"]
+        mot._context = linearized_ctx
+        mot._action = action
+        mot._model_options = model_options
+
+        self.formatter.parse(action, mot)
+
+        generate_log = GenerateLog()
+        generate_log.backend = f"cache::{entry['backend']}"
+        generate_log.model_options = model_options
+        generate_log.date = datetime.datetime.now()
+        generate_log.model_output = mot.value
+        generate_log.extra = {"cache_hit": True, "tools_called": mot.tool_calls}
+        generate_log.action = action
+        generate_log.result = mot
+        mot._generate_log = generate_log
+        return mot
+
+
+CACHEABLE_RESPONSE_MODELS: set[str] = {"ollama._types:ChatResponse"}
+"""The pydantic models (as `module:qualname`) in `_meta` that are cached and restored. Cache entries name the class of every model in them, so only these classes are ever imported when reading an entry. Use `register_cacheable_response_model` to add more."""
+
+
+def register_cacheable_response_model(cls: type[pydantic.BaseModel]) -> type:
+    """Allows instances of the pydantic model `cls` in `_meta` to be cached. Can be used as a class decorator."""
+    assert issubclass(cls, pydantic.BaseModel), f"{cls} is not a pydantic model"
+    CACHEABLE_RESPONSE_MODELS.add(_qualified_name(cls))
+    return cls
+
+
+def _qualified_name(cls: type) -> str:
+    return f"{cls.__module__}:{cls.__qualname__}"
+
+
+def _encode_meta(meta: dict[str, Any]) -> dict[str, Any]:
+    """Returns the json-serializable part of a ModelOutputThunk's `_meta`.
+
+    Pydantic models in `CACHEABLE_RESPONSE_MODELS` (e.g., the raw chat responses of the ollama client) are stored with their class so that they can be restored. Other pydantic models and values that can't be serialized (e.g., tensors) are dropped.
+    """
+    encoded: dict[str, Any] = {}
+    for k, v in meta.items():
+        if isinstance(v, pydantic.BaseModel):
+            name = _qualified_name(type(v))
+            if name in CACHEABLE_RESPONSE_MODELS:
+                encoded[k] = {"__pydantic__": name, "data": v.model_dump(mode="json")}
+            continue
+        try:
+            json.dumps(v)
+        except (TypeError, ValueError):
+            continue
+        encoded[k] = v
+    return encoded
+
+
+def _decode_meta(encoded: dict[str, Any]) -> dict[str, Any]:
+    """Restores the `_meta` of a cached response. Raises a `ValueError` if a pydantic model can't be restored, e.g., because its class isn't in `CACHEABLE_RESPONSE_MODELS`, was renamed or its schema changed since the response was cached."""
+    meta: dict[str, Any] = {}
+    for k, v in encoded.items():
+        if isinstance(v, dict) and "__pydantic__" in v:
+            if v["__pydantic__"] not in CACHEABLE_RESPONSE_MODELS:
+                raise ValueError(
+                    f"cannot restore {v['__pydantic__']} for `{k}`: not a cacheable response model"
+                )
+            try:
+                module_name, qualname = v["__pydantic__"].split(":")
+                cls: Any = importlib.import_module(module_name)
+                for name in qualname.split("."):
+                    cls = getattr(cls, name)
+                if not (isinstance(cls, type) and issubclass(cls, pydantic.BaseModel)):
+                    raise ValueError("not a pydantic model")
+                meta[k] = cls.model_validate(v["data"])
+            except (ImportError, AttributeError, ValueError) as e:
+                # pydantic's ValidationError is a ValueError.
+                raise ValueError(
+                    f"cannot restore {v['__pydantic__']} for `{k}`: {e}"
+                ) from e
+        else:
+            meta[k] = v
+    return meta
@@ -0,0 +1,393 @@
+"""A backend that load-balances requests across several replicas of the same model.
+
+Each replica is a regular backend (e.g., one `OllamaModelBackend` or `OpenAIBackend` per server). The `RouterBackend` picks a replica for every request with a pluggable `RoutingPolicy`, keeps track of the in-flight requests, latency and health of every replica, and retries requests that fail before producing any output on another replica.
+"""
+
+from __future__ import annotations
+
+import abc
+import asyncio
+import time
+from collections.abc import Callable
+from dataclasses import dataclass
+
+from mellea.backends import Backend, BaseModelSubclass
+from mellea.backends.formatter import FormatterBackend, TemplateFormatter
+from mellea.helpers.async_helpers import ModelOutputThunkRelay
+from mellea.helpers.fancy_logger import FancyLogger
+from mellea.stdlib.base import CBlock, Component, Context, GenerateLog, ModelOutputThunk
+
+
+@dataclass
+class ReplicaStats:
+    """The state of one replica of a `RouterBackend`."""
+
+    in_flight: int = 0
+    """The number of requests that are currently being generated by the replica."""
+
+    requests: int = 0
+    """The total number of requests sent to the replica."""
+
+    failures: int = 0
+    """The total number of failed requests."""
+
+    consecutive_failures: int = 0
+    """The number of requests that failed since the last successful one."""
+
+    unhealthy_until: float = 0.0
+    """The replica doesn't receive requests until this time (`time.monotonic()`) unless all replicas are unhealthy."""
+
+    latency: float | None = None
+    """The exponentially weighted moving average of the request latency in seconds, or `None` before the first successful request."""
+
+    def is_healthy(self, now: float) -> bool:
+        """Returns whether the replica can receive requests at time `now`."""
+        return now >= self.unhealthy_until
+
+
+class RoutingPolicy(abc.ABC):
+    """Chooses the replica for the next request."""
+
+    @abc.abstractmethod
+    def choose(self, candidates: list[int], replicas: list[ReplicaStats]) -> int:
+        """Returns one of the `candidates`.
+
+        Args:
+            candidates: the indices of the replicas that can receive the request; never empty.
+            replicas: the state of all replicas.
+        """
+        ...
+
+
+class RoundRobinPolicy(RoutingPolicy):
+    """Sends requests to the replicas in turn, skipping replicas that can't receive requests."""
+
+    def __init__(self):
+        """Initializes the policy to start with the first replica."""
+        self._next = 0
+
+    def choose(self, candidates: list[int], replicas: list[ReplicaStats]) -> int:
+        """Returns the next candidate in replica order."""
+        for offset in range(len(replicas)):
+            i = (self._next + offset) % len(replicas)
+            if i in candidates:
+                self._next = i + 1
+                return i
+        raise ValueError("There must be at least one candidate.")
+
+
+class LeastOutstandingPolicy(RoutingPolicy):
+    """Sends requests to the replica with the fewest in-flight requests."""
+
+    def choose(self, candidates: list[int], replicas: list[ReplicaStats]) -> int:
+        """Returns the candidate with the fewest in-flight requests, breaking ties by the total number of requests."""
+        return min(
+            candidates, key=lambda i: (replicas[i].in_flight, replicas[i].requests)
+        )
+
+
+class EWMALatencyPolicy(RoutingPolicy):
+    """Sends requests to the replica with the lowest expected latency.
+
+    The expected latency of a replica is its average latency weighted by the number of requests it would be working on. Replicas without a latency measurement are tried first.
+    """
+
+    def choose(self, candidates: list[int], replicas: list[ReplicaStats]) -> int:
+        """Returns the candidate with the lowest expected latency."""
+
+        def expected_latency(i: int) -> tuple[float, int]:
+            latency = replicas[i].latency
+            if latency is None:
+                return (0.0, replicas[i].in_flight)
+            return (latency * (replicas[i].in_flight + 1), replicas[i].in_flight)
+
+        return min(candidates, key=expected_latency)
+
+
+class RouterBackend(FormatterBackend):
+    """Routes requests across several backends that serve the same model.
+
+    Requests that fail before producing any output are retried on another replica. A replica that fails `max_consecutive_failures` requests in a row is considered unhealthy and doesn't receive requests for `cooldown` seconds (unless every replica is unhealthy).
+
+    With `prefix_affinity`, a request that continues a conversation is sent to the replica that generated the conversation's last output, since that replica likely still holds the conversation's kv cache. Affinity is ignored while that replica is unhealthy.
+    """
+
+    def __init__(
+        self,
+        backends: list[Backend],
+        *,
+        policy: RoutingPolicy | None = None,
+        prefix_affinity: bool = False,
+        max_consecutive_failures: int = 3,
+        cooldown: float = 30.0,
+        latency_alpha: float = 0.3,
+    ):
+        """Creates a router over `backends`.
+
+        Args:
+            backends: the replicas; they should all serve the same model. The first replica's model id, model options and formatter are used for the router.
+            policy: the routing policy; defaults to `RoundRobinPolicy`.
+            prefix_affinity: if True, conversations stick to the replica that generated their last output.
+            max_consecutive_failures: the number of failed requests in a row after which a replica is considered unhealthy.
+            cooldown: the number of seconds an unhealthy replica doesn't receive requests.
+            latency_alpha: the weight of the newest measurement in the latency average.
+        """
+        assert len(backends) > 0, "A RouterBackend needs at least one backend."
+        first = backends[0]
+        formatter = (
+            first.formatter
+            if isinstance(first, FormatterBackend)
+            else TemplateFormatter(model_id=first.model_id)
+        )
+        super().__init__(first.model_id, formatter, model_options=first.model_options)
+
+        self.backends = backends
+        self.policy = policy if policy is not None else RoundRobinPolicy()
+        self.prefix_affinity = prefix_affinity
+        self.max_consecutive_failures = max_consecutive_failures
+        self.cooldown = cooldown
+        self.latency_alpha = latency_alpha
+
+        self.replicas = [ReplicaStats() for _ in backends]
+
+        # Counters that are mostly useful for debugging and benchmarking.
+        self.affinity_hits = 0
+        self.retries = 0
+
+    def generate_from_context(
+        self,
+        action: Component | CBlock,
+        ctx: Context,
+        *,
+        format: type[BaseModelSubclass] | None = None,
+        model_options: dict | None = None,
+        tool_calls: bool = False,
+    ) -> tuple[ModelOutputThunk, Context]:
+        """Generates with the replica chosen by the routing policy."""
+
+        def generate(backend: Backend) -> ModelOutputThunk:
+            return backend.generate_from_context(
+                action,
+                ctx,
+                format=format,
+                model_options=model_options,
+                tool_calls=tool_calls,
+            )[0]
+
+        replica, source, started = self._send(ctx, generate, failed=set())
+        mot = self._relay(
+            source, replica, started, ctx, generate, action, model_options
+        )
+        return mot, ctx.add(action).add(mot)
+
+    def generate_n_from_context(
+        self,
+        action: Component | CBlock,
+        ctx: Context,
+        *,
+        n: int,
+        format: type[BaseModelSubclass] | None = None,
+        model_options: dict | None = None,
+        tool_calls: bool = False,
+    ) -> list[tuple[ModelOutputThunk, Context]]:
+        """Generates all samples with a single replica so that it can share work between them. Samples that fail are retried individually."""
+        failed: set[int] = set()
+        replica = self._choose(ctx, failed)
+        assert replica is not None
+        started = time.monotonic()
+        self._start_requests(replica, n)
+        try:
+            sources = self.backends[replica].generate_n_from_context(
+                action,
+                ctx,
+                n=n,
+                format=format,
+                model_options=model_options,
+                tool_calls=tool_calls,
+            )
+        except Exception:
+            for _ in range(n):
+                self._finish_request(replica, started, ok=False)
+            # Route the samples individually instead.
+            return super().generate_n_from_context(
+                action,
+                ctx,
+                n=n,
+                format=format,
+                model_options=model_options,
+                tool_calls=tool_calls,
+            )
+
+        def generate(backend: Backend) -> ModelOutputThunk:
+            return backend.generate_from_context(
+                action,
+                ctx,
+                format=format,
+                model_options=model_options,
+                tool_calls=tool_calls,
+            )[0]
+
+        results = []
+        for source, _ in sources:
+            mot = self._relay(
+                source, replica, started, ctx, generate, action, model_options
+            )
+            results.append((mot, ctx.add(action).add(mot)))
+        return results
+
+    def _generate_from_raw(
+        self,
+        actions: list[Component | CBlock],
+        *,
+        format: type[BaseModelSubclass] | None = None,
+        model_options: dict | None = None,
+        generate_logs: list[GenerateLog] | None = None,
+    ) -> list[ModelOutputThunk]:
+        """Generates with the replica chosen by the routing policy, retrying on other replicas if the request fails."""
+        failed: set[int] = set()
+        while True:
+            replica = self._choose(None, failed)
+            assert replica is not None
+            started = time.monotonic()
+            self._start_requests(replica, 1)
+            try:
+                results = self.backends[replica]._generate_from_raw(
+                    actions,
+                    format=format,
+                    model_options=model_options,
+                    generate_logs=generate_logs,
+                )
+            except Exception:
+                self._finish_request(replica, started, ok=False)
+                failed.add(replica)
+                if self._choose(None, failed) is None:
+                    raise
+                self.retries += 1
+                continue
+
+            self._finish_request(replica, started, ok=True)
+            return results
+
+    def _choose(self, ctx: Context | None, failed: set[int]) -> int | None:
+        """Returns the replica for the next request, or `None` if every replica has already failed this request."""
+        now = time.monotonic()
+        candidates = [
+            i
+            for i, stats in enumerate(self.replicas)
+            if i not in failed and stats.is_healthy(now)
+        ]
+        if len(candidates) == 0:
+            # Every replica that hasn't failed this request is unhealthy; try them anyway.
+            candidates = [i for i in range(len(self.replicas)) if i not in failed]
+            if len(candidates) == 0:
+                return None
+
+        if self.prefix_affinity and ctx is not None:
+            last_output = ctx.last_output()
+            if last_output is not None:
+                replica = last_output._meta.get("router_replica", None)
+                if replica in candidates:
+                    self.affinity_hits += 1
+                    return replica
+
+        return self.policy.choose(candidates, self.replicas)
+
+    def _send(
+        self,
+        ctx: Context,
+        generate: Callable[[Backend], ModelOutputThunk],
+        failed: set[int],
+    ) -> tuple[int, ModelOutputThunk, float]:
+        """Starts a request on a replica that hasn't failed it yet. Returns the replica, its ModelOutputThunk and the start time."""
+        while True:
+            replica = self._choose(ctx, failed)
+            assert replica is not None
+            started = time.monotonic()
+            self._start_requests(replica, 1)
+            try:
+                return replica, generate(self.backends[replica]), started
+            except Exception:
+                self._finish_request(replica, started, ok=False)
+                failed.add(replica)
+                if self._choose(ctx, failed) is None:
+                    raise
+                self.retries += 1
+
+    def _relay(
+        self,
+        source: ModelOutputThunk,
+        replica: int,
+        started: float,
+        ctx: Context,
+        generate: Callable[[Backend], ModelOutputThunk],
+        action: Component | CBlock,
+        model_options: dict | None,
+    ) -> ModelOutputThunk:
+        """Returns a ModelOutputThunk for the caller and tracks the request in the background."""
+        relay = ModelOutputThunkRelay(source)
+        relay.task = asyncio.create_task(
+            self._drive(relay, replica, started, ctx, generate)
+        )
+        return relay.subscribe(action, ctx.view_for_generation(), model_options)
+
+    async def _drive(
+        self,
+        relay: ModelOutputThunkRelay,
+        replica: int,
+        started: float,
+        ctx: Context,
+        generate: Callable[[Backend], ModelOutputThunk],
+    ):
+        """Generates the response, retrying on another replica if the request fails before producing any output."""
+        failed: set[int] = set()
+        while True:
+            try:
+                await relay.consume()
+            except Exception as e:
+                self._finish_request(replica, started, ok=False)
+                failed.add(replica)
+                if len(relay.chunks) > 0 or self._choose(ctx, failed) is None:
+                    # Part of the output has already been streamed; it can't be retried.
+                    relay.finish(e)
+                    return
+
+                self.retries += 1
+                try:
+                    replica, relay.source, started = self._send(ctx, generate, failed)
+                except Exception as retry_error:
+                    relay.finish(retry_error)
+                    return
+                continue
+
+            self._finish_request(replica, started, ok=True)
+            relay.source._meta["router_replica"] = replica
+            relay.finish()
+            return
+
+    def _start_requests(self, replica: int, n: int):
+        stats = self.replicas[replica]
+        stats.in_flight += n
+        stats.requests += n
+
+    def _finish_request(self, replica: int, started: float, ok: bool):
+        stats = self.replicas[replica]
+        stats.in_flight -= 1
+        now = time.monotonic()
+        if ok:
+            latency = now - started
+            stats.latency = (
+                latency
+                if stats.latency is None
+                else self.latency_alpha * latency
+                + (1 - self.latency_alpha) * stats.latency
+            )
+            stats.consecutive_failures = 0
+            return
+
+        stats.failures += 1
+        stats.consecutive_failures += 1
+        if stats.consecutive_failures >= self.max_consecutive_failures:
+            stats.unhealthy_until = now + self.cooldown
+            FancyLogger.get_logger().warning(
+                f"Replica {replica} of the RouterBackend failed {stats.consecutive_failures} requests in a row; not routing to it for {self.cooldown} seconds."
+            )
@@ -0,0 +1,463 @@
+"""A hierarchical cache for kv caches that spills to CPU memory and disk instead of dropping entries.
+
+Evicting a kv cache from the model device means that the next request which could have reused it (e.g., an aLoRA requirement check or a follow-up turn) has to prefill the whole prompt again. The `TieredKVCache` keeps the hottest entries on the model device, moves the next ones to (pinned) CPU memory, and serializes the coldest ones to a local directory with safetensors. On a hit, entries are promoted back to the device they came from. Entries on disk survive process restarts.
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import dataclasses
+import hashlib
+import importlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from collections.abc import Callable
+from typing import Any
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+from transformers import DynamicCache
+
+from mellea.backends.cache import Cache
+from mellea.helpers.fancy_logger import FancyLogger
+
+
+@dataclasses.dataclass
+class _Offloaded:
+    """A value whose tensors were copied to CPU memory."""
+
+    value: Any
+    device: torch.device
+    # Set when the copy to CPU memory was asynchronous; must be waited on before reading the tensors on the CPU.
+    copied: torch.cuda.Event | None = None
+
+
+class TieredKVCache(Cache):
+    """A three-tier LRU cache: model device, CPU memory and disk.
+
+    New entries go to the device tier. When a tier is over capacity, its least recently used entry is moved to the next tier: device entries are copied to (pinned) CPU memory, and CPU entries are written to `disk_dir` in the background. Entries that fall out of the last tier are dropped. A `get` that hits a lower tier promotes the entry back to its original device; use `prefetch` to start that promotion before the entry is needed.
+
+    Values can be tensors, `DynamicCache`s, the dataclasses in `OFFLOADABLE_DATACLASSES` (e.g., `HFAloraCacheInfo`), and lists, tuples and dicts of these and of json values. Values that contain anything else are dropped when they would be written to disk.
+
+    If `disk_dir` already contains entries (e.g., from a previous process), they are available immediately. This makes it possible to persist the kv caches of long-lived prompts across restarts.
+    """
+
+    def __init__(
+        self,
+        device_capacity: int,
+        cpu_capacity: int,
+        disk_dir: str | None = None,
+        disk_capacity: int | None = None,
+        pin_memory: bool = True,
+    ):
+        """Initializes the cache.
+
+        Args:
+            device_capacity: the number of entries to keep on the model device.
+            cpu_capacity: the number of entries to keep in CPU memory.
+            disk_dir: if set, entries evicted from CPU memory are stored in this directory.
+            disk_capacity: the number of entries to keep in `disk_dir`. None means unbounded.
+            pin_memory: whether to offload to pinned memory when the tensors live on a CUDA device. Pinned memory makes the copies between tiers asynchronous.
+        """
+        self.device_capacity = device_capacity
+        self.cpu_capacity = cpu_capacity
+        self.disk_dir = disk_dir
+        self.disk_capacity = disk_capacity
+        self.pin_memory = pin_memory
+
+        self._device: OrderedDict[str, Any] = OrderedDict()
+        self._cpu: OrderedDict[str, _Offloaded] = OrderedDict()
+        self._disk: OrderedDict[str, str] = OrderedDict()
+        # Entries that are being written to disk. They can still be read from CPU memory.
+        self._writing: dict[str, _Offloaded] = {}
+        self._promotions: dict[str, concurrent.futures.Future] = {}
+
+        self._lock = threading.RLock()
+        # A single worker keeps disk writes for the same key in order.
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="mellea-tiered-cache"
+        )
+
+        self.hits = {"device": 0, "cpu": 0, "disk": 0}
+        self.misses = 0
+
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._load_disk_index()
+
+    def current_size(self) -> int:
+        """Returns the number of entries across all tiers."""
+        with self._lock:
+            return (
+                len(self._device)
+                + len(self._cpu)
+                + len(self._writing)
+                + len(self._disk)
+            )
+
+    def tier_of(self, key: str) -> str | None:
+        """Returns the tier ("device", "cpu" or "disk") that currently holds `key`, or None."""
+        with self._lock:
+            if key in self._device:
+                return "device"
+            if key in self._cpu or key in self._writing:
+                return "cpu"
+            if key in self._disk:
+                return "disk"
+            return None
+
+    def put(self, key: str, value: Any):
+        """Puts a value into the device tier, moving least recently used entries down the hierarchy as needed."""
+        with self._lock:
+            self._discard(key)
+            self._device[key] = value
+            self._rebalance()
+
+    def get(self, key: str) -> Any | None:
+        """Gets a value from the cache, promoting it to the device tier if it was offloaded."""
+        with self._lock:
+            promotion = self._promotions.get(key, None)
+        if promotion is not None:
+            # Wait outside the lock; the promotion needs it to finish.
+            promotion.result()
+
+        with self._lock:
+            if key in self._device:
+                self.hits["device"] += 1
+                self._device.move_to_end(key)
+                return self._device[key]
+
+            tier = self.tier_of(key)
+            if tier is None:
+                self.misses += 1
+                return None
+            self.hits[tier] += 1
+
+        value = self._promote(key)
+        if value is None:
+            # The entry could not be read back (e.g., the file was removed).
+            with self._lock:
+                self.misses += 1
+        return value
+
+    def prefetch(self, key: str) -> concurrent.futures.Future | None:
+        """Starts promoting an offloaded entry to the device tier in the background.
+
+        Returns a future that resolves to the value, or None if `key` is already on the device or not cached at all. A `get` for the same key waits for the promotion instead of starting another one.
+        """
+        with self._lock:
+            if key in self._promotions:
+                return self._promotions[key]
+            if self.tier_of(key) in (None, "device"):
+                return None
+            future = self._executor.submit(self._promote, key)
+            self._promotions[key] = future
+            future.add_done_callback(lambda _: self._promotions.pop(key, None))
+            return future
+
+    def flush(self):
+        """Blocks until all pending disk writes and promotions are done."""
+        self._executor.submit(lambda: None).result()
+
+    # region tier movement
+    def _rebalance(self):
+        """Moves least recently used entries down until every tier is within capacity. Must hold the lock."""
+        while len(self._device) > self.device_capacity:
+            key, value = self._device.popitem(last=False)
+            self._cpu[key] = self._offload(value)
+
+        while len(self._cpu) > self.cpu_capacity:
+            key, offloaded = self._cpu.popitem(last=False)
+            if self.disk_dir is None:
+                continue
+            self._writing[key] = offloaded
+            self._executor.submit(self._write, key, offloaded)
+
+        while self.disk_capacity is not None and len(self._disk) > self.disk_capacity:
+            _, path = self._disk.popitem(last=False)
+            _remove_file(path)
+
+    def _offload(self, value: Any) -> _Offloaded:
+        device = _first_device(value)
+        if device is None or device.type == "cpu":
+            return _Offloaded(value, torch.device("cpu"))
+
+        pin = self.pin_memory and device.type == "cuda"
+
+        def to_cpu(t: torch.Tensor) -> torch.Tensor:
+            if not pin:
+                return t.to("cpu")
+            host = torch.empty(t.shape, dtype=t.dtype, device="cpu", pin_memory=True)
+            return host.copy_(t, non_blocking=True)
+
+        offloaded = _map_tensors(value, to_cpu)
+        copied = None
+        if pin:
+            copied = torch.cuda.Event()
+            copied.record()
+        return _Offloaded(offloaded, device, copied)
+
+    def _promote(self, key: str) -> Any | None:
+        """Moves an entry to the device tier and returns its value."""
+        with self._lock:
+            if key in self._device:
+                return self._device[key]
+            offloaded = self._cpu.pop(key, None) or self._writing.pop(key, None)
+            path = self._disk.get(key, None)
+
+        if offloaded is None and path is not None:
+            offloaded = self._read(path)
+        if offloaded is None:
+            return None
+
+        non_blocking = offloaded.copied is not None
+        value = _map_tensors(
+            offloaded.value, lambda t: t.to(offloaded.device, non_blocking=non_blocking)
+        )
+
+        with self._lock:
+            # The entry may have been replaced while it was being promoted; the newer value wins.
+            if key in self._device:
+                return self._device[key]
+            if path is not None and self._disk.get(key, None) == path:
+                # The device tier holds the entry now; a stale file would be read back after a restart.
+                self._disk.pop(key, None)
+                _remove_file(path)
+            self._device[key] = value
+            self._rebalance()
+        return value
+
+    def _discard(self, key: str):
+        """Removes a key from every tier. Must hold the lock."""
+        self._device.pop(key, None)
+        self._cpu.pop(key, None)
+        self._writing.pop(key, None)
+        path = self._disk.pop(key, None)
+        if path is not None:
+            _remove_file(path)
+
+    # endregion
+
+    # region on-disk storage
+    def _disk_path(self, key: str) -> str:
+        assert self.disk_dir is not None
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.disk_dir, f"{digest}.safetensors")
+
+    def _write(self, key: str, offloaded: _Offloaded):
+        """Runs on the executor."""
+        path = self._disk_path(key)
+        try:
+            if offloaded.copied is not None:
+                offloaded.copied.synchronize()
+            tensors: dict[str, torch.Tensor] = {}
+            structure = _flatten(offloaded.value, tensors)
+            metadata = {
+                "key": key,
+                "device": str(offloaded.device),
+                "structure": json.dumps(structure),
+            }
+            # Write to a temporary file first so that readers never see partial files.
+            fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+            os.close(fd)
+            save_file(tensors, tmp_path, metadata=metadata)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            FancyLogger.get_logger().warning(
+                f"could not offload kv cache for key '{key[:32]}' to disk: {e}"
+            )
+            with self._lock:
+                if self._writing.get(key, None) is offloaded:
+                    del self._writing[key]
+            return
+
+        with self._lock:
+            if self._writing.get(key, None) is not offloaded:
+                # The key was replaced or promoted while it was being written.
+                if key not in self._writing and key not in self._disk:
+                    _remove_file(path)
+                return
+            del self._writing[key]
+            self._disk[key] = path
+            self._rebalance()
+
+    def _read(self, path: str) -> _Offloaded | None:
+        try:
+            with safe_open(path, framework="pt") as f:  # type: ignore
+                metadata = f.metadata()
+            # load_file memory-maps the file; tensors are only read when they are moved to the device.
+            tensors = load_file(path, device="cpu")
+            value = _unflatten(json.loads(metadata["structure"]), tensors)
+            device = torch.device(metadata["device"])
+        except Exception as e:
+            FancyLogger.get_logger().warning(
+                f"could not load offloaded kv cache from {path}: {e}"
+            )
+            return None
+
+        if device.type == "cuda" and not torch.cuda.is_available():
+            device = torch.device("cpu")
+        return _Offloaded(value, device)
+
+    def _load_disk_index(self):
+        """Registers the entries that are already in `disk_dir`, least recently written first."""
+        assert self.disk_dir is not None
+        paths = [
+            os.path.join(self.disk_dir, name)
+            for name in os.listdir(self.disk_dir)
+            if name.endswith(".safetensors")
+        ]
+        for path in sorted(paths, key=os.path.getmtime):
+            try:
+                with safe_open(path, framework="pt") as f:  # type: ignore
+                    key = f.metadata()["key"]
+            except Exception as e:
+                FancyLogger.get_logger().warning(
+                    f"ignoring unreadable kv cache file {path}: {e}"
+                )
+                continue
+            self._disk[key] = path
+
+        while self.disk_capacity is not None and len(self._disk) > self.disk_capacity:
+            _, path = self._disk.popitem(last=False)
+            _remove_file(path)
+
+    # endregion
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _first_device(value: Any) -> torch.device | None:
+    found: list[torch.device] = []
+
+    def visit(t: torch.Tensor) -> torch.Tensor:
+        found.append(t.device)
+        return t
+
+    _map_tensors(value, visit)
+    return found[0] if found else None
+
+
+def _map_tensors(value: Any, fn: Callable[[torch.Tensor], torch.Tensor]) -> Any:
+    """Returns a copy of `value` with `fn` applied to every tensor in it."""
+    if isinstance(value, torch.Tensor):
+        return fn(value)
+    if isinstance(value, DynamicCache):
+        return DynamicCache.from_legacy_cache(
+            tuple((fn(k), fn(v)) for k, v in value.to_legacy_cache())  # type: ignore
+        )
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return dataclasses.replace(
+            value,  # type: ignore
+            **{
+                field.name: _map_tensors(getattr(value, field.name), fn)
+                for field in dataclasses.fields(value)
+                if field.init
+            },
+        )
+    if isinstance(value, list | tuple):
+        return type(value)(_map_tensors(v, fn) for v in value)
+    if isinstance(value, dict):
+        return {k: _map_tensors(v, fn) for k, v in value.items()}
+    return value
+
+
+# region serialization
+# Values are stored as a json structure that refers to the tensors in the safetensors file by name.
+
+OFFLOADABLE_DATACLASSES: set[str] = {"mellea.backends.huggingface:HFAloraCacheInfo"}
+"""The dataclasses (as `module:qualname`) that can be written to and read from disk. Files name the class of every dataclass in them, so only these classes are ever imported when reading a file. Use `register_offloadable_dataclass` to add more."""
+
+
+def register_offloadable_dataclass(cls: type) -> type:
+    """Allows instances of the dataclass `cls` to be offloaded to disk. Can be used as a class decorator."""
+    assert dataclasses.is_dataclass(cls), f"{cls} is not a dataclass"
+    OFFLOADABLE_DATACLASSES.add(_qualified_name(cls))
+    return cls
+
+
+def _qualified_name(cls: type) -> str:
+    return f"{cls.__module__}:{cls.__qualname__}"
+
+
+def _flatten(value: Any, tensors: dict[str, torch.Tensor]) -> Any:
+    if isinstance(value, torch.Tensor):
+        name = str(len(tensors))
+        tensors[name] = value.contiguous()
+        return {"tensor": name}
+    if isinstance(value, DynamicCache):
+        return {
+            "dynamic_cache": [
+                [_flatten(k, tensors), _flatten(v, tensors)]
+                for k, v in value.to_legacy_cache()
+            ]
+        }
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        name = _qualified_name(type(value))
+        if name not in OFFLOADABLE_DATACLASSES:
+            raise TypeError(
+                f"cannot offload dataclass {name} to disk; see `register_offloadable_dataclass`"
+            )
+        return {
+            "dataclass": name,
+            "fields": {
+                field.name: _flatten(getattr(value, field.name), tensors)
+                for field in dataclasses.fields(value)
+                if field.init
+            },
+        }
+    if isinstance(value, list | tuple):
+        return {
+            "tuple" if isinstance(value, tuple) else "list": [
+                _flatten(v, tensors) for v in value
+            ]
+        }
+    if isinstance(value, dict):
+        assert all(isinstance(k, str) for k in value), (
+            "only dicts with string keys can be offloaded to disk"
+        )
+        return {"dict": {k: _flatten(v, tensors) for k, v in value.items()}}
+    if value is None or isinstance(value, bool | int | float | str):
+        return {"value": value}
+    raise TypeError(f"cannot offload values of type {type(value)} to disk")
+
+
+def _unflatten(structure: dict, tensors: dict[str, torch.Tensor]) -> Any:
+    if "tensor" in structure:
+        return tensors[structure["tensor"]]
+    if "dynamic_cache" in structure:
+        return DynamicCache.from_legacy_cache(
+            tuple(  # type: ignore
+                (_unflatten(k, tensors), _unflatten(v, tensors))
+                for k, v in structure["dynamic_cache"]
+            )
+        )
+    if "dataclass" in structure:
+        if structure["dataclass"] not in OFFLOADABLE_DATACLASSES:
+            raise TypeError(f"{structure['dataclass']} is not an offloadable dataclass")
+        module_name, qualname = structure["dataclass"].split(":")
+        cls: Any = importlib.import_module(module_name)
+        for part in qualname.split("."):
+            cls = getattr(cls, part)
+        return cls(
+            **{k: _unflatten(v, tensors) for k, v in structure["fields"].items()}
+        )
+    if "tuple" in structure:
+        return tuple(_unflatten(v, tensors) for v in structure["tuple"])
+    if "list" in structure:
+        return [_unflatten(v, tensors) for v in structure["list"]]
+    if "dict" in structure:
+        return {k: _unflatten(v, tensors) for k, v in structure["dict"].items()}
+    return structure["value"]
+
+
+# endregion
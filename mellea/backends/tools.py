@@ -1,13 +1,111 @@
 """Utilities for dealing with tools."""
 
+from __future__ import annotations
+
 import json
+import re
+import weakref
 from collections.abc import Callable, Generator, Iterable, Mapping
 from typing import Any
 
 from ollama._utils import convert_function_to_tool
 
 from mellea.backends.types import ModelOption
-from mellea.stdlib.base import CBlock, Component, TemplateRepresentation
+from mellea.stdlib.base import CBlock, Component, Context, TemplateRepresentation
+
+
+class ToolRegistry:
+    """Caches the tools of components and contexts, and the JSON schemas of tools.
+
+    - The tools of a component are extracted with `format_for_llm` once per component. This assumes that the tools of a component don't change once it has been added to a context.
+    - The tools of a context are kept per context node and built from the tools of the previous node, so collecting the tools of a context only looks at the components added since the last time.
+    - The JSON schema of a tool is derived once per function. Bound methods share the schema of their function since a new bound method object is created every time the method is accessed.
+
+    All caches hold weak references, so they don't keep components, contexts, or tools alive.
+    """
+
+    def __init__(self):
+        """Initializes the registry with empty caches."""
+        self._component_tools: weakref.WeakKeyDictionary[
+            Component, dict[str, Callable] | None
+        ] = weakref.WeakKeyDictionary()
+        self._context_tools: weakref.WeakKeyDictionary[Context, dict[str, Callable]] = (
+            weakref.WeakKeyDictionary()
+        )
+        self._function_schemas: weakref.WeakKeyDictionary[Callable, dict] = (
+            weakref.WeakKeyDictionary()
+        )
+        self._method_schemas: weakref.WeakKeyDictionary[Callable, dict] = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def component_tools(self, c: Component | CBlock) -> dict[str, Callable] | None:
+        """Returns the tools in the template representation of `c`, if any. Do not modify the returned dict."""
+        if not isinstance(c, Component):
+            return None  # Only components have template representations.
+
+        try:
+            if c in self._component_tools:
+                return self._component_tools[c]
+        except TypeError:
+            # Unhashable components can't be cached.
+            return _extract_tools(c)
+
+        tools = _extract_tools(c)
+        self._component_tools[c] = tools
+        return tools
+
+    def context_tools(self, ctx: Context) -> dict[str, Callable]:
+        """Returns the tools of all components in the history of `ctx`; later components overwrite tools with the same name. Do not modify the returned dict."""
+        # Walk back to the closest node whose tools are known.
+        new_nodes: list[Context] = []
+        node: Context | None = ctx
+        while node is not None and node not in self._context_tools:
+            new_nodes.append(node)
+            node = node.previous_node
+
+        tools: dict[str, Callable] = (
+            self._context_tools[node] if node is not None else {}
+        )
+        for node in reversed(new_nodes):
+            data = node.node_data
+            new_tools = self.component_tools(data) if data is not None else None
+            if new_tools:
+                tools = {**tools, **new_tools}
+            # Nodes without new tools share the dict of their previous node.
+            self._context_tools[node] = tools
+        return tools
+
+    def tool_schema(self, tool: Callable) -> dict:
+        """Returns the JSON schema of `tool`. Raises if no schema can be derived. Do not modify the returned dict."""
+        # Bound methods are recreated on every attribute access; cache by their function instead.
+        func = getattr(tool, "__func__", None)
+        cache, key = (
+            (self._method_schemas, func)
+            if func is not None
+            else (self._function_schemas, tool)
+        )
+        try:
+            schema = cache.get(key, None)
+        except TypeError:
+            # Some callables can't be weakly referenced.
+            return convert_function_to_tool(tool).model_dump(exclude_none=True)
+
+        if schema is None:
+            schema = convert_function_to_tool(tool).model_dump(exclude_none=True)
+            cache[key] = schema
+        return schema
+
+
+def _extract_tools(c: Component) -> dict[str, Callable] | None:
+    tr = c.format_for_llm()
+    if not isinstance(tr, TemplateRepresentation) or tr.tools is None:
+        return None
+    return dict(tr.tools)
+
+
+tool_registry = ToolRegistry()
+"""The registry used by the tool helpers below."""
 
 
 def add_tools_from_model_options(
@@ -50,15 +148,26 @@ def add_tools_from_context_actions(
         return
 
     for action in ctx_actions:
-        if not isinstance(action, Component):
-            continue  # Only components have template representations.
+        tools = tool_registry.component_tools(action)
+        if tools is not None:
+            tools_dict.update(tools)
 
-        tr = action.format_for_llm()
-        if not isinstance(tr, TemplateRepresentation) or tr.tools is None:
-            continue
 
-        for tool_name, func in tr.tools.items():
-            tools_dict[tool_name] = func
+def add_tools_from_context(tools_dict: dict[str, Callable], ctx: Context):
+    """Add the tools of the components in `ctx.actions_for_available_tools()` to the tools_dict.
+
+    If the context makes its whole history available (e.g., a `ChatContext` without a window), the tools are built incrementally from the tools of the previous context.
+    """
+    actions = ctx.actions_for_available_tools()
+    if actions is None:
+        return
+
+    if len(actions) == ctx.length and (
+        len(actions) == 0 or actions[-1] is ctx.node_data
+    ):
+        tools_dict.update(tool_registry.context_tools(ctx))
+    else:
+        add_tools_from_context_actions(tools_dict, actions)
 
 
 def convert_tools_to_json(tools: dict[str, Callable]) -> list[dict]:
@@ -72,9 +181,7 @@ def convert_tools_to_json(tools: dict[str, Callable]) -> list[dict]:
     converted: list[dict[str, Any]] = []
     for tool in tools.values():
         try:
-            converted.append(
-                convert_function_to_tool(tool).model_dump(exclude_none=True)
-            )
+            converted.append(tool_registry.tool_schema(tool))
         except Exception:
             pass
 
@@ -129,15 +236,172 @@ def find_func(d) -> tuple[str | None, Mapping | None]:
     return None, None
 
 
-# NOTE: these extraction tools only work for json based outputs.
-def parse_tools(llm_response: str) -> list[tuple[str, Mapping]]:
-    """A simple parser that will scan a string for tools and attempt to extract them."""
-    processed = " ".join(llm_response.split())
+class IncrementalToolCallParser:
+    """Finds tool calls in model output while it is streamed.
+
+    Feed each chunk of output to `feed`. It returns the calls (`(name, arguments)` tuples) whose json objects were closed by the chunk, so tools can be called before the model has finished generating. Call `finish` once the output is complete.
+
+    The parser only looks at braces, quotes and backslashes and keeps track of nesting and strings across chunks. A top-level json object is decoded when it is closed. Like `json_extraction`, the parser also finds objects nested in text that isn't valid json: if a closed object can't be decoded, the objects closed inside of it are decoded instead, outermost first, and for an object that is never closed, the objects closed inside of it are decoded.
+    """
+
+    _special_chars = re.compile(r'[{}"\\]')
+
+    def __init__(self):
+        """Initializes the parser for a new output."""
+        self._reset()
 
-    tools = []
-    for possible_tool in json_extraction(processed):
-        tool_name, tool_arguments = find_func(possible_tool)
+    def _reset(self):
+        # The number of characters fed so far.
+        self._pos = 0
+        self._in_string = False
+        # The position after an escaped character; the character before it is skipped.
+        self._skip_until = 0
+
+        # The starts of the open objects, from the outermost to the innermost.
+        self._open: list[int] = []
+        # The spans of the objects closed inside the current top-level object.
+        self._closed: list[tuple[int, int]] = []
+        # The text of the current top-level object from previous chunks.
+        self._pieces: list[str] = []
+
+    def feed(self, chunk: str) -> list[tuple[str, Mapping]]:
+        """Adds a chunk of output and returns the tool calls that it completed."""
+        calls: list[tuple[str, Mapping]] = []
+        for match in self._special_chars.finditer(chunk):
+            i = match.start()
+            pos = self._pos + i
+            if pos < self._skip_until:
+                continue  # An escaped character.
+
+            char = match.group()
+            if self._in_string:
+                if char == "\\":
+                    self._skip_until = pos + 2
+                elif char == '"':
+                    self._in_string = False
+            elif char == "{":
+                if len(self._open) == 0:
+                    self._pieces = []
+                    self._closed = []
+                self._open.append(pos)
+            elif char == "}" and len(self._open) > 0:
+                start = self._open.pop()
+                if len(self._open) > 0:
+                    self._closed.append((start, pos + 1))
+                else:
+                    text = (
+                        "".join(self._pieces) + chunk[max(0, start - self._pos) : i + 1]
+                    )
+                    self._pieces = []
+                    calls.extend(
+                        _decode_tool_calls(
+                            text, start, [(start, pos + 1), *self._closed]
+                        )
+                    )
+                    self._closed = []
+            elif char == '"' and len(self._open) > 0:
+                # Quotes outside of objects are prose, not json strings.
+                self._in_string = True
+
+        if len(self._open) > 0:
+            self._pieces.append(chunk[max(0, self._open[0] - self._pos) :])
+        self._pos += len(chunk)
+        return calls
+
+    def finish(self, rescan: bool = True) -> list[tuple[str, Mapping]]:
+        """Returns the tool calls in the objects closed inside an object that was never closed.
+
+        Args:
+            rescan: if no calls are found, scan the text after the unclosed object's opening brace again. This finds calls that the parser missed because a stray quote made it mistake json for the contents of a string.
+        """
+        calls: list[tuple[str, Mapping]] = []
+        if len(self._open) > 0:
+            text = "".join(self._pieces)
+            offset = self._open[0]
+            calls = _decode_tool_calls(text, offset, self._closed)
+
+            if len(calls) == 0 and rescan:
+                # Scan the text once more, starting outside of any string.
+                self._reset()
+                calls = self.feed(text[1:]) + self.finish(rescan=False)
+
+        self._reset()
+        return calls
+
+
+_decoder = json.JSONDecoder(strict=False)
+"""Non-strict decoding allows raw newlines in strings."""
+
+_object_start = re.compile(r'\{\s*["}]')
+"""The start of an object that might be valid json."""
+
+
+class _InvalidJson(Exception):
+    def __init__(self, pos: int):
+        self.pos = pos
+
+
+def _decode_object(text: str, start: int, stop: int) -> tuple[Any, int]:
+    """Decodes the json object that starts at `start`, and ends before `stop`, and returns it and its end.
+
+    The text is read in growing windows, so that decoding costs time in proportion to the length of the object or to the distance to the error, not to the length of `text` (which `json` needs to report the line of an error).
+
+    Raises:
+        _InvalidJson: with the position of the error if the object isn't valid json.
+        RecursionError: if the object is nested too deeply to be decoded.
+    """
+    size = 256
+    while True:
+        window = text[start : min(stop, start + size)]
+        try:
+            obj, length = _decoder.raw_decode(window)
+            return obj, start + length
+        except json.JSONDecodeError as e:
+            # An error at the end of a window (or in a string that isn't terminated before it) might be caused by cutting the object off.
+            truncated = start + len(window) < stop and (
+                e.pos >= len(window) - 8 or e.msg.startswith("Unterminated string")
+            )
+            if not truncated:
+                raise _InvalidJson(start + e.pos) from None
+        size *= 4
+
+
+def _decode_tool_calls(
+    text: str, offset: int, spans: list[tuple[int, int]]
+) -> list[tuple[str, Mapping]]:
+    """Decodes the tool calls in the json objects at `spans` of `text`, which starts at position `offset` of the output.
+
+    Like in `json_extraction`, objects are tried in order of their start and the objects nested in a decoded object are skipped, so only the outermost valid objects are decoded. An object that contains the error of an object around it can't be valid either and is skipped too, as is everything in an object that is nested too deeply to be decoded. This keeps the time linear in the length of `text`.
+    """
+    calls: list[tuple[str, Mapping]] = []
+    # Everything before `end` has been decoded or skipped.
+    end = 0
+    # The position of the last decoding error.
+    error = -1
+    for start, stop in sorted(spans):
+        start -= offset
+        stop -= offset
+        if start < end or start <= error < stop:
+            continue
+        if _object_start.match(text, start) is None:
+            continue
+        try:
+            obj, end = _decode_object(text, start, stop)
+        except _InvalidJson as e:
+            error = e.pos
+            continue
+        except RecursionError:
+            end = stop
+            continue
+
+        tool_name, tool_arguments = find_func(obj)
         if tool_name is not None and tool_arguments is not None:
-            tools.append((tool_name, tool_arguments))
+            calls.append((tool_name, tool_arguments))
+    return calls
 
-    return tools
+
+# NOTE: these extraction tools only work for json based outputs.
+def parse_tools(llm_response: str) -> list[tuple[str, Mapping]]:
+    """A simple parser that will scan a string for tools and attempt to extract them."""
+    parser = IncrementalToolCallParser()
+    return parser.feed(llm_response) + parser.finish()
@@ -26,6 +26,8 @@ class ModelOption:
     THINKING = "@@@thinking@@@"
     SEED = "@@@seed@@@"
     STREAM = "@@@stream@@@"
+    LOGPROBS = "@@@logprobs@@@"
+    """Must be an int k. If set, backends that support it keep the log probabilities of the k most likely tokens at every generation step. Off by default; keeping scores for large vocabularies is expensive."""
 
     @staticmethod
     def replace_keys(options: dict, from_to: dict[str, str]) -> dict[str, Any]:
@@ -7,15 +7,15 @@ from __future__ import annotations
 
 import abc
 import asyncio
+import copy
 import dataclasses
 import datetime
 import functools
 import importlib
 import inspect
-import json
 import os
 import shutil
-from collections.abc import Callable
+from collections.abc import AsyncIterator, Awaitable, Callable
 from typing import TYPE_CHECKING, Any, Optional
 
 import msgspec  # type:ignore
@@ -26,10 +26,12 @@ import vllm  # type:ignore
 from transformers import AutoTokenizer, PreTrainedTokenizerBase
 
 from mellea.backends import BaseModelSubclass
-from mellea.backends._utils import to_chat, to_tool_calls
+from mellea.backends._utils import StreamingToolCalls, to_chat
 from mellea.backends.formatter import Formatter, FormatterBackend, TemplateFormatter
+from mellea.backends.guide_cache import get_guide_cache
 from mellea.backends.model_ids import ModelIdentifier
 from mellea.backends.tools import (
+    add_tools_from_context,
     add_tools_from_context_actions,
     add_tools_from_model_options,
     convert_tools_to_json,
@@ -228,9 +230,44 @@ class LocalVLLMBackend(FormatterBackend):
             model_options=model_options,
             generate_logs=generate_logs,
             tool_calls=tool_calls,
-        )
+        )[0]
         return mot, ctx.add(action).add(mot)
 
+    def generate_n_from_context(
+        self,
+        action: Component | CBlock,
+        ctx: Context,
+        *,
+        n: int,
+        format: type[BaseModelSubclass] | None = None,
+        model_options: dict | None = None,
+        tool_calls: bool = False,
+    ) -> list[tuple[ModelOutputThunk, Context]]:
+        """Generates `n` samples with a single vllm request that sets `SamplingParams.n`, so the prompt is only prefilled once.
+
+        Streaming requests fall back to `n` separate requests.
+        """
+        model_opts = self._simplify_and_merge(model_options)
+        if n == 1 or model_opts.get(ModelOption.STREAM, False):
+            return super().generate_n_from_context(
+                action,
+                ctx,
+                n=n,
+                format=format,
+                model_options=model_options,
+                tool_calls=tool_calls,
+            )
+
+        mots = self._generate_from_context_standard(
+            action,
+            ctx,
+            format=format,
+            model_options=model_opts,
+            tool_calls=tool_calls,
+            n=n,
+        )
+        return [(mot, ctx.add(action).add(mot)) for mot in mots]
+
     def _generate_from_context_standard(
         self,
         action: Component | CBlock,
@@ -240,7 +277,11 @@ class LocalVLLMBackend(FormatterBackend):
         model_options: dict[str, Any],
         generate_logs: list[GenerateLog] | None = None,
         tool_calls: bool = False,
-    ) -> ModelOutputThunk:
+        n: int = 1,
+    ) -> list[ModelOutputThunk]:
+        """Generates `n` ModelOutputThunks for the action. Streaming is only supported for a single sample."""
+        assert n == 1 or not model_options.get(ModelOption.STREAM, False)
+
         # Construct input.
         # If the Context is a ChatHistory then we will pretty-print each content as a message and then use apply_chat_template.
         # Otherwise, we will linearize the context and treat it as a raw input.
@@ -257,9 +298,7 @@ class LocalVLLMBackend(FormatterBackend):
                     )
                 else:
                     add_tools_from_model_options(tools, model_options)
-                    add_tools_from_context_actions(
-                        tools, ctx.actions_for_available_tools()
-                    )
+                    add_tools_from_context(tools, ctx)
 
                     # Add the tools from the action for this generation last so that
                     # they overwrite conflicting names.
@@ -283,22 +322,15 @@ class LocalVLLMBackend(FormatterBackend):
                     # returns only the final result
                     else vllm.sampling_params.RequestOutputKind.FINAL_ONLY
                 ),
+                n=n,
             )
 
             if format is not None:
                 # outlines.generate.json always parses the resulting json into a python dict.
                 # We however want to keep it as a json string for later storing it in ModelOutputThunk
                 schema: dict[str, Any] = format.model_json_schema()
-                schema_json: str = json.dumps(schema)
-                regex_str: str = outlines_core.fsm.json_schema.build_regex_from_schema(
-                    schema_json
-                )
-
-                from outlines.processors import RegexLogitsProcessor
-
-                logits_processor = RegexLogitsProcessor(
-                    regex_str,
-                    tokenizer=self._tokenizer_for_outlines,  # type: ignore
+                logits_processor = get_guide_cache().logits_processor(
+                    schema, self._tokenizer_for_outlines
                 )
                 sampling_params.logits_processors = (
                     [logits_processor] if logits_processor is not None else []
@@ -307,54 +339,76 @@ class LocalVLLMBackend(FormatterBackend):
             # stream = model_options.get(ModelOption.STREAM, False)
             # if stream:
 
-            output = ModelOutputThunk(None)
+            outputs = [ModelOutputThunk(None) for _ in range(n)]
 
             generator = self._model.generate(  # type: ignore
-                request_id=str(id(output)),
+                request_id=str(id(outputs[0])),
                 prompt=input_str,
                 sampling_params=sampling_params,
             )  # type: ignore
 
-            output._context = ctx.view_for_generation()
-            output._action = action
-            output._model_options = model_options
+            responses: list[Any] = [generator]
+            if n > 1:
+                # The request returns all samples in its final output; each ModelOutputThunk awaits its own sample.
+                final_output = asyncio.create_task(_final_output(generator))
+                responses = [_get_sample(final_output, i) for i in range(n)]
 
-            output._process = self.processing
-            output._post_process = functools.partial(
-                self.post_processing,
-                conversation=ctx_as_chat,
-                tool_calls=tool_calls,
-                tools=tools,
-                seed=model_options.get(ModelOption.SEED, None),
-            )
+            for output, response in zip(outputs, responses):
+                output._context = ctx.view_for_generation()
+                output._action = action
+                output._model_options = model_options
 
-            try:
-                # This function should always be called from a running event loop so we don't have to worry about
-                # scheduling the task to a specific event loop here.
-                output._generate = asyncio.create_task(
-                    send_to_queue(generator, output._async_queue)  # type: ignore
+                # Only scan for tools if we are not doing structured output and tool calls were provided to the model.
+                tool_parser = (
+                    StreamingToolCalls(tools) if format is None and tool_calls else None
+                )
+                output._process = functools.partial(
+                    self.processing, tool_parser=tool_parser
                 )
-                output._generate_type = GenerateType.ASYNC
-            except RuntimeError as e:
-                # Most likely cause is running this function without an event loop present.
-                raise e
+                output._post_process = functools.partial(
+                    self.post_processing,
+                    conversation=ctx_as_chat,
+                    tool_parser=tool_parser,
+                    tools=tools,
+                    seed=model_options.get(ModelOption.SEED, None),
+                )
+
+                try:
+                    # This function should always be called from a running event loop so we don't have to worry about
+                    # scheduling the task to a specific event loop here.
+                    output._generate = asyncio.create_task(
+                        send_to_queue(response, output._async_queue)  # type: ignore
+                    )
+                    output._generate_type = GenerateType.ASYNC
+                except RuntimeError as e:
+                    # Most likely cause is running this function without an event loop present.
+                    raise e
 
-            return output
+            return outputs
 
         else:
             raise Exception("Does not yet support non-chat contexts.")
 
-    async def processing(self, mot: ModelOutputThunk, chunk: vllm.RequestOutput):
+    async def processing(
+        self,
+        mot: ModelOutputThunk,
+        chunk: vllm.RequestOutput,
+        tool_parser: StreamingToolCalls | None = None,
+    ):
         """Process the returned chunks or the complete response."""
         if mot._underlying_value is None:
             mot._underlying_value = ""
         mot._underlying_value += chunk.outputs[0].text
 
+        # Tool calls are available as soon as their json is complete, before the rest of the response is generated.
+        if tool_parser is not None and len(tool_parser.feed(chunk.outputs[0].text)) > 0:
+            mot.tool_calls = dict(tool_parser.tool_calls)
+
     async def post_processing(
         self,
         mot: ModelOutputThunk,
         conversation: list[dict],
-        tool_calls: bool,
+        tool_parser: StreamingToolCalls | None,
         tools: dict[str, Callable],
         seed,
     ):
@@ -362,9 +416,8 @@ class LocalVLLMBackend(FormatterBackend):
         # The ModelOutputThunk must be computed by this point.
         assert mot.value is not None
 
-        # Only scan for tools if we are not doing structured output and tool calls were provided to the model.
-        if format is None and tool_calls:
-            mot.tool_calls = to_tool_calls(tools, mot.value)
+        if tool_parser is not None:
+            mot.tool_calls = tool_parser.finish()
 
         assert mot._action is not None, (
             "ModelOutputThunks should have their action assigned during generation"
@@ -415,16 +468,8 @@ class LocalVLLMBackend(FormatterBackend):
 
         if format is not None:
             schema: dict[str, Any] = format.model_json_schema()
-            schema_json: str = json.dumps(schema)
-            regex_str: str = outlines_core.fsm.json_schema.build_regex_from_schema(
-                schema_json
-            )
-
-            from outlines.processors import RegexLogitsProcessor
-
-            logits_processor = RegexLogitsProcessor(
-                regex_str,
-                tokenizer=self._tokenizer_for_outlines,  # type: ignore
+            logits_processor = get_guide_cache().logits_processor(
+                schema, self._tokenizer_for_outlines
             )
             sampling_params.logits_processors = (
                 [logits_processor] if logits_processor is not None else []
@@ -533,3 +578,23 @@ class LocalVLLMBackend(FormatterBackend):
                 for field in msgspec.structs.fields(cls)
                 if field.name in backend_specific
             }
+
+
+async def _final_output(
+    generator: AsyncIterator[vllm.RequestOutput],
+) -> vllm.RequestOutput:
+    """Returns the last output of a request."""
+    final_output = None
+    async for final_output in generator:
+        pass
+    assert final_output is not None and final_output.finished
+    return final_output
+
+
+async def _get_sample(
+    request_output: Awaitable[vllm.RequestOutput], i: int
+) -> vllm.RequestOutput:
+    """Returns a copy of the request output that only holds its `i`-th sample."""
+    sample = copy.copy(await request_output)
+    sample.outputs = [o for o in sample.outputs if o.index == i]
+    return sample
@@ -18,6 +18,7 @@ from mellea.backends import BaseModelSubclass, model_ids
 from mellea.backends.formatter import Formatter, FormatterBackend, TemplateFormatter
 from mellea.backends.model_ids import ModelIdentifier
 from mellea.backends.tools import (
+    add_tools_from_context,
     add_tools_from_context_actions,
     add_tools_from_model_options,
     convert_tools_to_json,
@@ -315,7 +316,7 @@ class WatsonxAIBackend(FormatterBackend):
                 )
             else:
                 add_tools_from_model_options(tools, model_opts)
-                add_tools_from_context_actions(tools, ctx.actions_for_available_tools())
+                add_tools_from_context(tools, ctx)
 
                 # Add the tools from the action for this generation last so that
                 # they overwrite conflicting names.
@@ -1,11 +1,12 @@
 """Async helper functions."""
 
 import asyncio
+import dataclasses
 from collections import OrderedDict
-from collections.abc import AsyncIterator, Coroutine
+from collections.abc import AsyncIterator, Awaitable, Coroutine, Sequence
 from typing import Any, TypeVar
 
-from mellea.stdlib.base import ModelOutputThunk
+from mellea.stdlib.base import CBlock, Component, GenerateType, ModelOutputThunk
 
 
 async def send_to_queue(
@@ -49,6 +50,108 @@ async def wait_for_all_mots(mots: list[ModelOutputThunk]):
     await asyncio.gather(*coroutines)
 
 
+async def get_item(batch: Awaitable[Sequence], i: int) -> Any:
+    """Awaits a batched result and returns its `i`-th item.
+
+    Lets several ModelOutputThunks share a single batched request; each thunk's `_generate` awaits its own item.
+    """
+    return (await batch)[i]
+
+
+class ModelOutputThunkRelay:
+    """Relays the output of one ModelOutputThunk to any number of new ModelOutputThunks.
+
+    The source is consumed exactly once, by `consume`, and its value is published in chunks as it grows. Every ModelOutputThunk returned by `subscribe` streams all chunks (including the ones published before it subscribed) and gets a copy of the source's result once the relay is finished. This lets several callers share a single request, and lets a backend wrapper observe a request (e.g., its latency or errors) without competing with the caller for the source's chunks.
+    """
+
+    def __init__(self, source: ModelOutputThunk):
+        """Creates a relay for `source`, which must not be consumed by anything else."""
+        self.source = source
+        self.chunks: list[str] = []
+        self.done = False
+        self.error: Exception | None = None
+
+        # The task driving the relay, if any. Holding the reference keeps the task from being garbage collected.
+        self.task: asyncio.Task | None = None
+        self._updated = asyncio.Event()
+
+    async def consume(self):
+        """Consumes the source and publishes its value as it grows. Raises the source's error if generation fails.
+
+        The source may be replaced (e.g., by a retry) before calling `consume` again, as long as no chunks have been published.
+        """
+        published = sum(len(c) for c in self.chunks)
+        while not self.source.is_computed():
+            await self.source.astream()
+            value = self.source._underlying_value or ""
+            if len(value) > published:
+                self.chunks.append(value[published:])
+                published = len(value)
+                self._notify()
+
+    def finish(self, error: Exception | None = None):
+        """Ends the streams of all subscribers, either successfully or with `error`."""
+        self.error = error
+        self.done = True
+        self._notify()
+
+    def subscribe(
+        self,
+        action: Component | CBlock,
+        context: list[Component | CBlock] | None,
+        model_options: dict[str, Any] | None,
+    ) -> ModelOutputThunk:
+        """Returns a new ModelOutputThunk that streams the source's value. Must be called from a running event loop."""
+        mot = ModelOutputThunk(None)
+        mot._context = context
+        mot._action = action
+        mot._model_options = model_options
+
+        mot._process = _append_chunk
+        mot._post_process = self._copy_result
+        mot._generate = asyncio.create_task(
+            send_to_queue(self._stream(), mot._async_queue)
+        )
+        mot._generate_type = GenerateType.ASYNC
+        return mot
+
+    def _notify(self):
+        updated, self._updated = self._updated, asyncio.Event()
+        updated.set()
+
+    async def _stream(self) -> AsyncIterator[str]:
+        i = 0
+        while True:
+            updated = self._updated
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await updated.wait()
+
+    async def _copy_result(self, mot: ModelOutputThunk):
+        """Copies the result of the source's post processing."""
+        source = self.source
+        mot._underlying_value = source._underlying_value
+        mot._meta.update(source._meta)
+        mot.tool_calls = source.tool_calls
+        mot._thinking = source._thinking
+        mot.parsed_repr = source.parsed_repr
+        if source._generate_log is not None:
+            mot._generate_log = dataclasses.replace(
+                source._generate_log, action=mot._action, result=mot
+            )
+
+
+async def _append_chunk(mot: ModelOutputThunk, chunk: str):
+    if mot._underlying_value is None:
+        mot._underlying_value = ""
+    mot._underlying_value += chunk
+
+
 def get_current_event_loop() -> None | asyncio.AbstractEventLoop:
     """Get the current event loop without having to catch exceptions."""
     loop = None
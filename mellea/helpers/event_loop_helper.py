@@ -1,26 +1,69 @@
-"""Helper for event loop management. Allows consistently running async generate requests in sync code."""
+"""Helper for event loop management. Allows consistently running async generate requests in sync code.
+
+Sync calls that are made from code that already runs on Mellea's event loop (e.g., a sync `m.instruct` inside a tool or validator) can't wait on that loop without blocking it. They run on a nested loop instead: every nesting level has one event loop and thread that are created on first use and reused afterwards, so re-entrant calls neither spawn new threads nor lose the clients that backends cache per event loop. Nesting is limited to `MAX_NESTING_DEPTH` levels. Functions that code on an event loop runs in a worker thread (e.g., sync tools) can be bound to that loop with `_bind_to_calling_loop`, so that their sync calls are nested in the same way.
+"""
 
 import asyncio
+import concurrent.futures
+import contextvars
 import threading
-from collections.abc import Coroutine
+from collections.abc import Callable, Coroutine
+from dataclasses import dataclass
 from typing import Any, TypeVar
 
 from mellea.helpers.async_helpers import get_current_event_loop
 
 R = TypeVar("R")
 
+MAX_NESTING_DEPTH = 8
+"""The maximum number of nested event loops, i.e., how deep sync calls can be nested inside code that runs on Mellea's event loop."""
+
+_calling_loop: contextvars.ContextVar[asyncio.AbstractEventLoop | None] = (
+    contextvars.ContextVar("_calling_loop", default=None)
+)
+"""The event loop that a worker thread runs a function for; see `_bind_to_calling_loop`."""
+
+
+@dataclass
+class EventLoopStats:
+    """The event loops and threads that run Mellea's async code for sync callers."""
+
+    loops: int
+    """The number of event loops: the shared loop plus one per nesting level that has been used."""
+
+    threads: int
+    """The number of threads that run the event loops."""
+
+    calls: int
+    """The total number of coroutines run for sync callers."""
+
+    nested_calls: int
+    """The number of those calls that were made from code running on one of the event loops."""
+
 
 class _EventLoopHandler:
     """A class that handles the event loop for Mellea code. Do not directly instantiate this. Use `_run_async_in_thread`."""
 
-    def __init__(self):
+    def __init__(self, depth: int = 0):
         """Instantiates an EventLoopHandler. Used to ensure consistency when calling async code from sync code in Mellea.
 
         Do not instantiate this class. Rely on the exported `_run_async_in_thread` function.
+
+        Args:
+            depth: the nesting level of the handler's loop; 0 for the shared loop.
         """
+        self._depth = depth
+        self._nested: _EventLoopHandler | None = None
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._nested_calls = 0
+        self._closed = False
+
         self._event_loop = asyncio.new_event_loop()
         self._thread: threading.Thread = threading.Thread(
-            target=self._event_loop.run_forever, daemon=True
+            target=self._event_loop.run_forever,
+            daemon=True,
+            name=f"mellea-event-loop-{depth}",
         )
         self._thread.start()
 
@@ -29,7 +72,12 @@ class _EventLoopHandler:
         self._close_event_loop()
 
     def _close_event_loop(self) -> None:
-        """Called when deleting the event loop handler. Cleans up the event loop and thread."""
+        """Called when deleting the event loop handler. Cleans up the event loop and thread, and those of the nested handlers."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._nested is not None:
+            self._nested._close_event_loop()
         if self._event_loop:
             try:
                 tasks = asyncio.all_tasks(self._event_loop)
@@ -50,14 +98,70 @@ class _EventLoopHandler:
                 pass
 
             # Finally stop the event loop for this session.
-            self._event_loop.stop()
+            self._event_loop.call_soon_threadsafe(self._event_loop.stop)
 
     def __call__(self, co: Coroutine[Any, Any, R]) -> R:
-        """Runs the coroutine in the event loop."""
-        if self._event_loop == get_current_event_loop():
-            # If this gets called from the same event loop, launch in a separate thread to prevent blocking.
-            return _EventLoopHandler()(co)
-        return asyncio.run_coroutine_threadsafe(co, self._event_loop).result()
+        """Runs the coroutine in the event loop and waits for its result.
+
+        If this gets called from one of the handler's loops, the coroutine runs on the next nested loop instead to prevent blocking.
+        """
+        try:
+            handler = self._handler_for(get_current_event_loop() or _calling_loop.get())
+        except RuntimeError:
+            co.close()
+            raise
+        self._count(nested=handler is not self)
+        return asyncio.run_coroutine_threadsafe(co, handler._event_loop).result()
+
+    def submit(self, co: Coroutine[Any, Any, R]) -> concurrent.futures.Future[R]:
+        """Schedules the coroutine in the event loop without waiting for it."""
+        self._count(nested=False)
+        return asyncio.run_coroutine_threadsafe(co, self._event_loop)
+
+    def _count(self, nested: bool):
+        with self._lock:
+            self._calls += 1
+            if nested:
+                self._nested_calls += 1
+
+    def _handler_for(
+        self, current_loop: asyncio.AbstractEventLoop | None
+    ) -> "_EventLoopHandler":
+        """Returns the handler whose loop runs coroutines for a sync caller on `current_loop`: the next nested handler if `current_loop` is one of this handler's loops, otherwise this handler."""
+        if current_loop is None:
+            return self
+        handler: _EventLoopHandler | None = self
+        while handler is not None:
+            if handler._event_loop is current_loop:
+                return handler._nested_handler()
+            handler = handler._nested
+        # Not one of our loops (e.g., the caller's own `asyncio.run`); waiting on the shared loop doesn't block it.
+        return self
+
+    def _nested_handler(self) -> "_EventLoopHandler":
+        """Returns the handler of the next nesting level, creating it on first use."""
+        with self._lock:
+            if self._nested is None:
+                if self._depth + 1 >= MAX_NESTING_DEPTH:
+                    raise RuntimeError(
+                        f"Sync Mellea calls are nested more than {MAX_NESTING_DEPTH} levels deep inside async code. Use the async interface (e.g., `ainstruct`) inside tools and validators that are called from async code."
+                    )
+                self._nested = _EventLoopHandler(self._depth + 1)
+            return self._nested
+
+    def stats(self) -> EventLoopStats:
+        """Returns the number of event loops, threads and calls of this handler and its nested handlers."""
+        handlers = []
+        handler: _EventLoopHandler | None = self
+        while handler is not None:
+            handlers.append(handler)
+            handler = handler._nested
+        return EventLoopStats(
+            loops=len(handlers),
+            threads=sum(h._thread.is_alive() for h in handlers),
+            calls=self._calls,
+            nested_calls=self._nested_calls,
+        )
 
 
 # Instantiate this class once. It will not be re-instantiated.
@@ -88,4 +192,52 @@ def _run_async_in_thread(co: Coroutine[Any, Any, R]) -> R:
     return __event_loop_handler(co)
 
 
-__all__ = ["_run_async_in_thread"]
+def _submit_async_in_thread(co: Coroutine[Any, Any, R]) -> concurrent.futures.Future[R]:
+    """Like `_run_async_in_thread`, but doesn't wait for the coroutine to finish.
+
+    Use this to start background work (e.g., summarizing a long history) from synchronous code on the same event loop as the other requests.
+
+    Args:
+        co: coroutine to run
+
+    Returns:
+        a future for the output of the coroutine
+    """
+    return __event_loop_handler.submit(co)
+
+
+def _bind_to_calling_loop(func: Callable[[], R]) -> Callable[[], R]:
+    """Binds a function that is about to run in a worker thread to the current event loop.
+
+    The worker thread has no event loop, so sync Mellea calls made by `func` would wait on the shared loop, which deadlocks if the shared loop is blocked by a sync call further up the stack (e.g., a sync tool that calls `m.instruct`, called by `_call_tools` from code on the shared loop). Bound functions make their sync calls like code on the calling loop, i.e., on the next nested loop.
+
+    Args:
+        func: the function to run in the worker thread.
+
+    Returns:
+        a function that runs `func` on behalf of the current event loop.
+    """
+    loop = get_current_event_loop()
+
+    def run() -> R:
+        token = _calling_loop.set(loop)
+        try:
+            return func()
+        finally:
+            _calling_loop.reset(token)
+
+    return run
+
+
+def event_loop_stats() -> EventLoopStats:
+    """Returns the number of event loops and threads that run Mellea's async code for sync callers, and how many calls they ran."""
+    return __event_loop_handler.stats()
+
+
+__all__ = [
+    "EventLoopStats",
+    "_bind_to_calling_loop",
+    "_run_async_in_thread",
+    "_submit_async_in_thread",
+    "event_loop_stats",
+]
@@ -5,8 +5,6 @@ import logging
 import os
 import sys
 
-import requests
-
 
 class RESTHandler(logging.Handler):
     """RESTHandler for logging."""
@@ -21,6 +19,9 @@ class RESTHandler(logging.Handler):
     def emit(self, record):
         """Attempts to emit a record to FLOG, or silently fails."""
         if os.environ.get("FLOG"):
+            # Imported here because it is slow to import and only needed to send logs.
+            import requests
+
             log_data = self.format(record)
             try:
                 response = requests.request(
@@ -0,0 +1,135 @@
+"""Helpers for compiling jinja2 templates.
+
+Parsing and compiling a jinja2 template to python code takes far longer than rendering it. Inline templates (`TemplateRepresentation.template`) and the user variables of an `Instruction` are rendered from source strings that rarely change, so they are compiled once and kept in a bounded cache that is shared by the whole process.
+
+Template files can also be compiled ahead of time into a bytecode cache with `m templates compile` (see `compile_templates`). Template environments load from that cache when its directory exists, so new processes don't compile templates in their first requests.
+"""
+
+import functools
+import os
+from collections.abc import Iterable
+from typing import Any
+
+import jinja2
+
+from mellea.helpers.fancy_logger import FancyLogger
+
+TEMPLATE_CACHE_DIR_ENV = "MELLEA_TEMPLATE_CACHE_DIR"
+"""The environment variable that overrides the directory of the template bytecode cache."""
+
+TEMPLATE_CACHE_SIZE = 512
+"""The number of compiled templates that `compile_template` keeps."""
+
+
+@functools.cache
+def _environment(options: tuple[tuple[str, Any], ...]) -> jinja2.Environment:
+    """Returns the shared environment for a set of environment options."""
+    return jinja2.Environment(**dict(options))
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _compile(source: str, options: tuple[tuple[str, Any], ...]) -> jinja2.Template:
+    return _environment(options).from_string(source)
+
+
+def compile_template(source: str, **options: Any) -> jinja2.Template:
+    """Returns the compiled template for `source`. Templates are cached by their source and environment options; rendering a cached template is safe from multiple threads.
+
+    Args:
+        source: the template source.
+        options: keyword arguments for the `jinja2.Environment` that compiles the template. Must be hashable.
+    """
+    return _compile(source, tuple(sorted(options.items())))
+
+
+def template_cache_info() -> functools._CacheInfo:
+    """Returns the hits, misses and size of the compiled template cache."""
+    return _compile.cache_info()
+
+
+def clear_template_cache():
+    """Removes all compiled templates from the cache."""
+    _compile.cache_clear()
+
+
+class TemplateBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """A bytecode cache in a directory of compiled templates.
+
+    Templates that aren't in the cache yet are added to it when they are compiled. If the directory isn't writable (e.g., it is part of a read-only image), they are compiled without being added.
+    """
+
+    def dump_bytecode(self, bucket: jinja2.bccache.Bucket):
+        """Adds a compiled template to the cache if the directory is writable."""
+        try:
+            super().dump_bytecode(bucket)
+        except OSError as e:
+            FancyLogger.get_logger().debug(
+                f"could not add template {bucket.key} to the bytecode cache: {e}"
+            )
+
+
+def default_template_cache_dir() -> str:
+    """Returns the directory of the template bytecode cache: `$MELLEA_TEMPLATE_CACHE_DIR`, or `mellea/templates` in the user's cache directory."""
+    cache_dir = os.environ.get(TEMPLATE_CACHE_DIR_ENV, "")
+    if cache_dir != "":
+        return cache_dir
+    cache_home = os.environ.get("XDG_CACHE_HOME", "") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(cache_home, "mellea", "templates")
+
+
+def default_bytecode_cache() -> TemplateBytecodeCache | None:
+    """Returns the template bytecode cache if its directory exists (see `default_template_cache_dir`), or `None`."""
+    cache_dir = default_template_cache_dir()
+    if not os.path.isdir(cache_dir):
+        return None
+    return TemplateBytecodeCache(cache_dir)
+
+
+def template_environment(
+    loader: jinja2.BaseLoader, bytecode_cache: jinja2.BytecodeCache | None = None
+) -> jinja2.Environment:
+    """Returns a new environment for the template files of `loader`.
+
+    The options of the environment must be the same when templates are compiled ahead of time and when they are loaded; otherwise the compiled templates don't match.
+    """
+    return jinja2.Environment(
+        loader=loader,
+        autoescape=jinja2.select_autoescape(),
+        bytecode_cache=bytecode_cache,
+    )
+
+
+def compile_templates(
+    template_dirs: Iterable[str] = (),
+    *,
+    packages: Iterable[str] = ("mellea",),
+    cache_dir: str | None = None,
+) -> list[str]:
+    """Compiles template files ahead of time into a bytecode cache.
+
+    Args:
+        template_dirs: template directories, as passed to `TemplateFormatter(template_path=...)`.
+        packages: packages whose `templates` directory is compiled.
+        cache_dir: the directory of the bytecode cache; defaults to `default_template_cache_dir()`. It is created if it doesn't exist.
+
+    Returns:
+        the file names of the compiled templates.
+    """
+    if cache_dir is None:
+        cache_dir = default_template_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+
+    loaders: list[jinja2.BaseLoader] = [jinja2.PackageLoader(p) for p in packages]
+    loaders.extend(jinja2.FileSystemLoader(d) for d in template_dirs)
+
+    compiled = []
+    for loader in loaders:
+        env = template_environment(loader, bytecode_cache)
+        for name in env.list_templates(extensions=["jinja2"]):
+            template = env.get_template(name)
+            assert template.filename is not None
+            compiled.append(template.filename)
+    return compiled
@@ -6,15 +6,20 @@ import abc
 import asyncio
 import base64
 import binascii
+import concurrent.futures
 import datetime
 import enum
-from collections.abc import Callable, Coroutine, Iterable, Mapping
+import functools
+import inspect
+import sys
+from collections.abc import Callable, Coroutine, Hashable, Iterable, Mapping
 from copy import copy, deepcopy
 from dataclasses import dataclass
 from io import BytesIO
-from typing import Any, Protocol, TypeVar, runtime_checkable
+from typing import TYPE_CHECKING, Any, Protocol, TypeGuard, TypeVar, runtime_checkable
 
-from PIL import Image as PILImage
+if TYPE_CHECKING:
+    from PIL import Image as PILImage
 
 from mellea.helpers.fancy_logger import FancyLogger
 
@@ -90,6 +95,13 @@ class ImageBlock:
         except (binascii.Error, ValueError):
             return False
 
+    @staticmethod
+    def is_pil_image(obj: Any) -> TypeGuard[PILImage.Image]:
+        """Checks if `obj` is a PIL image without importing PIL."""
+        # A PIL image can only exist if PIL has already been imported.
+        pil_image = sys.modules.get("PIL.Image", None)
+        return pil_image is not None and isinstance(obj, pil_image.Image)
+
     @staticmethod
     def pil_to_base64(image: PILImage.Image) -> str:
         """Converts a PIL image to a base64 string representation."""
@@ -130,6 +142,53 @@ class Component(Protocol):
         raise NotImplementedError("format_for_llm isn't implemented by default")
 
 
+class VersionedComponent(Component):
+    """A `Component` that counts the changes to its attributes.
+
+    Every assignment to an attribute of the component increments its version, so formatters can reuse the rendering of the component until it changes. Call `mark_changed` after changing the component in place in other ways (e.g., appending to a list attribute).
+    """
+
+    _version: int = 0
+
+    def __setattr__(self, name: str, value: Any):
+        """Sets the attribute and increments the version of the component."""
+        object.__setattr__(self, "_version", self._version + 1)
+        object.__setattr__(self, name, value)
+
+    def mark_changed(self):
+        """Increments the version of the component so that its rendering isn't reused."""
+        object.__setattr__(self, "_version", self._version + 1)
+
+    def version(self) -> Hashable | None:
+        """Returns a value that changes whenever the rendering of the component may change, or `None` if that isn't known. Override this if the rendering depends on other mutable objects."""
+        return self._version
+
+
+def render_version(c: Any) -> Hashable | None:
+    """Returns a value that changes whenever the rendering of `c` may change, or `None` if `c` can change without notice.
+
+    Strings and `CBlock`s are versioned by their value, computed `ModelOutputThunk`s by their value and parsed representation, and `VersionedComponent`s by their `version`. Formatters only reuse the renderings of objects with a version.
+    """
+    match c:
+        case str():
+            return c
+        case ModelOutputThunk():
+            if not c.is_computed():
+                return None
+            if c.parsed_repr is None or c.parsed_repr is c:
+                return c.value
+            parsed = render_version(c.parsed_repr)
+            if parsed is None:
+                return None
+            return (c.value, id(c.parsed_repr), parsed)
+        case CBlock():
+            return c.value
+        case VersionedComponent():
+            return c.version()
+        case _:
+            return None
+
+
 def get_images_from_component(c: Component) -> None | list[ImageBlock]:
     """Gets images from a `Component` if they are present and a non-empty list, otherwise returns None."""
     if hasattr(c, "images"):
@@ -397,6 +456,33 @@ class ContextTurn:
 ContextT = TypeVar("ContextT", bound="Context")
 
 
+class _LinearizedHistory:
+    """Append-only storage for the linearized components of a context chain.
+
+    Contexts are immutable, so a context node only ever needs a prefix of this list. A node that extends the
+    current tip of the list shares it with its previous node; a node that branches off from the middle of a chain
+    copies the prefix it needs. This makes adding to a context and linearizing it O(1) amortized (plus the size of the returned list).
+    """
+
+    __slots__ = ("items", "positions")
+
+    def __init__(self, items: list[Component | CBlock] | None = None):
+        """Initializes the history, optionally with a list of components."""
+        self.items: list[Component | CBlock] = items if items is not None else []
+
+        # Key: id(component) -> Value: index in items. Used for O(1) identity checks.
+        self.positions: dict[int, int] = {id(c): i for i, c in enumerate(self.items)}
+
+    def prefix(self, length: int) -> _LinearizedHistory:
+        """Returns a new history containing only the first `length` components."""
+        return _LinearizedHistory(self.items[:length])
+
+    def append(self, c: Component | CBlock):
+        """Appends a component to the history."""
+        self.positions[id(c)] = len(self.items)
+        self.items.append(c)
+
+
 class Context(abc.ABC):
     """A `Context` is used to track the state of a `MelleaSession`.
 
@@ -408,11 +494,17 @@ class Context(abc.ABC):
     _is_root: bool
     _is_chat_context: bool = True
 
+    # The linearized components of this context are `_history.items[:_length]`.
+    _history: _LinearizedHistory
+    _length: int
+
     def __init__(self):
         """Constructs a new root context with no content."""
         self._previous = None
         self._data = None
         self._is_root = True
+        self._history = _LinearizedHistory()
+        self._length = 0
 
     # factory functions below this line.
 
@@ -426,11 +518,24 @@ class Context(abc.ABC):
         )
         assert data is not None, "Cannot create a new context from None data."
 
+        # Share the previous node's history if it's at the tip. Otherwise, we are branching
+        # and need our own copy of the prefix.
+        history = previous._history
+        if len(history.items) != previous._length:
+            history = history.prefix(previous._length)
+
+        assert id(data) not in history.positions, (
+            "There might be a cycle in the context tree. That is not allowed."
+        )
+        history.append(data)
+
         x = cls()
         x._previous = previous
         x._data = data
         x._is_root = False
         x._is_chat_context = previous._is_chat_context
+        x._history = history
+        x._length = previous._length + 1
         return x
 
     @classmethod
@@ -466,6 +571,11 @@ class Context(abc.ABC):
         """Returns whether this context is a chat context."""
         return self._is_chat_context
 
+    @property
+    def length(self) -> int:
+        """Returns the number of components in this context."""
+        return self._length
+
     # User functions below this line.
 
     def as_list(self, last_n_components: int | None = None) -> list[Component | CBlock]:
@@ -473,28 +583,10 @@ class Context(abc.ABC):
 
         If `last_n_components` is `None`, then all components are returned.
         """
-        context_list: list[Component | CBlock] = []
-        current_context: Context = self
-
-        last_n_count = 0
-        while not current_context.is_root_node and (
-            last_n_components is None or last_n_count < last_n_components
-        ):
-            data = current_context.node_data
-            assert data is not None, "Data cannot be None (except for root context)."
-            assert data not in context_list, (
-                "There might be a cycle in the context tree. That is not allowed."
-            )
-            context_list.append(data)
-            last_n_count += 1
-
-            current_context = current_context.previous_node  # type: ignore
-            assert current_context is not None, (
-                "Previous context cannot be None (except for root context)."
-            )
-
-        context_list.reverse()
-        return context_list
+        start = 0
+        if last_n_components is not None:
+            start = max(0, self._length - last_n_components)
+        return self._history.items[start : self._length]
 
     def actions_for_available_tools(self) -> list[Component | CBlock] | None:
         """Provides a list of actions to extract tools from for use with during generation, or None if that's not possible.
@@ -627,3 +719,23 @@ class ModelToolCall:
     def call_func(self) -> Any:
         """A helper function for calling the function/tool represented by this object."""
         return self.func(**self.args)
+
+    async def acall_func(
+        self, executor: concurrent.futures.Executor | None = None
+    ) -> Any:
+        """Calls the function/tool without blocking the event loop.
+
+        Coroutine functions are awaited directly. Other functions run in `executor` (the event loop's default executor if `None`); sync Mellea calls that they make are nested inside the calling event loop, like calls from code that runs on it.
+        """
+        from mellea.helpers.event_loop_helper import _bind_to_calling_loop
+
+        if inspect.iscoroutinefunction(self.func):
+            return await self.func(**self.args)
+
+        output = await asyncio.get_running_loop().run_in_executor(
+            executor, _bind_to_calling_loop(functools.partial(self.func, **self.args))
+        )
+        if inspect.isawaitable(output):
+            # E.g., a callable object with an async `__call__`.
+            output = await output
+        return output
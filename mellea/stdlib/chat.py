@@ -12,10 +12,11 @@ from mellea.stdlib.base import (
     ModelOutputThunk,
     ModelToolCall,
     TemplateRepresentation,
+    VersionedComponent,
 )
 
 
-class Message(Component):
+class Message(VersionedComponent):
     """A single Message in a Chat history."""
 
     Role = Literal["system", "user", "assistant", "tool"]
@@ -0,0 +1,271 @@
+"""Rolling summarization of long chat histories.
+
+Every turn of a `ChatContext` re-sends the whole history, so the prompt grows with every turn and the total cost of a session grows quadratically. A `HistoryCompactor` keeps the prompt size roughly constant: once the history exceeds a threshold, the oldest components are summarized into a single `HistorySummary` that replaces them in a new context. Earlier summaries are summarized again together with the next oldest components, so the summary rolls forward with the conversation.
+
+Summaries are generated in the background (optionally with a cheaper backend) and applied on a later turn, so compaction never delays a turn.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import dataclasses
+from collections.abc import Callable, Sequence
+from dataclasses import dataclass
+
+from mellea.backends import Backend
+from mellea.backends.formatter import FormatterBackend, TemplateFormatter
+from mellea.helpers.async_helpers import get_current_event_loop
+from mellea.helpers.event_loop_helper import _submit_async_in_thread
+from mellea.helpers.fancy_logger import FancyLogger
+from mellea.stdlib.base import (
+    CBlock,
+    Component,
+    Context,
+    GenerateLog,
+    ModelOutputThunk,
+    SimpleContext,
+)
+from mellea.stdlib.chat import Message
+from mellea.stdlib.context_window import ComponentTokenCounter, default_pinned
+
+DEFAULT_SUMMARY_INSTRUCTION = "Summarize the following conversation. Keep all facts, decisions, names, numbers and open questions that later turns may refer to. Answer with the summary only."
+
+
+class HistorySummary(Message):
+    """A summary of earlier components of a conversation that replaces them in the context."""
+
+    def __init__(
+        self, summary: str, *, summarized: int, generate_log: GenerateLog | None = None
+    ):
+        """Initializes the summary message.
+
+        Args:
+            summary: the summary text.
+            summarized: the number of components that the summary replaced.
+            generate_log: the log of the request that generated the summary.
+        """
+        super().__init__("system", f"Summary of the earlier conversation:\n{summary}")
+        self.summary = summary
+        self.summarized = summarized
+        self.generate_log = generate_log
+
+
+@dataclass
+class _PendingSummary:
+    prefix: list[Component | CBlock]
+    future: asyncio.Future | concurrent.futures.Future
+
+
+class HistoryCompactor:
+    """Summarizes the oldest components of a context once it exceeds a threshold.
+
+    `compact` never blocks: it starts summarizing in the background and applies a finished summary when it is called again, as long as the summarized components are still the oldest components of the context. `MelleaSession(..., compactor=...)` calls `compact` whenever its context changes.
+
+    A compactor keeps the summary in progress for the context of one session; `MelleaSession.clone` gives the clone a copy of the compactor, and a copy applies the summary in progress to its own context too.
+
+    Every applied summary is counted in `compactions`. The `GenerateLog` of the summarization request is kept in `last_log` and in the `HistorySummary`; its `extra["compaction"]` records the number of summarized components and the token counts before and after compaction.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_components: int | None = 20,
+        max_tokens: int | None = None,
+        summarize_oldest: int = 10,
+        backend: Backend | None = None,
+        model_options: dict | None = None,
+        instruction: str = DEFAULT_SUMMARY_INSTRUCTION,
+        token_counter: ComponentTokenCounter | None = None,
+        pinned: Callable[[Sequence[Component | CBlock]], list[int]] = default_pinned,
+    ):
+        """Initializes the compactor.
+
+        Args:
+            max_components: compact once the history has more components than this.
+            max_tokens: compact once the history has more tokens than this (counted with `token_counter`).
+            summarize_oldest: the number of oldest (unpinned) components to summarize at once.
+            backend: the backend that writes the summaries, e.g., a smaller model; defaults to the session's backend.
+            model_options: model options for the summarization requests.
+            instruction: the instruction that precedes the summarized conversation.
+            token_counter: counts the tokens of the history for `max_tokens`.
+            pinned: returns the indices of the components that are never summarized; defaults to system messages and the first instruction.
+        """
+        self.max_components = max_components
+        self.max_tokens = max_tokens
+        self.summarize_oldest = summarize_oldest
+        self.backend = backend
+        self.model_options = model_options
+        self.instruction = instruction
+        self.token_counter = (
+            token_counter if token_counter is not None else ComponentTokenCounter()
+        )
+        self.pinned = pinned
+
+        self.compactions = 0
+        self.last_log: GenerateLog | None = None
+        self._pending: _PendingSummary | None = None
+
+    def needs_compaction(self, ctx: Context) -> bool:
+        """Returns whether the history of `ctx` exceeds the threshold."""
+        if isinstance(ctx, SimpleContext):
+            # Its history isn't used for generation.
+            return False
+        if self.max_components is not None and ctx.length > self.max_components:
+            return True
+        if self.max_tokens is not None:
+            tokens = sum(self.token_counter.count(c) for c in ctx.as_list())
+            return tokens > self.max_tokens
+        return False
+
+    def compact(self, ctx: Context, backend: Backend) -> Context:
+        """Applies a finished summary to `ctx` and starts summarizing if `ctx` exceeds the threshold. Never blocks.
+
+        Args:
+            ctx: the current context.
+            backend: the backend that writes the summary unless the compactor has its own.
+
+        Returns:
+            the compacted context, or `ctx` if there is no finished summary that applies to it.
+        """
+        if self._pending is not None and self._pending.future.done():
+            pending, self._pending = self._pending, None
+            try:
+                summary = pending.future.result()
+            except Exception as e:
+                FancyLogger.get_logger().warning(
+                    f"Summarizing the context history failed: {e}"
+                )
+            else:
+                ctx = self._apply(ctx, pending.prefix, summary)
+
+        if self._pending is None and self.needs_compaction(ctx):
+            prefix = self._prefix(ctx.as_list())
+            if prefix is not None:
+                co = self._summarize(prefix, backend)
+                future: asyncio.Future | concurrent.futures.Future = (
+                    asyncio.ensure_future(co)
+                    if get_current_event_loop() is not None
+                    else _submit_async_in_thread(co)
+                )
+                self._pending = _PendingSummary(prefix, future)
+        return ctx
+
+    async def acompact(self, ctx: Context, backend: Backend) -> Context:
+        """Summarizes the oldest components of `ctx` right away if it exceeds the threshold.
+
+        Args:
+            ctx: the current context.
+            backend: the backend that writes the summary unless the compactor has its own.
+
+        Returns:
+            the compacted context, or `ctx` if it doesn't need compaction.
+        """
+        if not self.needs_compaction(ctx):
+            return ctx
+        prefix = self._prefix(ctx.as_list())
+        if prefix is None:
+            return ctx
+        summary = await self._summarize(prefix, backend)
+        return self._apply(ctx, prefix, summary)
+
+    def _pinned(self, components: Sequence[Component | CBlock]) -> set[int]:
+        # Earlier summaries are summarized again instead of being kept.
+        return {
+            i
+            for i in self.pinned(components)
+            if not isinstance(components[i], HistorySummary)
+        }
+
+    def _prefix(
+        self, history: list[Component | CBlock]
+    ) -> list[Component | CBlock] | None:
+        """Returns the oldest components up to the `summarize_oldest`-th unpinned one, or `None` if there is nothing to summarize."""
+        pinned = self._pinned(history)
+        unpinned = 0
+        end = 0
+        # Always keep the last component; it is the output that the next turn responds to.
+        for i, c in enumerate(history[:-1]):
+            if isinstance(c, ModelOutputThunk) and not c.is_computed():
+                break
+            end = i + 1
+            if i not in pinned:
+                unpinned += 1
+                if unpinned == self.summarize_oldest:
+                    break
+        if unpinned == 0:
+            return None
+        return history[:end]
+
+    async def _summarize(
+        self, prefix: list[Component | CBlock], backend: Backend
+    ) -> HistorySummary:
+        if self.backend is not None:
+            backend = self.backend
+        formatter = (
+            backend.formatter
+            if isinstance(backend, FormatterBackend)
+            else TemplateFormatter(model_id=backend.model_id)
+        )
+
+        pinned = self._pinned(prefix)
+        summarized = [c for i, c in enumerate(prefix) if i not in pinned]
+        transcript = "\n\n".join(
+            f"{m.role}: {m.content}" for m in formatter.to_chat_messages(summarized)
+        )
+        mot, _ = backend.generate_from_context(
+            Message("user", f"{self.instruction}\n\n{transcript}"),
+            SimpleContext(),
+            model_options=self.model_options,
+        )
+        summary = await mot.avalue()
+        assert summary is not None
+
+        tokens_before = sum(self.token_counter.count(c) for c in summarized)
+        log = (
+            dataclasses.replace(mot._generate_log)
+            if mot._generate_log is not None
+            else GenerateLog(backend=backend.__class__.__name__, result=mot)
+        )
+        result = HistorySummary(
+            summary.strip(), summarized=len(summarized), generate_log=log
+        )
+        log.extra = {
+            **(log.extra or {}),
+            "compaction": {
+                "summarized_components": len(summarized),
+                "tokens_before": tokens_before,
+                "tokens_after": self.token_counter.count(result),
+            },
+        }
+        return result
+
+    def _apply(
+        self, ctx: Context, prefix: list[Component | CBlock], summary: HistorySummary
+    ) -> Context:
+        """Returns a new context in which `summary` replaces the unpinned components of `prefix`, or `ctx` if `prefix` isn't the start of its history anymore (e.g., after a reset)."""
+        history = ctx.as_list()
+        if len(history) < len(prefix) or any(
+            a is not b for a, b in zip(history, prefix)
+        ):
+            return ctx
+
+        pinned = self._pinned(prefix)
+        components = [c for i, c in enumerate(prefix) if i in pinned]
+        components.append(summary)
+        components.extend(history[len(prefix) :])
+
+        # Rebuild from the root so that the new context keeps its settings (e.g., a window size).
+        root = ctx
+        while root.previous_node is not None:
+            root = root.previous_node
+        new = root
+        for c in components:
+            new = new.add(c)
+
+        self.compactions += 1
+        self.last_log = summary.generate_log
+        FancyLogger.get_logger().info(
+            f"Compacted the context history from {len(history)} to {len(components)} components."
+        )
+        return new
@@ -0,0 +1,251 @@
+"""A chat context that fits its history into a token budget.
+
+`ChatContext(window_size=...)` trims the history by the number of components, which says little about how many tokens the history takes up: one large grounding document can overflow the model's context window while many short turns are trimmed needlessly. A `TokenBudgetContext` instead keeps the longest suffix of the history that fits into `max_tokens - reserved_output` tokens, plus any pinned components (by default, system messages and the first instruction).
+
+Tokens are counted by a pluggable `TokenCounter`. Counts are cached per component and render version (see `render_version`), so each component is rendered and tokenized once no matter how many turns it stays in the history, as long as it doesn't change.
+"""
+
+from __future__ import annotations
+
+import abc
+import math
+import re
+from collections.abc import Callable, Sequence
+from typing import Any
+
+from mellea.backends.formatter import Formatter, RenderMemo, TemplateFormatter
+from mellea.backends.types import ModelOption
+from mellea.stdlib.base import (
+    CBlock,
+    ChatContext,
+    Component,
+    ModelOutputThunk,
+    render_version,
+)
+from mellea.stdlib.chat import Message
+from mellea.stdlib.instruction import Instruction
+
+
+class TokenCounter(abc.ABC):
+    """Counts the tokens of a text."""
+
+    @abc.abstractmethod
+    def count(self, text: str) -> int:
+        """Returns the number of tokens in `text`."""
+        ...
+
+
+class CharTokenCounter(TokenCounter):
+    """Estimates the number of tokens from the number of characters. Cheap, but only accurate on average."""
+
+    def __init__(self, chars_per_token: float = 4.0):
+        """Initializes the counter with the average number of characters per token."""
+        self.chars_per_token = chars_per_token
+
+    def count(self, text: str) -> int:
+        """Returns the estimated number of tokens in `text`."""
+        return math.ceil(len(text) / self.chars_per_token)
+
+
+class RegexTokenCounter(TokenCounter):
+    """Estimates the number of tokens like a BPE tokenizer (e.g., tiktoken) would split the text.
+
+    The text is pre-tokenized into words (with their leading space), numbers of up to three digits, punctuation and whitespace. Each piece counts as one token, plus one token per `chars_per_token` characters of long words. This is more accurate than `CharTokenCounter` for code and text with a lot of punctuation, without needing a tokenizer.
+    """
+
+    _pattern = re.compile(r"\s?[^\W\d_]+|\d{1,3}|\s?[^\s\w]+|\s+")
+
+    def __init__(self, chars_per_token: float = 6.0):
+        """Initializes the counter with the number of characters of a word that fit into one token."""
+        self.chars_per_token = chars_per_token
+
+    def count(self, text: str) -> int:
+        """Returns the estimated number of tokens in `text`."""
+        return sum(
+            max(1, math.ceil(len(piece.lstrip()) / self.chars_per_token))
+            for piece in self._pattern.findall(text)
+        )
+
+
+class TokenizerCounter(TokenCounter):
+    """Counts tokens exactly with a tokenizer, e.g., a huggingface tokenizer or a tiktoken encoding."""
+
+    def __init__(self, tokenizer: Any):
+        """Initializes the counter with any tokenizer that has an `encode(text)` method."""
+        self.tokenizer = tokenizer
+        # Huggingface tokenizers add special tokens (e.g., BOS) to every encoded text by default.
+        self._encode_kwargs = (
+            {"add_special_tokens": False}
+            if hasattr(tokenizer, "add_special_tokens")
+            else {}
+        )
+
+    def count(self, text: str) -> int:
+        """Returns the number of tokens in `text`."""
+        return len(self.tokenizer.encode(text, **self._encode_kwargs))
+
+
+def default_pinned(components: Sequence[Component | CBlock]) -> list[int]:
+    """Returns the indices of the system messages and of the first instruction."""
+    pinned = []
+    found_instruction = False
+    for i, c in enumerate(components):
+        if isinstance(c, Message) and c.role == "system":
+            pinned.append(i)
+        elif isinstance(c, Instruction) and not found_instruction:
+            pinned.append(i)
+            found_instruction = True
+    return pinned
+
+
+class ComponentTokenCounter:
+    """Counts the tokens that components take up in a prompt. Counts are cached per component and render version; components without a version (see `render_version`), e.g., uncomputed `ModelOutputThunk`s, are counted every time."""
+
+    def __init__(
+        self,
+        counter: TokenCounter | None = None,
+        formatter: Formatter | None = None,
+        message_overhead: int = 4,
+    ):
+        """Initializes the counter.
+
+        Args:
+            counter: the token counter; defaults to `CharTokenCounter`. Use a `TokenizerCounter` with the model's tokenizer for exact counts.
+            formatter: renders components to the text that is counted; defaults to a `TemplateFormatter`. Pass the backend's formatter to count exactly what the backend sends.
+            message_overhead: the number of tokens per message for its role and delimiters.
+        """
+        self.counter = counter if counter is not None else CharTokenCounter()
+        self._formatter = formatter
+        self.message_overhead = message_overhead
+
+        # Holds weak references, so that components that were trimmed or summarized away can be freed.
+        self._counts = RenderMemo()
+
+    @property
+    def formatter(self) -> Formatter:
+        """The formatter that renders the counted components."""
+        # Created on first use; `Context.from_previous` constructs a new context (and counter) for every added component.
+        if self._formatter is None:
+            self._formatter = TemplateFormatter(model_id="default")
+        return self._formatter
+
+    def count(self, c: Component | CBlock) -> int:
+        """Returns the number of tokens `c` takes up in the prompt."""
+        version = render_version(c)
+        if version is not None:
+            count = self._counts.get(c, version)
+            if count is not None:
+                return count
+        elif isinstance(c, ModelOutputThunk) and not c.is_computed():
+            # Its value is still changing.
+            return 0
+
+        messages = self.formatter.to_chat_messages([c])
+        count = sum(
+            self.counter.count(m.content) + self.message_overhead for m in messages
+        )
+        if version is not None:
+            self._counts.put(c, version, count)
+        return count
+
+
+class _TokenBudget(ComponentTokenCounter):
+    """The budget settings and token count cache; shared by all nodes of a `TokenBudgetContext`."""
+
+    def __init__(
+        self,
+        max_tokens: int | None,
+        reserved_output: int,
+        pinned: Callable[[Sequence[Component | CBlock]], list[int]],
+        counter: TokenCounter | None,
+        formatter: Formatter | None,
+        message_overhead: int,
+    ):
+        super().__init__(counter, formatter, message_overhead)
+        self.max_tokens = max_tokens
+        self.reserved_output = reserved_output
+        self.pinned = pinned
+
+
+class TokenBudgetContext(ChatContext):
+    """A chat context whose view for generation fits into a token budget.
+
+    The view keeps the pinned components and the longest suffix of the remaining history that fits into `max_tokens - reserved_output` tokens. The budget covers the history only; the action that is generated from the context isn't part of it, so leave room for it in `reserved_output`. Pinned components are kept even if they exceed the budget on their own.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_tokens: int | None = None,
+        reserved_output: int = 0,
+        counter: TokenCounter | None = None,
+        formatter: Formatter | None = None,
+        pinned: Callable[[Sequence[Component | CBlock]], list[int]] = default_pinned,
+        message_overhead: int = 4,
+    ):
+        """Constructs a new token-budgeted chat context.
+
+        Args:
+            max_tokens: the model's context window in tokens. If `None`, the whole history is used.
+            reserved_output: the number of tokens kept free for the action and the model's response.
+            counter: the token counter; defaults to `CharTokenCounter`. Use a `TokenizerCounter` with the model's tokenizer for exact counts.
+            formatter: renders components to the text that is counted; defaults to a `TemplateFormatter`. Pass the backend's formatter to count exactly what the backend sends.
+            pinned: returns the indices of the components of the history that must always be kept.
+            message_overhead: the number of tokens per message for its role and delimiters.
+        """
+        super().__init__()
+        self._budget = _TokenBudget(
+            max_tokens=max_tokens,
+            reserved_output=reserved_output,
+            counter=counter,
+            formatter=formatter,
+            pinned=pinned,
+            message_overhead=message_overhead,
+        )
+
+    @classmethod
+    def from_model_options(
+        cls, model_options: dict, **kwargs: Any
+    ) -> TokenBudgetContext:
+        """Constructs a context whose budget is the `ModelOption.CONTEXT_WINDOW` minus the `ModelOption.MAX_NEW_TOKENS` of `model_options`. Other arguments are passed to the constructor."""
+        return cls(
+            max_tokens=model_options.get(ModelOption.CONTEXT_WINDOW, None),
+            reserved_output=model_options.get(ModelOption.MAX_NEW_TOKENS, 0),
+            **kwargs,
+        )
+
+    def add(self, c: Component | CBlock) -> TokenBudgetContext:
+        """Add a new component/cblock to the context. Returns the new context."""
+        new = TokenBudgetContext.from_previous(self, c)
+        new._budget = self._budget
+        return new
+
+    def token_count(
+        self, components: Sequence[Component | CBlock] | None = None
+    ) -> int:
+        """Returns the number of tokens of `components`; defaults to the view for generation."""
+        if components is None:
+            components = self.view_for_generation()
+        return sum(self._budget.count(c) for c in components)
+
+    def view_for_generation(self) -> list[Component | CBlock]:
+        """Returns the pinned components and the longest suffix of the history that fits into the token budget."""
+        history = self.as_list()
+        budget = self._budget
+        if budget.max_tokens is None:
+            return history
+
+        pinned = set(budget.pinned(history))
+        used = sum(budget.count(history[i]) for i in pinned)
+        available = budget.max_tokens - budget.reserved_output
+
+        start = len(history)
+        while start > 0:
+            if start - 1 not in pinned:
+                count = budget.count(history[start - 1])
+                if used + count > available:
+                    break
+                used += count
+            start -= 1
+
+        return [c for i, c in enumerate(history) if i >= start or i in pinned]
@@ -3,10 +3,9 @@
 from __future__ import annotations
 
 import asyncio
+import concurrent.futures
 from collections.abc import Coroutine
-from typing import Any, Literal, overload
-
-from PIL import Image as PILImage
+from typing import TYPE_CHECKING, Any, Literal, overload
 
 from mellea.backends import Backend, BaseModelSubclass
 from mellea.backends.formatter import FormatterBackend
@@ -20,6 +19,7 @@ from mellea.stdlib.base import (
     GenerateLog,
     ImageBlock,
     ModelOutputThunk,
+    ModelToolCall,
     SimpleContext,
 )
 from mellea.stdlib.chat import Message, ToolMessage
@@ -33,6 +33,9 @@ from mellea.stdlib.sampling import (
     SamplingStrategy,
 )
 
+if TYPE_CHECKING:
+    from PIL import Image as PILImage
+
 
 @overload
 def act(
@@ -840,7 +843,7 @@ async def atransform(
         tool_calls=True,
     )
 
-    tools = _call_tools(transformed, backend)
+    tools = await _acall_tools(transformed, backend)
 
     # Transform only supports calling one tool call since it cannot currently synthesize multiple outputs.
     # Attempt to choose the best one to call.
@@ -887,11 +890,11 @@ def _parse_and_clean_image_args(
         assert isinstance(images_, list), "Images should be a list or None."
 
         if len(images_) > 0:
-            if isinstance(images_[0], PILImage.Image):
+            if ImageBlock.is_pil_image(images_[0]):
                 images = [
                     ImageBlock.from_pil_image(i)
                     for i in images_
-                    if isinstance(i, PILImage.Image)
+                    if ImageBlock.is_pil_image(i)
                 ]
             else:
                 images = images_  # type: ignore
@@ -904,35 +907,100 @@ def _parse_and_clean_image_args(
     return images
 
 
-def _call_tools(result: ModelOutputThunk, backend: Backend) -> list[ToolMessage]:
-    """Call all the tools requested in a result's tool calls object.
+MAX_CONCURRENT_TOOL_CALLS = 8
+"""The maximum number of tool calls from one response that run at the same time."""
+
+TOOL_CALL_TIMEOUT: float | None = None
+"""The default number of seconds after which a tool call is abandoned; `None` means no timeout."""
+
+
+def _call_tools(
+    result: ModelOutputThunk,
+    backend: Backend,
+    *,
+    timeout: float | None = None,
+    max_concurrency: int | None = None,
+) -> list[ToolMessage]:
+    """Call all the tools requested in a result's tool calls object. See `_acall_tools`.
+
+    Returns:
+        list[ToolMessage]: A list of tool messages that can be empty.
+    """
+    if not result.tool_calls:
+        return []
+    return _run_async_in_thread(
+        _acall_tools(result, backend, timeout=timeout, max_concurrency=max_concurrency)
+    )
+
+
+async def _acall_tools(
+    result: ModelOutputThunk,
+    backend: Backend,
+    *,
+    timeout: float | None = None,
+    max_concurrency: int | None = None,
+) -> list[ToolMessage]:
+    """Call all the tools requested in a result's tool calls object concurrently.
+
+    Coroutine tools run on the event loop; synchronous tools run in a thread pool of their own for every call (a process-wide pool would deadlock once tools that call tools hold all of its threads), and their sync Mellea calls (e.g., `m.instruct`) run on a nested event loop, so they don't wait on a loop that is blocked by the caller. Errors and timeouts become the output of their tool call. The tool messages are in the same order as the tool calls, no matter which call finishes first.
+
+    Args:
+        result: the output whose tool calls are called.
+        backend: its formatter (if any) prints the tool outputs.
+        timeout: the number of seconds after which a tool call is abandoned; defaults to `TOOL_CALL_TIMEOUT`. Synchronous tools that time out keep running in their thread, but their output is discarded.
+        max_concurrency: the maximum number of tool calls that run at the same time; defaults to `MAX_CONCURRENT_TOOL_CALLS`.
 
     Returns:
         list[ToolMessage]: A list of tool messages that can be empty.
     """
-    # There might be multiple tool calls returned.
-    outputs: list[ToolMessage] = []
     tool_calls = result.tool_calls
-    if tool_calls:
-        # Call the tools and decide what to do.
-        for name, tool in tool_calls.items():
+    if not tool_calls:
+        return []
+
+    if timeout is None:
+        timeout = TOOL_CALL_TIMEOUT
+    if max_concurrency is None:
+        max_concurrency = MAX_CONCURRENT_TOOL_CALLS
+    semaphore = asyncio.Semaphore(max_concurrency)
+    # Threads are only started when a synchronous tool is called.
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_concurrency, thread_name_prefix="mellea-tool"
+    )
+
+    async def call(name: str, tool: ModelToolCall) -> Any:
+        async with semaphore:
             try:
-                output = tool.call_func()
-            except Exception as e:
-                output = e
-
-            content = str(output)
-            if isinstance(backend, FormatterBackend):
-                content = backend.formatter.print(output)  # type: ignore
-
-            outputs.append(
-                ToolMessage(
-                    role="tool",
-                    content=content,
-                    tool_output=output,
-                    name=name,
-                    args=tool.args,
-                    tool=tool,
+                return await asyncio.wait_for(tool.acall_func(executor), timeout)
+            except asyncio.TimeoutError:
+                return TimeoutError(
+                    f"the tool call `{name}` timed out after {timeout} seconds"
                 )
+            except Exception as e:
+                return e
+
+    # There might be multiple tool calls returned.
+    try:
+        tool_outputs = await asyncio.gather(
+            *[call(name, tool) for name, tool in tool_calls.items()]
+        )
+    finally:
+        # Don't wait for synchronous tools that timed out.
+        executor.shutdown(wait=False)
+
+    outputs: list[ToolMessage] = []
+    for (name, tool), output in zip(tool_calls.items(), tool_outputs):
+        content = str(output)
+        if isinstance(backend, FormatterBackend):
+            content = backend.formatter.print(output)  # type: ignore
+
+        outputs.append(
+            ToolMessage(
+                role="tool",
+                content=content,
+                tool_output=output,
+                name=name,
+                args=tool.args,
+                tool=tool,
             )
+        )
     return outputs
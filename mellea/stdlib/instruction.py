@@ -2,21 +2,22 @@
 
 from __future__ import annotations
 
+from collections.abc import Hashable
 from copy import deepcopy
 
-import jinja2
-
 from mellea.stdlib.base import (
     CBlock,
     Component,
     ImageBlock,
     TemplateRepresentation,
+    VersionedComponent,
     blockify,
+    render_version,
 )
 from mellea.stdlib.requirement import Requirement, reqify
 
 
-class Instruction(Component):
+class Instruction(VersionedComponent):
     """The Instruction in an instruct/validate/repair loop."""
 
     def __init__(
@@ -151,11 +152,28 @@ class Instruction(Component):
             template_order=["*", "Instruction"],
         )
 
+    def version(self) -> Hashable | None:
+        """Returns a value that changes whenever the rendering of the instruction may change, including changes to its requirements and to the blocks and components it contains."""
+        parts = [
+            self._description,
+            self._prefix,
+            self._output_prefix,
+            *self._icl_examples,
+            *self._grounding_context.values(),
+        ]
+        versions = tuple(render_version(p) for p in parts if p is not None)
+        if None in versions:
+            return None
+        requirements = tuple((r.description, r.check_only) for r in self._requirements)
+        return (self._version, requirements, tuple(self._grounding_context), versions)
+
     @staticmethod
     def apply_user_dict_from_jinja(user_dict: dict[str, str], s: str) -> str:
-        """Treats s as a jinja string and user_dict as the template values dictionary."""
+        """Treats s as a jinja string and user_dict as the template values dictionary. Compiled templates are cached by `s`."""
+        from mellea.helpers.template_helpers import compile_template
+
         assert s is not None
-        return jinja2.Template(s).render(user_dict)
+        return compile_template(s).render(user_dict)
 
     @property
     def requirements(self) -> list[Requirement]:
@@ -114,6 +114,36 @@ class BaseSamplingStrategy(SamplingStrategy):
         Raises:
             AssertionError: Asserts that all required components (repair, select_from_failure, validate, and generate) are provided before proceeding with the sampling.
         """
+        return await self._sample(
+            action,
+            context,
+            backend,
+            requirements,
+            validation_ctx=validation_ctx,
+            format=format,
+            model_options=model_options,
+            tool_calls=tool_calls,
+            show_progress=show_progress,
+        )
+
+    async def _sample(
+        self,
+        action: Component,
+        context: Context,
+        backend: Backend,
+        requirements: list[Requirement] | None,
+        *,
+        validation_ctx: Context | None = None,
+        format: type[BaseModelSubclass] | None = None,
+        model_options: dict | None = None,
+        tool_calls: bool = False,
+        show_progress: bool = True,
+        first_generation: tuple[Component, ModelOutputThunk, Context] | None = None,
+    ) -> SamplingResult:
+        """Runs the sampling loop of `sample`.
+
+        If `first_generation` is set, it is used as the first attempt instead of generating it: the copy of `action` that was generated, and the result and context of the generation. This lets callers that run several sampling loops for the same action generate all first attempts with a single `generate_n_from_context` call.
+        """
         validation_ctx = validation_ctx if validation_ctx is not None else context
 
         flog = FancyLogger.get_logger()
@@ -143,7 +173,10 @@ class BaseSamplingStrategy(SamplingStrategy):
             else range(self.loop_budget)  # type: ignore
         )
 
-        next_action = deepcopy(action)
+        # The first attempt's action must be the one in its context.
+        next_action = (
+            first_generation[0] if first_generation is not None else deepcopy(action)
+        )
         next_context = context
         for _ in loop_budget_range_iterator:  # type: ignore
             loop_count += 1
@@ -151,13 +184,16 @@ class BaseSamplingStrategy(SamplingStrategy):
                 flog.info(f"Running loop {loop_count} of {self.loop_budget}")
 
             # run a generation pass
-            result, result_ctx = backend.generate_from_context(
-                next_action,
-                ctx=next_context,
-                format=format,
-                model_options=model_options,
-                tool_calls=tool_calls,
-            )
+            if loop_count == 1 and first_generation is not None:
+                _, result, result_ctx = first_generation
+            else:
+                result, result_ctx = backend.generate_from_context(
+                    next_action,
+                    ctx=next_context,
+                    format=format,
+                    model_options=model_options,
+                    tool_calls=tool_calls,
+                )
             await result.avalue()
 
             # validation pass
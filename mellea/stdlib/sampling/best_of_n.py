@@ -87,12 +87,6 @@ class BestofNSamplingStrategy(BaseSamplingStrategy):
             "BestOfNSamplingStrategy requires exactly one ScorerRequirement"
         )
 
-        loop_count = 0
-        generate_loop_budget_iterator = (
-            tqdm.tqdm(range(self.loop_budget))  # type: ignore
-            if show_progress
-            else range(self.loop_budget)  # type: ignore
-        )
         validate_loop_budget_iterator = (
             tqdm.tqdm(range(self.loop_budget))  # type: ignore
             if show_progress
@@ -101,20 +95,17 @@ class BestofNSamplingStrategy(BaseSamplingStrategy):
 
         next_action = deepcopy(action)
         next_context = context
-        flog.info("BestofNSampling Generating Loop:")
-        for _ in generate_loop_budget_iterator:  # type: ignore
-            loop_count += 1
-            if not show_progress:
-                flog.info(f"Running loop {loop_count} of {self.loop_budget}")
-
-            # run a generation pass
-            result, result_ctx = backend.generate_from_context(
-                next_action,
-                ctx=next_context,
-                format=format,
-                model_options=model_options,
-                tool_calls=tool_calls,
-            )
+        flog.info(f"BestofNSampling Generating {self.loop_budget} samples:")
+        # Repairs only happen after all samples have been generated, so all samples share the same action and context.
+        # This lets the backend generate them together.
+        for result, result_ctx in backend.generate_n_from_context(
+            next_action,
+            ctx=next_context,
+            n=self.loop_budget,
+            format=format,
+            model_options=model_options,
+            tool_calls=tool_calls,
+        ):
             sampled_results.append(result)
             sampled_actions.append(next_action)
             sample_contexts.append(result_ctx)
@@ -2,6 +2,7 @@
 
 import abc
 import asyncio
+from copy import deepcopy
 
 import numpy as np
 from math_verify import ExprExtractionConfig, LatexExtractionConfig, parse, verify
@@ -91,11 +92,21 @@ class BaseMBRDSampling(RejectionSamplingStrategy):
         Returns:
             SamplingResult: A result object indicating the success or failure of the sampling process.
         """
+        # The first attempts of all samples use the same action and context, so the backend can generate them together.
+        first_action = deepcopy(action)
+        first_generations = backend.generate_n_from_context(
+            first_action,
+            context,
+            n=self.number_of_samples,
+            model_options=model_options,
+            tool_calls=tool_calls,
+        )
+
         # execute sampling concurrently
         tasks: list[asyncio.Task[SamplingResult]] = []
-        for i in range(self.number_of_samples):
+        for first_result, result_ctx in first_generations:
             task = asyncio.create_task(
-                super().sample(
+                self._sample(
                     action,
                     context,
                     backend,
@@ -104,6 +115,7 @@ class BaseMBRDSampling(RejectionSamplingStrategy):
                     model_options=model_options,
                     tool_calls=tool_calls,
                     show_progress=show_progress,
+                    first_generation=(first_action, first_result, result_ctx),
                 )
             )
             tasks.append(task)
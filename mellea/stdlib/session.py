@@ -4,9 +4,7 @@ from __future__ import annotations
 
 import contextvars
 from copy import copy
-from typing import Any, Literal, overload
-
-from PIL import Image as PILImage
+from typing import TYPE_CHECKING, Any, Literal, overload
 
 import mellea.stdlib.funcs as mfuncs
 from mellea.backends import Backend, BaseModelSubclass
@@ -15,8 +13,6 @@ from mellea.backends.model_ids import (
     IBM_GRANITE_4_MICRO_3B,
     ModelIdentifier,
 )
-from mellea.backends.ollama import OllamaModelBackend
-from mellea.backends.openai import OpenAIBackend
 from mellea.helpers.fancy_logger import FancyLogger
 from mellea.stdlib.base import (
     CBlock,
@@ -28,10 +24,14 @@ from mellea.stdlib.base import (
     SimpleContext,
 )
 from mellea.stdlib.chat import Message
+from mellea.stdlib.compaction import HistoryCompactor
 from mellea.stdlib.requirement import Requirement, ValidationResult
 from mellea.stdlib.sampling import SamplingResult, SamplingStrategy
 from mellea.stdlib.sampling.base import RejectionSamplingStrategy
 
+if TYPE_CHECKING:
+    from PIL import Image as PILImage
+
 # Global context variable for the context session
 _context_session: contextvars.ContextVar[MelleaSession | None] = contextvars.ContextVar(
     "context_session", default=None
@@ -53,14 +53,18 @@ def get_session() -> MelleaSession:
 
 
 def backend_name_to_class(name: str) -> Any:
-    """Resolves backend names to Backend classes."""
+    """Resolves backend names to Backend classes. Backends are imported on first use since their client libraries are slow to import."""
     if name == "ollama":
+        from mellea.backends.ollama import OllamaModelBackend
+
         return OllamaModelBackend
     elif name == "hf" or name == "huggingface":
         from mellea.backends.huggingface import LocalHFBackend
 
         return LocalHFBackend
     elif name == "openai":
+        from mellea.backends.openai import OpenAIBackend
+
         return OpenAIBackend
     elif name == "watsonx":
         from mellea.backends.watsonx import WatsonxAIBackend
@@ -80,6 +84,7 @@ def start_session(
     ctx: Context | None = None,
     *,
     model_options: dict | None = None,
+    compactor: HistoryCompactor | None = None,
     **backend_kwargs,
 ) -> MelleaSession:
     """Start a new Mellea session. Can be used as a context manager or called directly.
@@ -103,6 +108,8 @@ def start_session(
             Use ChatContext() for chat-style conversations.
         model_options: Additional model configuration options that will be passed
             to the backend (e.g., temperature, max_tokens, etc.).
+        compactor: If set, summarizes the oldest turns of a long context in the
+            background. See `mellea.stdlib.compaction.HistoryCompactor`.
         **backend_kwargs: Additional keyword arguments passed to the backend constructor.
 
     Returns:
@@ -152,7 +159,7 @@ def start_session(
 
     if ctx is None:
         ctx = SimpleContext()
-    return MelleaSession(backend, ctx)
+    return MelleaSession(backend, ctx, compactor=compactor)
 
 
 class MelleaSession:
@@ -169,20 +176,37 @@ class MelleaSession:
     Note: we put the `instruct`, `validate`, and other convenience functions here instead of in `Context` or `Backend` to avoid import resolution issues.
     """
 
-    ctx: Context
-
-    def __init__(self, backend: Backend, ctx: Context | None = None):
+    def __init__(
+        self,
+        backend: Backend,
+        ctx: Context | None = None,
+        *,
+        compactor: HistoryCompactor | None = None,
+    ):
         """Initializes a new Mellea session with the provided backend and context.
 
         Args:
             backend (Backend): This is always required.
             ctx (Context): The way in which the model's context will be managed. By default, each interaction with the model is a stand-alone interaction, so we use SimpleContext as the default.
+            compactor (HistoryCompactor): If set, the oldest turns of a long context are summarized in the background and replaced by their summary.
         """
         self.backend = backend
-        self.ctx: Context = ctx if ctx is not None else SimpleContext()
+        self.compactor = compactor
+        self.ctx = ctx if ctx is not None else SimpleContext()
         self._session_logger = FancyLogger.get_logger()
         self._context_token = None
 
+    @property
+    def ctx(self) -> Context:
+        """The context of the session."""
+        return self._ctx
+
+    @ctx.setter
+    def ctx(self, ctx: Context):
+        if self.compactor is not None:
+            ctx = self.compactor.compact(ctx, self.backend)
+        self._ctx = ctx
+
     def __enter__(self):
         """Enter context manager and set this session as the current global session."""
         self._context_token = _context_session.set(self)
@@ -197,7 +221,12 @@ class MelleaSession:
 
     def __copy__(self):
         """Use self.clone. Copies the current session but keeps references to the backend and context."""
-        new = MelleaSession(backend=self.backend, ctx=self.ctx)
+        new = MelleaSession(
+            backend=self.backend,
+            ctx=self.ctx,
+            # The clone gets its own compactor, which shares the summary that is in progress.
+            compactor=copy(self.compactor) if self.compactor is not None else None,
+        )
         new._session_logger = self._session_logger
         # Explicitly don't copy over the _context_token.
 
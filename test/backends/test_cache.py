@@ -0,0 +1,108 @@
+import pytest
+
+from mellea.backends.cache import (
+    ByteSizeLRUCache,
+    SimpleLRUCache,
+    TokenPrefixCache,
+    tensor_bytes_by_device,
+)
+
+
+def test_simple_lru_cache():
+    cache = SimpleLRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+
+    # "b" is the least recently used entry.
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.current_size() == 2
+
+
+def test_token_prefix_cache_longest_prefix():
+    cache = TokenPrefixCache(4)
+    cache.put([1, 2, 3, 4], "a")
+    cache.put([1, 2, 5], "b")
+
+    # Extends an entry.
+    assert cache.get_longest_prefix([1, 2, 3, 4, 6]) == (4, "a")
+    # Diverges in the middle of an entry.
+    assert cache.get_longest_prefix([1, 2, 3, 7]) == (3, "a")
+    assert cache.get_longest_prefix([1, 2, 5, 9]) == (3, "b")
+
+    # Shares a prefix with both entries; either one can be used.
+    length, value = cache.get_longest_prefix([1, 2, 8])
+    assert length == 2 and value in ("a", "b")
+
+    assert cache.get_longest_prefix([9, 1, 2]) == (0, None)
+    assert cache.hits == 4
+    assert cache.misses == 1
+
+
+def test_token_prefix_cache_max_length():
+    cache = TokenPrefixCache(4)
+    cache.put([1, 2, 3], "a")
+    assert cache.get_longest_prefix([1, 2, 3], max_length=2) == (2, "a")
+
+
+def test_token_prefix_cache_eviction():
+    cache = TokenPrefixCache(2)
+    cache.put([1, 2, 3], "a")
+    cache.put([1, 2, 4], "b")
+    cache.get_longest_prefix([1, 2, 3])
+
+    # "b" is the least recently used entry.
+    cache.put([5, 6], "c")
+    assert cache.current_size() == 2
+    assert cache.get([1, 2, 4]) is None
+    assert cache.get_longest_prefix([1, 2, 4]) == (2, "a")
+    assert cache.get_longest_prefix([5, 6, 7]) == (2, "c")
+
+
+def test_tensor_bytes_by_device():
+    torch = pytest.importorskip("torch")
+    t = torch.zeros(10, 10, dtype=torch.float32)
+
+    # Views share their storage with the original tensor and are only counted once.
+    assert tensor_bytes_by_device({"a": [t, t[:5]], "b": "text"}) == {"cpu": 400}
+    assert tensor_bytes_by_device("no tensors") == {}
+
+
+def test_byte_size_lru_cache():
+    torch = pytest.importorskip("torch")
+    cache = ByteSizeLRUCache(1000)
+
+    cache.put("a", torch.zeros(100))  # 400 bytes each.
+    cache.put("b", torch.zeros(100))
+    assert cache.get("a") is not None
+    cache.put("c", torch.zeros(100))
+
+    # "b" is the least recently used entry.
+    assert cache.get("b") is None
+    assert cache.current_size() == 2
+    assert cache.current_bytes() == 800
+    assert cache.current_bytes("cpu") == 800
+    assert cache.hits == 1
+    assert cache.misses == 1
+    assert cache.evictions == 1
+
+    # Values that can't fit by themselves are not cached and don't evict anything.
+    cache.put("big", torch.zeros(1000))
+    assert cache.get("big") is None
+    assert cache.current_size() == 2
+
+
+def test_byte_size_lru_cache_per_device_budget():
+    torch = pytest.importorskip("torch")
+    cache = ByteSizeLRUCache({"cpu": 500})
+    cache.put("a", torch.zeros(100))
+    cache.put("b", torch.zeros(100))
+    assert cache.current_size() == 1
+    assert cache.get("b") is not None
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
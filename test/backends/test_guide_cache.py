@@ -0,0 +1,87 @@
+import pydantic
+import pytest
+from outlines.models.transformers import TransformerTokenizer
+from transformers import AutoTokenizer
+
+from mellea.backends.guide_cache import GuideCache
+
+
+class Answer(pydantic.BaseModel):
+    name: str
+    value: int
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return TransformerTokenizer(
+        AutoTokenizer.from_pretrained("ibm-granite/granite-3.3-8b-instruct")
+    )
+
+
+def test_guide_cache_reuses_guides(tokenizer):
+    cache = GuideCache(capacity=2)
+    schema = Answer.model_json_schema()
+
+    p1 = cache.logits_processor(schema, tokenizer)
+    p2 = cache.logits_processor(schema, tokenizer)
+
+    # Each request gets its own processor, but they share the compiled guide.
+    assert p1 is not p2
+    assert p1.guide is p2.guide
+    assert cache.misses == 1
+    assert cache.hits == 1
+
+
+def test_guide_cache_eviction(tokenizer):
+    cache = GuideCache(capacity=1)
+    r1 = cache.regex_for_schema('{"type": "integer"}')
+    r2 = cache.regex_for_schema('{"type": "boolean"}')
+
+    cache.get_guide(r1, tokenizer)
+    cache.get_guide(r2, tokenizer)
+    cache.get_guide(r1, tokenizer)
+    assert cache.misses == 3
+
+
+def test_guide_cache_on_disk(tokenizer, tmp_path):
+    schema = Answer.model_json_schema()
+    GuideCache(cache_dir=str(tmp_path)).logits_processor(schema, tokenizer)
+    assert len(list(tmp_path.iterdir())) == 1
+
+    # A new cache (e.g., in a restarted process) loads the compiled guide from disk.
+    cache = GuideCache(cache_dir=str(tmp_path))
+    processor = cache.logits_processor(schema, tokenizer)
+    assert processor.guide is not None
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+class CountingTokenizer:
+    """A stand-in for an outlines tokenizer that counts how often its vocabulary is read."""
+
+    eos_token_id = 0
+
+    def __init__(self):
+        self.reads = 0
+
+    @property
+    def vocabulary(self):
+        self.reads += 1
+        return {f"t{i}": i for i in range(1000)}
+
+
+def test_tokenizer_fingerprint_is_computed_once(tmp_path):
+    cache = GuideCache(cache_dir=str(tmp_path))
+    tokenizer = CountingTokenizer()
+
+    p1 = cache._disk_path("a", tokenizer)
+    p2 = cache._disk_path("b", tokenizer)
+    assert p1 != p2
+    assert tokenizer.reads == 1
+
+    # The fingerprint is forgotten once the tokenizer is collected.
+    del tokenizer
+    assert cache._fingerprints == {}
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,142 @@
+import asyncio
+
+import pytest
+
+from mellea.backends.formatter import FormatterBackend, TemplateFormatter
+from mellea.backends.hedging import HedgingBackend, LatencyHistogram
+from mellea.stdlib.base import ChatContext, GenerateType, ModelOutputThunk
+from mellea.stdlib.chat import Message
+
+
+class DelayedBackend(FormatterBackend):
+    """Streams `"<name> <call>"` after the call's delay, or fails with `error`."""
+
+    def __init__(self, name: str, delays: list[float], error: Exception | None = None):
+        super().__init__("test-model", TemplateFormatter(model_id="test-model"))
+        self.name = name
+        self.delays = delays
+        self.error = error
+        self.calls = 0
+        self.thunks: list[ModelOutputThunk] = []
+
+    def generate_from_context(
+        self, action, ctx, *, format=None, model_options=None, tool_calls=False
+    ):
+        delay = self.delays[self.calls % len(self.delays)]
+        self.calls += 1
+        response = f"{self.name} {self.calls}"
+        mot = ModelOutputThunk(None)
+        mot._action = action
+
+        async def generate():
+            await asyncio.sleep(delay)
+            if self.error is not None:
+                await mot._async_queue.put(self.error)
+                return
+            for char in response:
+                await mot._async_queue.put(char)
+            await mot._async_queue.put(None)
+
+        async def process(thunk, chunk):
+            thunk._underlying_value = (thunk._underlying_value or "") + chunk
+
+        async def post_process(thunk):
+            pass
+
+        mot._process = process
+        mot._post_process = post_process
+        mot._generate = asyncio.create_task(generate())
+        mot._generate_type = GenerateType.ASYNC
+        self.thunks.append(mot)
+        return mot, ctx.add(action).add(mot)
+
+    def _generate_from_raw(
+        self, actions, *, format=None, model_options=None, generate_logs=None
+    ):
+        raise NotImplementedError()
+
+
+async def test_hedging_backend_hedges_slow_requests():
+    primary = DelayedBackend("primary", delays=[5.0])
+    secondary = DelayedBackend("secondary", delays=[0.0])
+    hedging = HedgingBackend(primary, secondary=secondary, initial_delay=0.05)
+
+    mot, ctx = hedging.generate_from_context(Message("user", "hello"), ChatContext())
+    assert await asyncio.wait_for(mot.avalue(), timeout=1) == "secondary 1"
+    assert mot._meta["hedged"]
+    assert ctx.last_output() is mot
+    assert hedging.hedges == 1 and hedging.hedge_wins == 1
+
+    # The slow request is cancelled.
+    await asyncio.sleep(0)
+    assert primary.thunks[0]._generate.cancelled()  # type: ignore
+
+
+async def test_hedging_backend_does_not_hedge_fast_requests():
+    backend = DelayedBackend("backend", delays=[0.0])
+    hedging = HedgingBackend(backend, initial_delay=0.5)
+    mot, _ = hedging.generate_from_context(Message("user", "hello"), ChatContext())
+    assert await mot.avalue() == "backend 1"
+    assert "hedged" not in mot._meta
+    assert backend.calls == 1
+    assert hedging.hedges == 0 and hedging.histogram.count == 1
+
+
+async def test_hedging_backend_primary_wins_race():
+    # The primary is slower than the hedge delay but faster than the hedge request.
+    backend = DelayedBackend("backend", delays=[0.1, 5.0])
+    hedging = HedgingBackend(backend, initial_delay=0.05)
+    mot, _ = hedging.generate_from_context(Message("user", "hello"), ChatContext())
+    assert await asyncio.wait_for(mot.avalue(), timeout=1) == "backend 1"
+    assert hedging.hedges == 1 and hedging.hedge_wins == 0
+
+
+async def test_hedging_backend_falls_back_to_hedge_on_error():
+    primary = DelayedBackend("primary", delays=[0.1], error=ValueError("boom"))
+    hedging = HedgingBackend(
+        primary, secondary=DelayedBackend("secondary", [0.2]), initial_delay=0.05
+    )
+    mot, _ = hedging.generate_from_context(Message("user", "hello"), ChatContext())
+    assert await mot.avalue() == "secondary 1"
+
+    # Errors are raised once there is nothing left to wait for.
+    hedging = HedgingBackend(primary, initial_delay=0.05)
+    mot, _ = hedging.generate_from_context(Message("user", "hello"), ChatContext())
+    with pytest.raises(ValueError, match="boom"):
+        await mot.avalue()
+
+
+def test_hedge_delay_adapts_to_latency():
+    hedging = HedgingBackend(
+        DelayedBackend("backend", [0.0]), initial_delay=1.0, min_samples=10
+    )
+    for _ in range(9):
+        hedging.histogram.record(0.1)
+    assert hedging.hedge_delay() == 1.0
+
+    for _ in range(91):
+        hedging.histogram.record(0.1)
+    assert 0.1 <= hedging.hedge_delay() < 0.1 * 1.2
+    for _ in range(10):
+        hedging.histogram.record(2.0)
+    assert 2.0 <= hedging.hedge_delay() < 2.0 * 1.2
+
+    # The delay is clamped.
+    for _ in range(100):
+        hedging.histogram.record(100.0)
+    assert hedging.hedge_delay() == hedging.max_delay
+
+
+def test_latency_histogram_decays():
+    histogram = LatencyHistogram(max_count=10)
+    assert histogram.percentile(50) is None
+    for _ in range(10):
+        histogram.record(1.0)
+    assert histogram.count == 5
+    for _ in range(5):
+        histogram.record(0.01)
+    assert histogram.percentile(50) < 1.0  # type: ignore
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
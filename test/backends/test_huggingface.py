@@ -1,13 +1,14 @@
 import asyncio
 import pydantic
 import pytest
+import torch
 from typing_extensions import Annotated
 
 from mellea import MelleaSession
 from mellea.backends.aloras.huggingface.granite_aloras import add_granite_aloras
-from mellea.backends.cache import SimpleLRUCache
+from mellea.backends.cache import SimpleLRUCache, TokenPrefixCache
 from mellea.backends.formatter import TemplateFormatter
-from mellea.backends.huggingface import LocalHFBackend
+from mellea.backends.huggingface import HFAloraCacheInfo, HFTopLogprobs, LocalHFBackend
 from mellea.backends.types import ModelOption
 from mellea.stdlib.base import CBlock, ChatContext, SimpleContext
 from mellea.stdlib.requirement import (
@@ -66,6 +67,68 @@ async def test_constraint_alora(session, backend):
     await alora_output.avalue()
     assert alora_output.value in ["Y", "N"], alora_output
 
+@pytest.mark.qualitative
+async def test_constraint_alora_batch(session, backend):
+    answer = session.instruct(
+        "Find the difference between these two strings: aaaaaaaaaa aaaaabaaaa. Be concise and don't write code to answer the question.",
+        model_options={ModelOption.MAX_NEW_TOKENS: 300},
+    )
+    alora = backend.get_aloras()[0]
+    constraints = [
+        "The answer should mention that there is a b in the middle of one of the strings but not the other.",
+        "The answer should be concise.",
+        "The answer should not contain code.",
+    ]
+
+    batched = alora.generate_using_strings_batch(
+        input="Find the difference between these two strings: aaaaaaaaaa aaaaabaaaa",
+        response=str(answer),
+        constraints=constraints,
+    )
+    batched_values = [await output.avalue() for output in batched]
+    assert all(value in ["Y", "N"] for value in batched_values)
+
+    # The same checks made one at a time should agree with the batch.
+    for constraint, value in zip(constraints, batched_values):
+        single = alora.generate_using_strings(
+            input="Find the difference between these two strings: aaaaaaaaaa aaaaabaaaa",
+            response=str(answer),
+            constraint=constraint,
+        )
+        assert await single.avalue() == value
+
+@pytest.mark.qualitative
+def test_constraint_alora_prefill_matches_cache(backend):
+    alora = backend.get_aloras()[0]
+    input = "What is 1 + 1?"
+    response = "1 + 1 = 2."
+    constraints = [
+        "The answer should be correct.",
+        "The answer should be a single sentence.",
+    ]
+
+    # Nothing is cached for the response yet, so the prefix is prefilled.
+    prefilled = alora._check_constraints(input, response, constraints, True)
+
+    # Like the entry that the backend caches after generating the response.
+    input_ids, attention_mask, _ = alora._get_prefix(input, response, prefill=False)
+    with torch.no_grad():
+        kv = backend._model(
+            input_ids=input_ids[:, :-1],
+            attention_mask=attention_mask[:, :-1],
+            use_cache=True,
+        ).past_key_values
+    backend.cache_put(
+        response,
+        HFAloraCacheInfo(
+            kv_cache=kv, merged_token_ids=input_ids[0], merged_attention=attention_mask[0]
+        ),
+    )
+    cached = alora._check_constraints(input, response, constraints, True)
+
+    for p, c in zip(prefilled, cached):
+        assert p.yn_logits == pytest.approx(c.yn_logits, rel=1e-2)
+
 @pytest.mark.qualitative
 def test_constraint_lora_with_requirement(session, backend):
     answer = session.instruct(
@@ -257,6 +320,137 @@ async def test_async_avalue(session):
     assert m1_final_val is not None
     assert m1_final_val == mot1.value
 
+@pytest.mark.qualitative
+async def test_batched_requests(backend):
+    # Share the weights of the module's backend.
+    batched_backend = LocalHFBackend(
+        model_id="ibm-granite/granite-3.2-8b-instruct",
+        custom_config=(backend._tokenizer, backend._model, backend._device),
+        model_options={ModelOption.MAX_NEW_TOKENS: 20},
+        max_batch_size=4,
+    )
+    assert batched_backend._batch_scheduler is not None
+
+    prompts = ["Say Hello.", "Say Goodbye!", "Count to three.", "Name a color."]
+    mots = [
+        batched_backend.generate_from_context(
+            CBlock(p), SimpleContext(), model_options={ModelOption.STREAM: i % 2 == 0}
+        )[0]
+        for i, p in enumerate(prompts)
+    ]
+    values = await asyncio.gather(*[mot.avalue() for mot in mots])
+
+    assert all(v is not None and len(v) > 0 for v in values)
+    assert batched_backend._batch_scheduler.requests_run == len(prompts)
+    assert batched_backend._batch_scheduler.batches_run < len(prompts)
+
+    # Padding is stripped from the per-request outputs.
+    for mot in mots:
+        sequence = mot._meta["hf_output"].sequences[0]
+        assert sequence[0] != backend._tokenizer.pad_token_id
+
+@pytest.mark.qualitative
+def test_prefix_cache(backend):
+    prefix_cache = TokenPrefixCache(4)
+    cached_backend = LocalHFBackend(
+        model_id="ibm-granite/granite-3.2-8b-instruct",
+        custom_config=(backend._tokenizer, backend._model, backend._device),
+        model_options={ModelOption.MAX_NEW_TOKENS: 20},
+        prefix_cache=prefix_cache,
+    )
+    session = MelleaSession(cached_backend, ctx=ChatContext())
+
+    session.chat("Say Hello.")
+    assert prefix_cache.current_size() == 1
+
+    # The second turn shares the whole first turn as a prefix.
+    session.chat("Now say Goodbye.")
+    assert prefix_cache.hits == 1
+    assert prefix_cache.current_size() == 2
+
+@pytest.mark.qualitative
+async def test_logprobs(backend):
+    mot, _ = backend.generate_from_context(
+        CBlock("Say Hello."),
+        SimpleContext(),
+        model_options={ModelOption.LOGPROBS: 5, ModelOption.MAX_NEW_TOKENS: 10},
+    )
+    await mot.avalue()
+
+    logprobs = mot._meta["hf_top_logprobs"]
+    assert logprobs.token_ids.shape == logprobs.logprobs.shape
+    assert logprobs.token_ids.shape[1] == 5
+    assert logprobs.sampled_logprobs.shape == (logprobs.token_ids.shape[0],)
+    assert (logprobs.logprobs <= 0).all()
+
+    # Raw logits are never kept.
+    assert mot._meta["hf_output"].logits is None
+
+    mot, _ = backend.generate_from_context(CBlock("Say Hello."), SimpleContext())
+    await mot.avalue()
+    assert "hf_top_logprobs" not in mot._meta
+def test_logprobs_ignore_sampling_options():
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(0)
+    model = LlamaForCausalLM(
+        LlamaConfig(
+            vocab_size=64,
+            hidden_size=32,
+            intermediate_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            num_key_value_heads=2,
+        )
+    ).eval()
+    input_ids = torch.arange(1, 6).unsqueeze(0)
+    with torch.no_grad():
+        output = model.generate(
+            input_ids,
+            do_sample=True,
+            temperature=0.5,
+            top_k=2,
+            max_new_tokens=4,
+            min_new_tokens=4,
+            pad_token_id=0,
+            return_dict_in_generate=True,
+            output_scores=True,
+            output_logits=True,
+        )
+        full_logits = model(output.sequences).logits
+    generated = output.sequences[0, input_ids.shape[1] :]
+
+    logprobs = HFTopLogprobs.from_logits(output.logits, generated, k=5)
+
+    # The processed scores filter out all but the top 2 tokens; the logprobs are the model's own distribution.
+    assert torch.isinf(torch.cat(output.scores)).any()
+    expected = torch.log_softmax(full_logits[0, input_ids.shape[1] - 1 : -1], dim=-1)
+    assert torch.allclose(
+        torch.from_numpy(logprobs.logprobs), expected.topk(5).values, atol=1e-4
+    )
+    assert torch.allclose(
+        torch.from_numpy(logprobs.sampled_logprobs),
+        expected.gather(-1, generated[:, None])[:, 0],
+        atol=1e-4,
+    )
+
+
+@pytest.mark.qualitative
+async def test_generate_n_from_context(backend):
+    results = backend.generate_n_from_context(
+        CBlock("Name a color."),
+        ChatContext(),
+        n=3,
+        model_options={ModelOption.TEMPERATURE: 1.0, ModelOption.MAX_NEW_TOKENS: 10},
+    )
+    assert len(results) == 3
+
+    values = await asyncio.gather(*[mot.avalue() for mot, _ in results])
+    assert all(v is not None and len(v) > 0 for v in values)
+    for mot, ctx in results:
+        assert ctx.last_output() is mot
+
+
 if __name__ == "__main__":
     import pytest
 
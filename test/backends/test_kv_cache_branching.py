@@ -0,0 +1,87 @@
+import pytest
+import torch
+from transformers import DynamicCache, LlamaConfig, LlamaForCausalLM
+
+from mellea.backends.huggingface import _split_generate_output, branch_kv_cache
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+    )
+    return LlamaForCausalLM(config).eval()
+
+
+def prefill(model, input_ids: torch.Tensor) -> DynamicCache:
+    with torch.no_grad():
+        return model(input_ids, use_cache=True).past_key_values
+
+
+def test_branch_shares_tensors(model):
+    cache = prefill(model, torch.arange(10).unsqueeze(0))
+    branch = branch_kv_cache(cache, length=6, batch_size=3)
+
+    assert branch.get_seq_length() == 6
+    for (k, v), (bk, bv) in zip(cache.to_legacy_cache(), branch.to_legacy_cache()):
+        assert bk.shape[0] == 3
+        assert bk.data_ptr() == k.data_ptr()
+        assert bv.data_ptr() == v.data_ptr()
+
+
+def test_generating_from_branch_leaves_prefix_untouched(model):
+    input_ids = torch.arange(12).unsqueeze(0)
+    cache = prefill(model, input_ids[:, :8])
+    before = [(k.clone(), v.clone()) for k, v in cache.to_legacy_cache()]
+
+    # Two checks branch off the same prefix; each must see the same logits as a full prefill.
+    for suffix in (input_ids[:, 8:], input_ids[:, 9:] + 1):
+        with torch.no_grad():
+            branched = model(suffix, past_key_values=branch_kv_cache(cache)).logits
+            full = model(torch.cat([input_ids[:, :8], suffix], dim=1)).logits
+        assert torch.allclose(branched[0, -1], full[0, -1], atol=1e-5)
+
+    assert cache.get_seq_length() == 8
+    for (k, v), (k_before, v_before) in zip(cache.to_legacy_cache(), before):
+        assert torch.equal(k, k_before)
+        assert torch.equal(v, v_before)
+
+
+def test_split_generate_output(model):
+    # Two prompts of different lengths, left-padded to the same length like `HFBatchScheduler` does.
+    prompts = [[5, 6, 7, 8], [9, 10]]
+    max_len = max(len(p) for p in prompts)
+    input_ids = torch.zeros((2, max_len), dtype=torch.long)
+    attention_mask = torch.zeros((2, max_len), dtype=torch.long)
+    for i, p in enumerate(prompts):
+        input_ids[i, max_len - len(p) :] = torch.tensor(p)
+        attention_mask[i, max_len - len(p) :] = 1
+
+    with torch.no_grad():
+        output = model.generate(
+            input_ids,
+            attention_mask=attention_mask,
+            max_new_tokens=3,
+            do_sample=False,
+            pad_token_id=0,
+            return_dict_in_generate=True,
+            output_scores=True,
+            output_logits=True,
+        )
+    rows = _split_generate_output(output, max_len, [len(p) for p in prompts], set())
+
+    for i, (p, row) in enumerate(zip(prompts, rows)):
+        assert row.sequences.tolist() == [p + output.sequences[i, max_len:].tolist()]
+        assert len(row.scores) == len(row.logits) == 3
+        # The padding is stripped from the kv cache, which never contains the last generated token.
+        assert row.past_key_values.get_seq_length() == len(p) + 2
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,323 @@
+import asyncio
+import sqlite3
+import sys
+
+import ollama
+import pytest
+
+from mellea.backends.cache import SqliteCache
+from mellea.backends.coalescing import CoalescingBackend
+from mellea.backends.formatter import FormatterBackend, TemplateFormatter
+from mellea.backends.response_cache import CachingBackend
+from mellea.backends.types import ModelOption
+from mellea.stdlib.base import ChatContext, GenerateType, ModelOutputThunk
+from mellea.stdlib.chat import Message
+
+
+class CountingBackend(FormatterBackend):
+    def __init__(self):
+        super().__init__("test-model", TemplateFormatter(model_id="test-model"))
+        self.calls = 0
+
+    def generate_from_context(
+        self, action, ctx, *, format=None, model_options=None, tool_calls=False
+    ):
+        self.calls += 1
+        response = ollama.ChatResponse(
+            model="test-model",
+            message=ollama.Message(role="assistant", content=f"response {self.calls}"),
+        )
+        mot = ModelOutputThunk(
+            value=f"response {self.calls}", meta={"chat_response": response}
+        )
+        self.formatter.parse(action, mot)
+        return mot, ctx.add(action).add(mot)
+
+    def _generate_from_raw(
+        self, actions, *, format=None, model_options=None, generate_logs=None
+    ):
+        raise NotImplementedError()
+
+
+deterministic = {ModelOption.TEMPERATURE: 0}
+
+
+def test_caching_backend_hit():
+    backend = CountingBackend()
+    cached = CachingBackend(backend)
+
+    first, _ = cached.generate_from_context(
+        Message("user", "hello"), ChatContext(), model_options=deterministic
+    )
+    second, ctx = cached.generate_from_context(
+        Message("user", "hello"),
+        ChatContext(),
+        model_options={**deterministic, ModelOption.STREAM: True},
+    )
+
+    assert backend.calls == 1
+    assert cached.hits["memory"] == 1 and cached.misses == 1
+    assert second.is_computed() and second.value == first.value
+    assert ctx.last_output() is second
+    # The raw response is restored, so parsing gives the same message.
+    assert isinstance(second._meta["chat_response"], ollama.ChatResponse)
+    assert isinstance(second.parsed_repr, Message)
+    assert second.parsed_repr.content == first.parsed_repr.content  # type: ignore
+    assert second._generate_log is not None
+
+    cached.generate_from_context(
+        Message("user", "goodbye"), ChatContext(), model_options=deterministic
+    )
+    assert backend.calls == 2
+
+
+def test_caching_backend_only_caches_deterministic_requests():
+    backend = CountingBackend()
+    cached = CachingBackend(backend)
+    for _ in range(2):
+        cached.generate_from_context(Message("user", "hello"), ChatContext())
+    assert backend.calls == 2
+
+    cached = CachingBackend(backend, only_deterministic=False)
+    for _ in range(2):
+        cached.generate_from_context(Message("user", "hello"), ChatContext())
+    assert backend.calls == 3
+
+
+def test_caching_backend_persistent_cache(tmp_path):
+    path = str(tmp_path / "responses.db")
+    backend = CountingBackend()
+    CachingBackend(backend, persistent_cache=SqliteCache(path)).generate_from_context(
+        Message("user", "hello"), ChatContext(), model_options=deterministic
+    )
+
+    # A new process (here: a new wrapper) finds the response on disk.
+    cached = CachingBackend(backend, persistent_cache=SqliteCache(path))
+    mot, _ = cached.generate_from_context(
+        Message("user", "hello"), ChatContext(), model_options=deterministic
+    )
+    assert backend.calls == 1
+    assert cached.hits["persistent"] == 1
+    assert mot.value == "response 1"
+
+    expired = CachingBackend(backend, persistent_cache=SqliteCache(path), ttl=-1)
+    expired.generate_from_context(
+        Message("user", "hello"), ChatContext(), model_options=deterministic
+    )
+    assert backend.calls == 2
+
+
+class NativeOptionsBackend(CountingBackend):
+    """Maps a backend-specific "seed" option to `ModelOption.SEED`, like the ollama backend."""
+
+    def __init__(self):
+        super().__init__()
+        self.to_mellea_model_opts_map = {"seed": ModelOption.SEED}
+
+
+def test_caching_backend_normalizes_model_options():
+    backend = NativeOptionsBackend()
+    cached = CachingBackend(backend)
+
+    # A backend-specific seed makes a request deterministic, and is the same request as with `ModelOption.SEED`.
+    for options in ({"seed": 1}, {ModelOption.SEED: 1}):
+        cached.generate_from_context(
+            Message("user", "hello"), ChatContext(), model_options=options
+        )
+    assert backend.calls == 1
+    assert cached.hits["memory"] == 1
+
+
+def test_caching_backend_regenerates_unrestorable_entries(tmp_path):
+    path = str(tmp_path / "responses.db")
+    backend = CountingBackend()
+    CachingBackend(backend, persistent_cache=SqliteCache(path)).generate_from_context(
+        Message("user", "hello"), ChatContext(), model_options=deterministic
+    )
+
+    # The class of the cached raw response was renamed since it was cached.
+    with sqlite3.connect(path) as db:
+        db.execute("UPDATE cache SET value = replace(value, ':ChatResponse', ':Renamed')")
+
+    cached = CachingBackend(backend, persistent_cache=SqliteCache(path))
+    mot, _ = cached.generate_from_context(
+        Message("user", "hello"), ChatContext(), model_options=deterministic
+    )
+    assert mot.value == "response 2"
+    assert cached.hits["persistent"] == 0 and cached.misses == 1
+
+
+
+def test_caching_backend_only_restores_allowed_models(tmp_path):
+    path = str(tmp_path / "responses.db")
+    backend = CountingBackend()
+    CachingBackend(backend, persistent_cache=SqliteCache(path)).generate_from_context(
+        Message("user", "hello"), ChatContext(), model_options=deterministic
+    )
+
+    # Anyone who can write to a shared cache could name any class in an entry.
+    with sqlite3.connect(path) as db:
+        db.execute("UPDATE cache SET value = replace(value, 'ollama._types:ChatResponse', 'this:s')")
+
+    cached = CachingBackend(backend, persistent_cache=SqliteCache(path))
+    mot, _ = cached.generate_from_context(
+        Message("user", "hello"), ChatContext(), model_options=deterministic
+    )
+    assert mot.value == "response 2"
+    assert "this" not in sys.modules
+
+def test_sqlite_cache_evicts_least_recently_used(tmp_path):
+    cache = SqliteCache(str(tmp_path / "cache.db"), capacity=2)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    assert cache.get("a") == "1"
+    cache.put("c", "3")
+
+    assert cache.current_size() == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+
+
+class AsyncBackend(CountingBackend):
+    """Streams the response character by character."""
+
+    def __init__(self, error: Exception | None = None):
+        super().__init__()
+        self.error = error
+
+    def generate_from_context(self, action, ctx, **kwargs):
+        mot, new_ctx = super().generate_from_context(action, ctx, **kwargs)
+        pending = ModelOutputThunk(None)
+        pending._action = action
+
+        async def generate():
+            # Long enough that a ModelOutputThunk sees several chunks before it is done.
+            for char in mot.value.ljust(64, "."):  # type: ignore
+                await asyncio.sleep(0.01)
+                await pending._async_queue.put(char)
+            # Like `send_to_queue`, an error replaces the sentinel.
+            await pending._async_queue.put(self.error)
+
+        async def process(thunk, chunk):
+            thunk._underlying_value = (thunk._underlying_value or "") + chunk
+
+        async def post_process(thunk):
+            thunk._meta.update(mot._meta)
+
+        pending._process = process
+        pending._post_process = post_process
+        pending._generate = asyncio.create_task(generate())
+        pending._generate_type = GenerateType.ASYNC
+        return pending, new_ctx
+
+
+async def test_caching_backend_caches_async_responses():
+    backend = AsyncBackend()
+    cached = CachingBackend(backend)
+    mot, _ = cached.generate_from_context(
+        Message("user", "hello"), ChatContext(), model_options=deterministic
+    )
+    assert cached.current_size() == 0
+    await mot.avalue()
+    assert cached.current_size() == 1
+
+    hit, _ = cached.generate_from_context(
+        Message("user", "hello"), ChatContext(), model_options=deterministic
+    )
+    assert hit.value == mot.value
+    assert backend.calls == 1
+
+
+async def test_caching_backend_coalesces_in_flight_requests():
+    backend = AsyncBackend()
+    cached = CachingBackend(backend, capacity=0)
+
+    mots = [
+        cached.generate_from_context(
+            Message("user", "hello"), ChatContext(), model_options=deterministic
+        )[0]
+        for _ in range(3)
+    ]
+    # A follower that joins after the first chunks were generated still gets the whole response.
+    await mots[0].astream()
+    mots.append(
+        cached.generate_from_context(
+            Message("user", "hello"), ChatContext(), model_options=deterministic
+        )[0]
+    )
+
+    values = await asyncio.gather(*[mot.avalue() for mot in mots])
+    assert values[0].startswith("response 1")
+    assert values == [values[0]] * 4
+    assert backend.calls == 1
+    assert cached.coalesced == 3
+    assert len({id(mot) for mot in mots}) == 4
+    assert all(mot._meta["chat_response"] is not None for mot in mots)
+
+    # Nothing is kept once the request is done.
+    cached.generate_from_context(
+        Message("user", "hello"), ChatContext(), model_options=deterministic
+    )
+    assert backend.calls == 2
+
+
+async def test_caching_backend_coalesced_requests_share_errors():
+    cached = CachingBackend(AsyncBackend(error=ValueError("boom")))
+    mots = [
+        cached.generate_from_context(
+            Message("user", "hello"), ChatContext(), model_options=deterministic
+        )[0]
+        for _ in range(2)
+    ]
+    for mot in mots:
+        with pytest.raises(ValueError, match="boom"):
+            await mot.avalue()
+    assert cached.current_size() == 0
+
+
+async def test_coalescing_backend_without_cache():
+    backend = AsyncBackend()
+    coalescing = CoalescingBackend(backend)
+
+    mots = [
+        coalescing.generate_from_context(
+            Message("user", "hello"), ChatContext(), model_options=deterministic
+        )[0]
+        for _ in range(3)
+    ]
+    values = await asyncio.gather(*[mot.avalue() for mot in mots])
+    assert values == [values[0]] * 3
+    assert backend.calls == 1
+    assert coalescing.coalesced == 2
+
+    # Nothing is kept once the request is done.
+    await coalescing.generate_from_context(
+        Message("user", "hello"), ChatContext(), model_options=deterministic
+    )[0].avalue()
+    assert backend.calls == 2
+
+
+async def test_coalescing_backend_only_coalesces_deterministic_requests():
+    backend = AsyncBackend()
+    coalescing = CoalescingBackend(backend)
+    mots = [
+        coalescing.generate_from_context(Message("user", "hello"), ChatContext())[0]
+        for _ in range(2)
+    ]
+    await asyncio.gather(*[mot.avalue() for mot in mots])
+    assert backend.calls == 2 and coalescing.coalesced == 0
+
+    # Identical sampled requests get the same sample when they may share a response.
+    coalescing = CoalescingBackend(backend, only_deterministic=False)
+    mots = [
+        coalescing.generate_from_context(Message("user", "hello"), ChatContext())[0]
+        for _ in range(2)
+    ]
+    values = await asyncio.gather(*[mot.avalue() for mot in mots])
+    assert values[0] == values[1]
+    assert backend.calls == 3 and coalescing.coalesced == 1
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,150 @@
+import asyncio
+import time
+
+import pytest
+
+from mellea.backends.formatter import FormatterBackend, TemplateFormatter
+from mellea.backends.router import (
+    EWMALatencyPolicy,
+    LeastOutstandingPolicy,
+    ReplicaStats,
+    RouterBackend,
+)
+from mellea.stdlib.base import ChatContext, GenerateType, ModelOutputThunk
+from mellea.stdlib.chat import Message
+
+
+class ReplicaBackend(FormatterBackend):
+    """Streams `"<name> <call>"` after `delay` seconds, or fails with `error`."""
+
+    def __init__(self, name: str, delay: float = 0.0, error: Exception | None = None):
+        super().__init__("test-model", TemplateFormatter(model_id="test-model"))
+        self.name = name
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    def generate_from_context(
+        self, action, ctx, *, format=None, model_options=None, tool_calls=False
+    ):
+        self.calls += 1
+        response = f"{self.name} {self.calls}"
+        mot = ModelOutputThunk(None)
+        mot._action = action
+
+        async def generate():
+            await asyncio.sleep(self.delay)
+            if self.error is not None:
+                # Like `send_to_queue`, an error replaces the sentinel.
+                await mot._async_queue.put(self.error)
+                return
+            for char in response:
+                await mot._async_queue.put(char)
+            await mot._async_queue.put(None)
+
+        async def process(thunk, chunk):
+            thunk._underlying_value = (thunk._underlying_value or "") + chunk
+
+        async def post_process(thunk):
+            pass
+
+        mot._process = process
+        mot._post_process = post_process
+        mot._generate = asyncio.create_task(generate())
+        mot._generate_type = GenerateType.ASYNC
+        return mot, ctx.add(action).add(mot)
+
+    def _generate_from_raw(
+        self, actions, *, format=None, model_options=None, generate_logs=None
+    ):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return [ModelOutputThunk(f"{self.name} {self.calls}") for _ in actions]
+
+
+async def test_router_round_robin():
+    replicas = [ReplicaBackend("a"), ReplicaBackend("b")]
+    router = RouterBackend(replicas)
+    mots = [
+        router.generate_from_context(Message("user", "hello"), ChatContext())[0]
+        for _ in range(4)
+    ]
+    values = await asyncio.gather(*[mot.avalue() for mot in mots])
+    assert values == ["a 1", "b 1", "a 2", "b 2"]
+    assert [stats.in_flight for stats in router.replicas] == [0, 0]
+    assert all(stats.latency is not None for stats in router.replicas)
+
+
+async def test_router_retries_failed_requests_on_another_replica():
+    broken = ReplicaBackend("broken", error=ValueError("boom"))
+    router = RouterBackend(
+        [broken, ReplicaBackend("ok")], max_consecutive_failures=2, cooldown=60
+    )
+
+    for _ in range(2):
+        mot, _ = router.generate_from_context(Message("user", "hello"), ChatContext())
+        assert (await mot.avalue()).startswith("ok")
+    assert router.retries == 2
+    assert router.replicas[0].failures == 2
+
+    # The second failure in a row marks the broken replica as unhealthy.
+    assert not router.replicas[0].is_healthy(time.monotonic())
+    calls = broken.calls
+    for _ in range(3):
+        mot, _ = router.generate_from_context(Message("user", "hello"), ChatContext())
+        await mot.avalue()
+    assert broken.calls == calls
+
+
+async def test_router_raises_when_every_replica_fails():
+    router = RouterBackend(
+        [
+            ReplicaBackend("a", error=ValueError("a failed")),
+            ReplicaBackend("b", error=ValueError("b failed")),
+        ]
+    )
+    mot, _ = router.generate_from_context(Message("user", "hello"), ChatContext())
+    with pytest.raises(ValueError, match="b failed"):
+        await mot.avalue()
+    assert [stats.failures for stats in router.replicas] == [1, 1]
+
+
+async def test_router_prefix_affinity():
+    router = RouterBackend(
+        [ReplicaBackend("a"), ReplicaBackend("b")], prefix_affinity=True
+    )
+    ctx = ChatContext()
+    for _ in range(3):
+        mot, ctx = router.generate_from_context(Message("user", "hello"), ctx)
+        assert (await mot.avalue()).startswith("a")
+    assert router.affinity_hits == 2
+
+    # A new conversation is routed by the policy.
+    mot, _ = router.generate_from_context(Message("user", "hello"), ChatContext())
+    assert (await mot.avalue()).startswith("b")
+
+
+def test_routing_policies():
+    replicas = [
+        ReplicaStats(in_flight=2, latency=0.1),
+        ReplicaStats(in_flight=0, latency=1.0),
+        ReplicaStats(in_flight=1),
+    ]
+    assert LeastOutstandingPolicy().choose([0, 1, 2], replicas) == 1
+    # Replicas without a measurement are tried first.
+    assert EWMALatencyPolicy().choose([0, 1, 2], replicas) == 2
+    assert EWMALatencyPolicy().choose([0, 1], replicas) == 0
+
+
+def test_router_generate_from_raw():
+    router = RouterBackend(
+        [ReplicaBackend("a", error=ValueError("boom")), ReplicaBackend("b")]
+    )
+    results = router._generate_from_raw([Message("user", "hello")])
+    assert results[0].value == "b 1"
+    assert router.retries == 1
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,167 @@
+import dataclasses
+import json
+
+import pytest
+import torch
+from safetensors.torch import save_file
+from transformers import DynamicCache
+
+from mellea.backends.huggingface import HFAloraCacheInfo
+from mellea.backends.tiered_cache import TieredKVCache
+
+
+def make_cache_info(seed: int) -> HFAloraCacheInfo:
+    generator = torch.Generator().manual_seed(seed)
+    kv = DynamicCache.from_legacy_cache(
+        tuple(
+            (
+                torch.randn(1, 2, 5, 4, generator=generator),
+                torch.randn(1, 2, 5, 4, generator=generator),
+            )
+            for _ in range(2)
+        )  # type: ignore
+    )
+    token_ids = torch.arange(6) + seed
+    return HFAloraCacheInfo(
+        kv_cache=kv,
+        merged_token_ids=token_ids,
+        merged_attention=torch.ones_like(token_ids),
+        q_end=3,
+    )
+
+
+def assert_same(a: HFAloraCacheInfo, b: HFAloraCacheInfo):
+    assert a.q_end == b.q_end
+    assert torch.equal(a.merged_token_ids, b.merged_token_ids)
+    assert torch.equal(a.merged_attention, b.merged_attention)
+    for (ka, va), (kb, vb) in zip(
+        a.kv_cache.to_legacy_cache(), b.kv_cache.to_legacy_cache()
+    ):
+        assert torch.equal(ka, kb)
+        assert torch.equal(va, vb)
+
+
+def test_tiered_cache_spills_and_promotes(tmp_path):
+    cache = TieredKVCache(device_capacity=1, cpu_capacity=1, disk_dir=str(tmp_path))
+    infos = {f"k{i}": make_cache_info(i) for i in range(3)}
+    for key, info in infos.items():
+        cache.put(key, info)
+    cache.flush()
+
+    assert cache.tier_of("k2") == "device"
+    assert cache.tier_of("k1") == "cpu"
+    assert cache.tier_of("k0") == "disk"
+    assert cache.current_size() == 3
+
+    # A hit on disk brings the entry back to the device and pushes the others down.
+    assert_same(cache.get("k0"), infos["k0"])  # type: ignore
+    cache.flush()
+    assert cache.tier_of("k0") == "device"
+    assert cache.tier_of("k2") == "cpu"
+    assert cache.tier_of("k1") == "disk"
+    assert cache.hits["disk"] == 1
+
+    assert cache.get("missing") is None
+    assert cache.misses == 1
+
+
+def test_tiered_cache_prefetch(tmp_path):
+    cache = TieredKVCache(device_capacity=1, cpu_capacity=0, disk_dir=str(tmp_path))
+    info = make_cache_info(0)
+    cache.put("a", info)
+    cache.put("b", make_cache_info(1))
+    cache.flush()
+    assert cache.tier_of("a") == "disk"
+
+    future = cache.prefetch("a")
+    assert future is not None
+    assert_same(future.result(), info)
+    assert cache.tier_of("a") == "device"
+    assert cache.prefetch("a") is None
+
+
+def test_tiered_cache_persists_across_instances(tmp_path):
+    info = make_cache_info(7)
+    cache = TieredKVCache(device_capacity=0, cpu_capacity=0, disk_dir=str(tmp_path))
+    cache.put("system prompt", info)
+    cache.flush()
+
+    restarted = TieredKVCache(device_capacity=1, cpu_capacity=1, disk_dir=str(tmp_path))
+    assert restarted.tier_of("system prompt") == "disk"
+    assert_same(restarted.get("system prompt"), info)  # type: ignore
+
+
+def test_tiered_cache_disk_capacity(tmp_path):
+    cache = TieredKVCache(
+        device_capacity=0, cpu_capacity=0, disk_dir=str(tmp_path), disk_capacity=1
+    )
+    cache.put("a", make_cache_info(0))
+    cache.put("b", make_cache_info(1))
+    cache.flush()
+
+    assert cache.tier_of("a") is None
+    assert cache.tier_of("b") == "disk"
+    assert len(list(tmp_path.glob("*.safetensors"))) == 1
+
+
+def test_tiered_cache_without_disk_drops_entries():
+    cache = TieredKVCache(device_capacity=1, cpu_capacity=1)
+    cache.put("a", make_cache_info(0))
+    cache.put("b", make_cache_info(1))
+    cache.put("c", make_cache_info(2))
+
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+    assert cache.current_size() == 2
+
+
+def test_tiered_cache_overwrite_after_promotion(tmp_path):
+    cache = TieredKVCache(device_capacity=1, cpu_capacity=0, disk_dir=str(tmp_path))
+    cache.put("a", make_cache_info(0))
+    cache.put("b", make_cache_info(1))
+    cache.flush()
+    assert cache.tier_of("a") == "disk"
+
+    # Promoting "a" from disk and then replacing it must not leave its old value on disk.
+    cache.get("a")
+    cache.put("a", make_cache_info(2))
+    cache.flush()
+    assert cache.tier_of("a") == "device"
+
+    # The new value only lives on the device, so a restarted process must not find the old one.
+    restarted = TieredKVCache(device_capacity=1, cpu_capacity=1, disk_dir=str(tmp_path))
+    assert restarted.tier_of("a") is None
+    assert restarted.tier_of("b") == "disk"
+
+
+@dataclasses.dataclass
+class Unregistered:
+    value: torch.Tensor
+
+
+def test_tiered_cache_only_loads_allowed_dataclasses(tmp_path):
+    cache = TieredKVCache(device_capacity=0, cpu_capacity=0, disk_dir=str(tmp_path))
+    cache.put("a", Unregistered(torch.ones(2)))
+    cache.flush()
+    # Dataclasses that aren't registered are never written.
+    assert cache.tier_of("a") is None
+
+    # Files that name other classes are not imported from.
+    save_file(
+        {"0": torch.ones(2)},
+        str(tmp_path / "forged.safetensors"),
+        metadata={
+            "key": "forged",
+            "device": "cpu",
+            "structure": json.dumps(
+                {"dataclass": "subprocess:Popen", "fields": {"args": {"value": "true"}}}
+            ),
+        },
+    )
+    restarted = TieredKVCache(device_capacity=1, cpu_capacity=1, disk_dir=str(tmp_path))
+    assert restarted.tier_of("forged") == "disk"
+    assert restarted.get("forged") is None
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
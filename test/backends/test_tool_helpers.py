@@ -1,8 +1,19 @@
+import time
 
 import pytest
-from mellea.backends.tools import add_tools_from_context_actions, add_tools_from_model_options
+from mellea.backends._utils import StreamingToolCalls
+from mellea.backends.tools import (
+    IncrementalToolCallParser,
+    ToolRegistry,
+    add_tools_from_context,
+    add_tools_from_context_actions,
+    add_tools_from_model_options,
+    convert_tools_to_json,
+    parse_tools,
+    tool_registry,
+)
 from mellea.backends.types import ModelOption
-from mellea.stdlib.base import CBlock, Component, TemplateRepresentation
+from mellea.stdlib.base import CBlock, ChatContext, Component, TemplateRepresentation
 
 class FakeToolComponent(Component):
     def __init__(self) -> None:
@@ -97,5 +108,138 @@ def test_add_tools_from_context_actions():
     tool2 = tools["tool2"]
     assert tool2 == ftc1.tool2, f"{tool2} should == {ftc1.tool2}"
 
+
+class CountingToolComponent(FakeToolComponent):
+    def __init__(self) -> None:
+        super().__init__()
+        self.formatted = 0
+
+    def format_for_llm(self) -> TemplateRepresentation:
+        self.formatted += 1
+        return super().format_for_llm()
+
+
+def test_add_tools_from_context_is_incremental():
+    ctx = ChatContext()
+    components = []
+    for i in range(5):
+        c = CountingToolComponent()
+        components.append(c)
+        ctx = ctx.add(c).add(CBlock(f"output {i}"))
+
+        tools = {}
+        add_tools_from_context(tools, ctx)
+        assert tools["tool1"] == c.tool1
+
+    # Every component was formatted once, not once per turn.
+    assert [c.formatted for c in components] == [1] * 5
+
+    # Windowed contexts only use the tools of the components in their window.
+    windowed = ChatContext(window_size=1).add(components[0]).add(CBlock("a"))
+    tools = {}
+    add_tools_from_context(tools, windowed)
+    assert tools == {}
+
+
+def test_tool_schemas_are_cached():
+    def get_weather(location: str) -> int:
+        """Returns the weather in Celsius.
+
+        Args:
+            location: the city.
+        """
+        return 21
+
+    ftc = FakeToolComponent()
+    registry = ToolRegistry()
+    schema = registry.tool_schema(get_weather)
+    assert schema["function"]["name"] == "get_weather"
+    assert registry.tool_schema(get_weather) is schema
+
+    # Bound methods are recreated on every access but share a schema.
+    assert registry.tool_schema(ftc.tool1) is registry.tool_schema(ftc.tool1)
+
+    converted = convert_tools_to_json({"get_weather": get_weather})
+    assert converted == [schema]
+    assert convert_tools_to_json({"get_weather": get_weather})[0] is converted[0]
+    assert tool_registry.tool_schema(get_weather) is converted[0]
+
+
+@pytest.mark.parametrize(
+    "response,expected",
+    [
+        (
+            'Sure! {"name": "get_weather", "arguments": {"location": "Boston"}} done',
+            [("get_weather", {"location": "Boston"})],
+        ),
+        (
+            '{"name": "a", "arguments": {}}{"name": "b", "arguments": {"y": [1, 2]}}',
+            [("a", {}), ("b", {"y": [1, 2]})],
+        ),
+        ('x {not json {"name": "f", "arguments": {}} } y', [("f", {})]),
+        ('unclosed { {"name": "g", "arguments": {"a": "}{"}}', [("g", {"a": "}{"})]),
+        (
+            '{"name": "h", "arguments": {"s": "escaped \\" {"}}',
+            [("h", {"s": 'escaped " {'})],
+        ),
+        ('He said "hi {" then {"name": "q", "arguments": {}}', [("q", {})]),
+        ('a "stray { quote {"name": "s", "arguments": {}}', [("s", {})]),
+        (
+            '{"a": {"name": "n", "arguments": {"k": 1}}, "b": {x}}',
+            [("n", {"k": 1})],
+        ),
+        pytest.param(
+            "{ x " * 50 + '{"name": "deep", "arguments": {}}' + "}" * 50,
+            [("deep", {})],
+            id="nested-in-invalid",
+        ),
+        pytest.param("{ x " * 600 + "}" * 600, [], id="deeply-nested-invalid"),
+        pytest.param(
+            '{"a": ' * 2000 + "1 x" + "}" * 2000, [], id="too-deep-to-decode"
+        ),
+    ],
+)
+def test_incremental_parser(response, expected):
+    assert parse_tools(response) == expected
+
+    # Streaming the response finds the same calls.
+    parser = IncrementalToolCallParser()
+    calls = []
+    for char in response:
+        calls.extend(parser.feed(char))
+    calls.extend(parser.finish())
+    assert calls == expected
+
+
+def test_parse_tools_is_linear_in_nesting():
+    def duration(depth: int) -> float:
+        response = '{"a": x ' * depth + "}" * depth
+        start = time.perf_counter()
+        assert parse_tools(response) == []
+        return time.perf_counter() - start
+
+    # Ten times deeper nesting would take a hundred times as long if every object was decoded from its start to the end.
+    duration(1000)
+    assert duration(20000) < 40 * duration(2000) + 0.05
+
+
+def test_streaming_tool_calls_emits_closed_calls_early():
+    def get_weather(location: str) -> int:
+        return 21
+
+    parser = StreamingToolCalls({"get_weather": get_weather})
+    assert parser.feed('{"name": "get_weather", "arguments": {"loc') == []
+    calls = parser.feed('ation": "Boston"}}')
+    assert len(calls) == 1
+    assert calls[0].name == "get_weather"
+    assert calls[0].args == {"location": "Boston"}
+
+    # Unknown tools are skipped.
+    assert parser.feed(' and {"name": "unknown", "arguments": {}}') == []
+    tool_calls = parser.finish()
+    assert tool_calls is not None and list(tool_calls) == ["get_weather"]
+
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -0,0 +1,95 @@
+"""Compares deep-copying a shared kv cache prefix with branching off it (copy-on-write) for aLoRA-style requirement checks.
+
+Each check reuses the kv cache of a prompt and response and runs a short constraint suffix on top of it, like `HFConstraintAlora` does on a cache hit. Uses a randomly initialized model so that nothing needs to be downloaded.
+
+Run with `python test/benchmarks/bench_kv_cache_branching.py`.
+"""
+
+import time
+from copy import deepcopy
+
+import torch
+from transformers import DynamicCache, LlamaConfig, LlamaForCausalLM
+
+from mellea.backends.huggingface import branch_kv_cache
+
+PREFIX_LENGTHS = [512, 2048, 4096]
+SUFFIX_LENGTH = 16
+CHECKS = 6
+
+
+def make_model(device: torch.device) -> LlamaForCausalLM:
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=1024,
+        hidden_size=256,
+        intermediate_size=512,
+        num_hidden_layers=8,
+        num_attention_heads=8,
+        num_key_value_heads=8,
+        max_position_embeddings=8192,
+    )
+    return LlamaForCausalLM(config).eval().to(device)  # type: ignore
+
+
+def copied_bytes(prefix: DynamicCache, cache: DynamicCache) -> int:
+    """The bytes of `cache` that are not shared with `prefix`."""
+    shared = {
+        t.untyped_storage().data_ptr() for kv in prefix.to_legacy_cache() for t in kv
+    }
+    return sum(
+        t.untyped_storage().nbytes()
+        for kv in cache.to_legacy_cache()
+        for t in kv
+        if t.untyped_storage().data_ptr() not in shared
+    )
+
+
+def run_checks(model, prefix: DynamicCache, suffixes: torch.Tensor, branch: bool):
+    """Runs every check and returns (seconds per check, bytes copied per check, peak device bytes)."""
+    device = suffixes.device
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    n_copied = 0
+
+    start = time.perf_counter()
+    for suffix in suffixes:
+        cache = branch_kv_cache(prefix) if branch else deepcopy(prefix)
+        n_copied += copied_bytes(prefix, cache)
+        with torch.no_grad():
+            model(suffix.unsqueeze(0), past_key_values=cache)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    peak = torch.cuda.max_memory_allocated() if device.type == "cuda" else -1
+    return elapsed / len(suffixes), n_copied // len(suffixes), peak
+
+
+def main():
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = make_model(device)
+    print(f"device: {device}, {CHECKS} checks of {SUFFIX_LENGTH} tokens each")
+    print(
+        f"{'prefix':>8} {'method':>9} {'ms/check':>9} {'MiB copied/check':>17} {'peak MiB':>9}"
+    )
+
+    for prefix_length in PREFIX_LENGTHS:
+        input_ids = torch.randint(0, 1024, (1, prefix_length), device=device)
+        with torch.no_grad():
+            prefix = model(input_ids, use_cache=True).past_key_values
+        suffixes = torch.randint(0, 1024, (CHECKS, SUFFIX_LENGTH), device=device)
+
+        # Warm up so that the first measurement doesn't include one-time setup costs.
+        run_checks(model, prefix, suffixes[:1], branch=True)
+        for method, branch in (("deepcopy", False), ("branch", True)):
+            seconds, n_copied, peak = run_checks(model, prefix, suffixes, branch)
+            peak_mib = f"{peak / 2**20:9.1f}" if peak >= 0 else f"{'n/a':>9}"
+            print(
+                f"{prefix_length:>8} {method:>9} {seconds * 1000:9.2f} {n_copied / 2**20:17.1f} {peak_mib}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Measures the cold-start cost of loading mellea's templates with and without the precompiled bytecode cache of `m templates compile`.
+
+Every run starts a new process that loads each template in `mellea/templates` once through a `TemplateFormatter`, like the first requests of a new worker do, and reports the time spent loading templates (excluding imports).
+
+Run with `python test/benchmarks/bench_template_cold_start.py`.
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from mellea.helpers.template_helpers import TEMPLATE_CACHE_DIR_ENV, compile_templates
+
+RUNS = 5
+
+LOAD_TEMPLATES = """
+import time
+
+import jinja2
+
+from mellea.backends.formatter import TemplateFormatter
+from mellea.stdlib.base import TemplateRepresentation
+from mellea.stdlib.mobject import MObject
+
+names = jinja2.PackageLoader("mellea").list_templates()
+start = time.perf_counter()
+for name in names:
+    # A new formatter per template so that the formatter's own cache doesn't hide lookups.
+    tf = TemplateFormatter("granite")
+    repr = TemplateRepresentation(
+        obj=MObject(), args={}, template_order=[name.rsplit("/", 1)[-1][: -len(".jinja2")]]
+    )
+    tf._load_template(repr)
+print(time.perf_counter() - start)
+"""
+
+
+def cold_start(cache_dir: str) -> float:
+    """Returns the median seconds to load all templates in a new process."""
+    env = {**os.environ, TEMPLATE_CACHE_DIR_ENV: cache_dir}
+    times = [
+        float(
+            subprocess.run(
+                [sys.executable, "-c", LOAD_TEMPLATES],
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+        )
+        for _ in range(RUNS)
+    ]
+    return statistics.median(times)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as td:
+        cache_dir = os.path.join(td, "templates")
+        missing = cold_start(cache_dir)
+        compiled = compile_templates(cache_dir=cache_dir)
+        precompiled = cold_start(cache_dir)
+
+    print(f"{len(compiled)} templates, median of {RUNS} new processes")
+    print(f"{'method':>12} {'ms':>8}")
+    print(f"{'compile':>12} {missing * 1000:8.1f}")
+    print(f"{'precompiled':>12} {precompiled * 1000:8.1f}")
+    print(f"speedup: {missing / precompiled:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
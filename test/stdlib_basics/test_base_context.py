@@ -65,5 +65,51 @@ def test_actions_for_available_tools():
         assert actions[i] == for_generation[i]
 
 
+def test_context_branching():
+    ctx = ChatContext()
+    ctx = ctx.add(CBlock("a")).add(CBlock("b"))
+
+    # Branch off the same node twice; each branch must only see its own history.
+    branch_1 = ctx.add(CBlock("c"))
+    branch_2 = ctx.add(CBlock("d")).add(CBlock("e"))
+
+    assert [c.value for c in ctx.as_list()] == ["a", "b"]
+    assert [c.value for c in branch_1.as_list()] == ["a", "b", "c"]
+    assert [c.value for c in branch_2.as_list()] == ["a", "b", "d", "e"]
+    assert branch_1.length == 3
+    assert branch_2.length == 4
+
+    # Branching from an older node after the tip has moved on.
+    branch_3 = branch_1.previous_node.previous_node.add(CBlock("f"))  # type: ignore
+    assert [c.value for c in branch_3.as_list()] == ["a", "f"]
+    assert [c.value for c in branch_1.as_list()] == ["a", "b", "c"]
+
+
+def test_context_as_list_window():
+    ctx = ChatContext()
+    for i in range(5):
+        ctx = ctx.add(CBlock(f"{i}"))
+
+    assert [c.value for c in ctx.as_list(2)] == ["3", "4"]
+    assert [c.value for c in ctx.as_list(10)] == ["0", "1", "2", "3", "4"]
+    assert ctx.as_list(0) == []
+
+    # Mutating the returned list must not change the context.
+    ctx.as_list().clear()
+    assert ctx.length == 5
+    assert len(ctx.as_list()) == 5
+
+
+def test_context_rejects_duplicate_components():
+    block = CBlock("a")
+    ctx = ChatContext().add(block)
+    with pytest.raises(AssertionError):
+        ctx.add(block)
+
+    # The same component can still appear in separate branches.
+    other = ChatContext().add(CBlock("b")).add(block)
+    assert other.length == 2
+
+
 if __name__ == "__main__":
     pytest.main([__file__])
@@ -0,0 +1,137 @@
+import pytest
+
+from mellea.backends.formatter import FormatterBackend, TemplateFormatter
+from mellea.stdlib.base import ChatContext, GenerateLog, ModelOutputThunk
+from mellea.stdlib.chat import Message
+from mellea.stdlib.compaction import HistoryCompactor, HistorySummary
+from mellea.stdlib.session import MelleaSession
+
+
+class EchoBackend(FormatterBackend):
+    """Answers summarization requests with a summary and everything else with a numbered reply."""
+
+    def __init__(self):
+        super().__init__("test-model", TemplateFormatter(model_id="test-model"))
+        self.summaries = 0
+        self.replies = 0
+
+    def generate_from_context(
+        self, action, ctx, *, format=None, model_options=None, tool_calls=False
+    ):
+        assert isinstance(action, Message)
+        if action.content.startswith("Summarize"):
+            self.summaries += 1
+            value = f"summary {self.summaries}"
+        else:
+            self.replies += 1
+            value = f"reply {self.replies}"
+        mot = ModelOutputThunk(value)
+        mot._generate_log = GenerateLog(prompt=action.content, backend="echo")
+        self.formatter.parse(action, mot)
+        return mot, ctx.add(action).add(mot)
+
+    def _generate_from_raw(
+        self, actions, *, format=None, model_options=None, generate_logs=None
+    ):
+        raise NotImplementedError()
+
+
+def conversation(turns: int) -> ChatContext:
+    ctx = ChatContext().add(Message("system", "be brief"))
+    for i in range(turns):
+        ctx = ctx.add(Message("user", f"question {i}"))
+        ctx = ctx.add(Message("assistant", f"answer {i}"))
+    return ctx
+
+
+async def test_compaction_replaces_oldest_components():
+    backend = EchoBackend()
+    compactor = HistoryCompactor(max_components=10, summarize_oldest=6)
+    ctx = conversation(6)
+
+    compacted = await compactor.acompact(ctx, backend)
+    history = compacted.as_list()
+    assert isinstance(compacted, ChatContext)
+    assert history[0] is ctx.as_list()[0]  # The system message is pinned.
+    assert isinstance(history[1], HistorySummary)
+    assert history[1].summary == "summary 1"
+    assert history[2:] == ctx.as_list()[7:]
+    assert compactor.compactions == 1
+
+    # The summarization request is observable through its GenerateLog.
+    log = compactor.last_log
+    assert log is history[1].generate_log
+    assert log is not None and log.extra is not None
+    assert log.extra["compaction"]["summarized_components"] == 6
+    assert "question 0" in log.prompt  # type: ignore
+
+    # The next compaction summarizes the earlier summary again.
+    for i in range(4):
+        compacted = compacted.add(Message("user", f"more {i}"))
+    compacted = await compactor.acompact(compacted, backend)
+    summaries = [c for c in compacted.as_list() if isinstance(c, HistorySummary)]
+    assert [s.summary for s in summaries] == ["summary 2"]
+    assert "summary 1" in compactor.last_log.prompt  # type: ignore
+
+
+async def test_compaction_is_skipped_below_threshold():
+    backend = EchoBackend()
+    compactor = HistoryCompactor(max_components=20)
+    ctx = conversation(3)
+    assert await compactor.acompact(ctx, backend) is ctx
+    assert backend.summaries == 0
+
+
+def test_session_compacts_in_the_background():
+    backend = EchoBackend()
+    compactor = HistoryCompactor(max_components=8, summarize_oldest=4)
+    m = MelleaSession(backend, ChatContext(), compactor=compactor)
+
+    for i in range(12):
+        m.chat(f"question {i}")
+        if compactor._pending is not None:
+            compactor._pending.future.result()
+
+    assert compactor.compactions > 0
+    assert m.ctx.length <= 8 + 2
+    assert isinstance(m.ctx.as_list()[0], HistorySummary)
+    assert m.ctx.last_output().value == "reply 12"  # type: ignore
+
+
+def test_stale_summaries_are_not_applied():
+    backend = EchoBackend()
+    compactor = HistoryCompactor(max_components=4, summarize_oldest=2)
+    m = MelleaSession(backend, ChatContext(), compactor=compactor)
+    for i in range(3):
+        m.chat(f"question {i}")
+    assert compactor._pending is not None
+    compactor._pending.future.result()
+
+    m.reset()
+    m.chat("hello")
+    assert compactor.compactions == 0
+    assert m.ctx.length == 2
+
+
+
+def test_cloned_sessions_both_get_the_summary_in_progress():
+    backend = EchoBackend()
+    compactor = HistoryCompactor(max_components=4, summarize_oldest=4)
+    m = MelleaSession(backend, ChatContext(), compactor=compactor)
+    for i in range(3):
+        m.chat(f"question {i}")
+    assert compactor._pending is not None
+    compactor._pending.future.result()
+
+    # Setting the context applies a finished summary.
+    clone = m.clone()
+    m.ctx = m.ctx
+    assert clone.compactor is not compactor
+    for session in (m, clone):
+        summary = session.ctx.as_list()[0]
+        assert isinstance(summary, HistorySummary) and summary.summary == "summary 1"
+        assert session.compactor.compactions == 1  # type: ignore
+    assert backend.summaries == 1
+
+if __name__ == "__main__":
+    pytest.main([__file__])
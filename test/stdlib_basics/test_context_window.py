@@ -0,0 +1,123 @@
+import gc
+import weakref
+
+import pytest
+
+from mellea.backends.types import ModelOption
+from mellea.stdlib.base import CBlock, ModelOutputThunk
+from mellea.stdlib.chat import Message
+from mellea.stdlib.context_window import (
+    CharTokenCounter,
+    ComponentTokenCounter,
+    RegexTokenCounter,
+    TokenBudgetContext,
+    TokenCounter,
+    TokenizerCounter,
+)
+from mellea.stdlib.instruction import Instruction
+
+
+class WordCounter(TokenCounter):
+    def __init__(self):
+        self.calls = 0
+
+    def count(self, text: str) -> int:
+        self.calls += 1
+        return len(text.split())
+
+
+def test_token_budget_keeps_longest_suffix():
+    ctx = TokenBudgetContext(max_tokens=7, counter=WordCounter(), message_overhead=0)
+    for i in range(5):
+        ctx = ctx.add(CBlock(f"turn {i} words"))
+    assert [c.value for c in ctx.view_for_generation()] == [  # type: ignore
+        "turn 3 words",
+        "turn 4 words",
+    ]
+
+    # One large component doesn't push out everything else.
+    ctx = ctx.add(CBlock("document " * 20)).add(CBlock("question"))
+    assert [c.value for c in ctx.view_for_generation()] == ["question"]  # type: ignore
+
+
+def test_token_budget_keeps_pinned_components():
+    ctx = TokenBudgetContext(max_tokens=10, counter=WordCounter(), message_overhead=0)
+    ctx = ctx.add(Message("system", "be brief")).add(
+        Instruction("Summarize the document")
+    )
+    for i in range(5):
+        ctx = ctx.add(Message("user", f"turn {i}"))
+
+    view = ctx.view_for_generation()
+    assert isinstance(view[0], Message) and view[0].role == "system"
+    assert isinstance(view[1], Instruction)
+    assert [m.content for m in view[2:]] == ["turn 3", "turn 4"]  # type: ignore
+    assert ctx.token_count() <= 10
+
+
+def test_token_budget_reserves_output_and_reads_model_options():
+    ctx = TokenBudgetContext.from_model_options(
+        {ModelOption.CONTEXT_WINDOW: 10, ModelOption.MAX_NEW_TOKENS: 4},
+        counter=WordCounter(),
+        message_overhead=0,
+    )
+    for i in range(5):
+        ctx = ctx.add(CBlock(f"turn {i}"))
+    assert len(ctx.view_for_generation()) == 3
+
+    # Without a budget, the whole history is used.
+    unbounded = TokenBudgetContext()
+    for i in range(5):
+        unbounded = unbounded.add(CBlock(f"turn {i}"))
+    assert len(unbounded.view_for_generation()) == 5
+
+
+def test_token_counts_are_cached():
+    counter = WordCounter()
+    ctx = TokenBudgetContext(max_tokens=100, counter=counter)
+    for i in range(10):
+        ctx = ctx.add(CBlock(f"turn {i}"))
+        ctx.view_for_generation()
+    assert counter.calls == 10
+
+    # Branches share the cache.
+    ctx.add(CBlock("a")).view_for_generation()
+    ctx.add(CBlock("b")).view_for_generation()
+    assert counter.calls == 12
+
+    # Outputs that are still being generated aren't cached.
+    pending = ModelOutputThunk(None)
+    ctx = ctx.add(pending)
+    ctx.view_for_generation()
+    pending._underlying_value = "the final answer"
+    pending._computed = True
+    assert ctx.token_count([pending]) == 3 + 4
+    assert counter.calls == 13
+
+
+
+def test_token_counts_follow_changes_and_dont_keep_components():
+    counter = ComponentTokenCounter(WordCounter(), message_overhead=0)
+    block = CBlock("two words")
+    assert counter.count(block) == 2
+    block.value = "now three words"
+    assert counter.count(block) == 3
+
+    ref = weakref.ref(block)
+    del block
+    gc.collect()
+    assert ref() is None
+
+def test_token_counters():
+    assert CharTokenCounter().count("a" * 10) == 3
+    assert RegexTokenCounter().count("Hello, world!") == 4
+
+    class Tokenizer:
+        def encode(self, text):
+            return text.split()
+
+    assert TokenizerCounter(Tokenizer()).count("one two three") == 3
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
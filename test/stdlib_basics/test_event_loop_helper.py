@@ -1,3 +1,7 @@
+import asyncio
+import concurrent.futures
+import threading
+
 import pytest
 
 import mellea.helpers.event_loop_helper as elh
@@ -29,6 +33,72 @@ def test_event_loop_handler_init_and_del():
     assert elh.__event_loop_handler is not None
 
 
+def nested(handler, depth: int) -> list[int]:
+    """Makes `depth` nested sync calls, each from inside the loop of the previous one; returns the ids of the loops they ran on."""
+    async def call(remaining: int) -> list[int]:
+        loop_id = id(asyncio.get_running_loop())
+        if remaining == 0:
+            return [loop_id]
+        return [loop_id, *handler(call(remaining - 1))]
+
+    return handler(call(depth))
+
+
+def event_loop_threads() -> int:
+    return sum(t.name.startswith("mellea-event-loop") for t in threading.enumerate())
+
+
+def test_nested_sync_calls_reuse_loops():
+    before = elh.event_loop_stats()
+    threads_before = event_loop_threads()
+
+    loop_ids = [tuple(nested(elh._run_async_in_thread, 3)) for _ in range(50)]
+
+    # Every call at the same nesting level ran on the same loop, so clients cached per loop are reused.
+    assert len(set(loop_ids)) == 1
+    assert len(set(loop_ids[0])) == 4
+
+    after = elh.event_loop_stats()
+    assert after.loops <= 4
+    assert after.threads == after.loops
+    assert after.nested_calls - before.nested_calls == 150
+    # At most one new thread per nesting level, instead of one per nested call.
+    assert event_loop_threads() - threads_before <= 3
+
+
+def test_nested_sync_calls_stress():
+    before = elh.event_loop_stats()
+
+    async def tool(i: int) -> int:
+        # A sync call inside async code, like a sync `m.instruct` inside a tool.
+        return elh._run_async_in_thread(asyncio.sleep(0, i)) + 1
+
+    async def agent(i: int) -> int:
+        return sum(await asyncio.gather(*[asyncio.to_thread(lambda j=j: elh._run_async_in_thread(tool(j))) for j in range(i)]))
+
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda i: elh._run_async_in_thread(agent(i)), range(40)))
+
+    assert results == [i * (i + 1) // 2 for i in range(40)]
+    # The tools run on the shared loop and their sync calls on the first nested loop, however many run at once.
+    after = elh.event_loop_stats()
+    assert after.loops <= max(before.loops, 2)
+    assert after.threads == after.loops
+    assert after.nested_calls - before.nested_calls == sum(range(40))
+
+
+def test_nesting_depth_is_limited():
+    # Do not ever instantiate this manually. Only doing here for testing.
+    handler = elh._EventLoopHandler()
+
+    assert len(set(nested(handler, elh.MAX_NESTING_DEPTH - 1))) == elh.MAX_NESTING_DEPTH
+    with pytest.raises(RuntimeError, match="nested"):
+        nested(handler, elh.MAX_NESTING_DEPTH)
+    assert handler.stats().loops == elh.MAX_NESTING_DEPTH
+
+    handler._close_event_loop()
+
+
 if __name__ == "__main__":
     import pytest
 
@@ -1,4 +1,7 @@
+import asyncio
+
 from mellea.backends import ModelOption
+from mellea.backends.dummy import DummyBackend
 from mellea import start_session, MelleaSession
 from mellea.stdlib.requirement import check, req, simple_validate
 from mellea.stdlib.sampling.majority_voting import (
@@ -7,6 +10,8 @@ from mellea.stdlib.sampling.majority_voting import (
 )
 import pytest
 
+from mellea.stdlib.base import ChatContext, GenerateLog
+from mellea.stdlib.instruction import Instruction
 from mellea.stdlib.sampling.types import SamplingResult
 
 
@@ -69,5 +74,41 @@ def test_MBRDRougeL(m_session: MelleaSession):
     assert output
 
 
+class CountingDummyBackend(DummyBackend):
+    def __init__(self, responses: list[str]):
+        super().__init__(responses)
+        self.n_calls: list[int] = []
+
+    def generate_from_context(self, action, ctx, **kwargs):
+        mot, ctx = super().generate_from_context(action, ctx, **kwargs)
+        mot._generate_log = GenerateLog()
+        return mot, ctx
+
+    def generate_n_from_context(self, action, ctx, *, n, **kwargs):
+        self.n_calls.append(n)
+        return super().generate_n_from_context(action, ctx, n=n, **kwargs)
+
+    def _generate_from_raw(self, actions, *, format=None, model_options=None, generate_logs=None):
+        raise NotImplementedError()
+
+
+def test_mbrd_generates_first_attempts_together():
+    backend = CountingDummyBackend(["a b c", "a b c", "x y z"])
+    result = asyncio.run(
+        MBRDRougeLStrategy(number_of_samples=3, loop_budget=1).sample(
+            Instruction("Say something."),
+            ChatContext(),
+            backend,
+            requirements=[],
+            show_progress=False,
+        )
+    )
+
+    assert backend.n_calls == [3]
+    assert str(result.result) == "a b c"
+
+    # The recorded action is the one that the result was generated for.
+    assert result.sample_actions[0] is result.sample_contexts[0].previous_node.node_data
+
 if __name__ == "__main__":
     pytest.main(["-s", __file__])
@@ -0,0 +1,118 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+from mellea.helpers.event_loop_helper import _run_async_in_thread
+from mellea.stdlib.base import ModelOutputThunk, ModelToolCall
+from mellea.stdlib.funcs import MAX_CONCURRENT_TOOL_CALLS, _acall_tools, _call_tools
+
+
+def with_tool_calls(*tools) -> ModelOutputThunk:
+    mot = ModelOutputThunk("")
+    mot.tool_calls = {
+        tool.__name__: ModelToolCall(tool.__name__, tool, {"x": i})
+        for i, tool in enumerate(tools)
+    }
+    return mot
+
+
+async def slow_async(x: int) -> int:
+    await asyncio.sleep(0.2)
+    return x
+
+
+def slow_sync(x: int) -> int:
+    time.sleep(0.2)
+    return x
+
+
+async def fast_async(x: int) -> int:
+    return x
+
+
+def failing(x: int) -> int:
+    raise ValueError("boom")
+
+
+async def test_tool_calls_run_concurrently_in_order():
+    start = time.monotonic()
+    messages = await _acall_tools(
+        with_tool_calls(slow_async, slow_sync, fast_async),
+        None,  # type: ignore
+    )
+    assert time.monotonic() - start < 0.35
+    # The order of the tool calls is kept even though `fast_async` finishes first.
+    assert [m.name for m in messages] == ["slow_async", "slow_sync", "fast_async"]
+    assert [m._tool_output for m in messages] == [0, 1, 2]
+
+
+async def test_tool_calls_respect_max_concurrency():
+    start = time.monotonic()
+    await _acall_tools(
+        with_tool_calls(slow_async, slow_sync),
+        None,  # type: ignore
+        max_concurrency=1,
+    )
+    assert time.monotonic() - start >= 0.4
+
+
+async def test_tool_call_timeouts_and_errors_become_outputs():
+    messages = await _acall_tools(
+        with_tool_calls(slow_async, failing, fast_async),
+        None,  # type: ignore
+        timeout=0.05,
+    )
+    assert isinstance(messages[0]._tool_output, TimeoutError)
+    assert "slow_async" in messages[0].content
+    assert isinstance(messages[1]._tool_output, ValueError)
+    assert messages[2]._tool_output == 2
+
+
+def test_call_tools_from_sync_code():
+    messages = _call_tools(with_tool_calls(fast_async, slow_sync), None)  # type: ignore
+    assert [m._tool_output for m in messages] == [0, 1]
+    assert _call_tools(ModelOutputThunk(""), None) == []  # type: ignore
+
+
+def run_in_daemon_thread(func):
+    """Runs `func` in a daemon thread, so that a deadlock fails the test instead of hanging it."""
+    future: concurrent.futures.Future = concurrent.futures.Future()
+    threading.Thread(target=lambda: future.set_result(func()), daemon=True).start()
+    return future.result(timeout=5)
+
+
+def reentrant_sync(x: int) -> int:
+    # Like a tool that calls `m.instruct`.
+    return _run_async_in_thread(fast_async(x + 10))
+
+
+def test_sync_tool_with_sync_calls_from_event_loop():
+    async def on_loop():
+        # E.g., a sync tool loop inside a validator that runs on the shared event loop.
+        return _call_tools(with_tool_calls(reentrant_sync), None)  # type: ignore
+
+    messages = run_in_daemon_thread(lambda: _run_async_in_thread(on_loop()))
+    assert [m._tool_output for m in messages] == [10]
+
+
+def calls_tools(x: int) -> int:
+    # A tool that makes its own tool calls, like a tool that runs an agent.
+    return sum(m._tool_output for m in _call_tools(with_tool_calls(slow_sync), None))  # type: ignore
+
+
+def test_nested_sync_tool_calls_fill_the_pool():
+    tools = [
+        ModelToolCall(f"outer_{i}", calls_tools, {"x": i})
+        for i in range(MAX_CONCURRENT_TOOL_CALLS + 1)
+    ]
+    mot = ModelOutputThunk("")
+    mot.tool_calls = {tool.name: tool for tool in tools}
+    messages = run_in_daemon_thread(lambda: _call_tools(mot, None))  # type: ignore
+    assert [m._tool_output for m in messages] == [0] * len(tools)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -4,10 +4,19 @@ import sys
 import tempfile
 from typing import List, Optional
 
+import jinja2
 import pytest
 
 from mellea.backends.formatter import TemplateFormatter
 from mellea.backends.model_ids import ModelIdentifier, IBM_GRANITE_3_2_8B
+from mellea.helpers.template_helpers import (
+    TEMPLATE_CACHE_DIR_ENV,
+    compile_template,
+    compile_templates,
+    default_bytecode_cache,
+    template_cache_info,
+    template_environment,
+)
 from mellea.stdlib.base import (
     CBlock,
     Component,
@@ -128,6 +137,20 @@ def test_custom_template_string(tf: TemplateFormatter):
     ), "custom template field failed, requirements shouldn't be included"
 
 
+def test_inline_templates_are_compiled_once(tf: TemplateFormatter):
+    c = Instruction("write about {{topic}}", user_variables={"topic": "cats"})
+    source = "{{description}}!"
+    repr = TemplateRepresentation(obj=c, args={"description": "x"}, template=source)
+    assert tf._load_template(repr) is tf._load_template(repr)
+    assert compile_template(source) is tf._load_template(repr)
+
+    # User variables are rendered with cached templates as well.
+    hits = template_cache_info().hits
+    c = Instruction("write about {{topic}}", user_variables={"topic": "dogs"})
+    assert str(c._description) == "write about dogs"
+    assert template_cache_info().hits == hits + 1
+
+
 def test_string_repre(tf: TemplateFormatter):
     str_repr = "string repr of _StringRepr"
 
@@ -272,6 +295,69 @@ def test_template_caching(instr: Instruction):
     ), "template formatter appeared to use cache or grab the wrong template when caching was disabled"
 
 
+def test_template_index_is_shared(instr: Instruction, monkeypatch):
+    tf = TemplateFormatter("granite3.3")
+    granite_tmpl = tf._load_template(instr.format_for_llm())
+    assert granite_tmpl.name == "prompts/granite/Instruction.jinja2"
+
+    def fail_walk(*args, **kwargs):
+        raise AssertionError("template lookups should use the template index")
+
+    monkeypatch.setattr(os, "walk", fail_walk)
+
+    # Formatters for the same model share the index and the compiled templates.
+    other = TemplateFormatter("granite3.3")
+    assert other._load_template(instr.format_for_llm()) is granite_tmpl
+    query = TemplateRepresentation(obj=MObject(), args={}, template_order=["Query"])
+    assert other._load_template(query).name == "prompts/default/Query.jinja2"
+
+
+def test_compile_templates(monkeypatch):
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as td:
+        cache_dir = os.path.join(td, "cache")
+        monkeypatch.setenv(TEMPLATE_CACHE_DIR_ENV, cache_dir)
+        assert default_bytecode_cache() is None, "there is no cache to load from yet"
+
+        compiled = compile_templates()
+        assert any(f.endswith("Instruction.jinja2") for f in compiled)
+        assert len(os.listdir(cache_dir)) == len(compiled)
+
+        # Environments load the compiled templates instead of compiling them.
+        bytecode_cache = default_bytecode_cache()
+        assert bytecode_cache is not None
+        env = template_environment(jinja2.PackageLoader("mellea"), bytecode_cache)
+        monkeypatch.setattr(
+            env, "compile", lambda *args, **kwargs: pytest.fail("template was compiled")
+        )
+        assert env.get_template("prompts/default/Query.jinja2") is not None
+
+
+def test_renderings_are_memoized(monkeypatch):
+    tf = TemplateFormatter("default")
+    instr = Instruction("Write an essay.", requirements=["Be brief."])
+    renders = []
+    render = tf._render
+    monkeypatch.setattr(tf, "_render", lambda c: renders.append(c) or render(c))
+
+    messages = tf.to_chat_messages([instr])
+    assert tf.to_chat_messages([instr])[0] is messages[0]
+    assert tf.print(instr) == messages[0].content
+    assert renders == [instr]
+
+    # Changes to the instruction or its parts invalidate the rendering.
+    instr.requirements[0].description = "Be very brief."
+    assert "Be very brief." in tf.print(instr)
+    repaired = instr.copy_and_repair("Too long.")
+    assert "Too long." in tf.print(repaired)
+    assert "Too long." not in tf.print(instr)
+
+    # Computed model outputs are memoized as well.
+    mot = ModelOutputThunk(value="an answer")
+    assert tf.to_chat_messages([mot])[0] is tf.to_chat_messages([mot])[0]
+    mot.parsed_repr = Message("assistant", "a parsed answer")
+    assert tf.to_chat_messages([mot])[0].content == "a parsed answer"
+
+
 def test_custom_component_external_package(tf: TemplateFormatter):
     """Creates a fake package with a custom component and loads the package.
     Ensures template loading works for custom components defined in other packages."""
@@ -0,0 +1,58 @@
+import subprocess
+import sys
+
+import pytest
+
+# Modules that `import mellea` and `m` must not import; they are imported when a backend, image, template or server needs them.
+HEAVY_MODULES = [
+    "ollama",
+    "openai",
+    "httpx",
+    "requests",
+    "PIL",
+    "jinja2",
+    "torch",
+    "transformers",
+    "fastapi",
+    "uvicorn",
+]
+
+# A generous budget for the cumulative import time, in microseconds; eagerly importing the backends took over a second.
+IMPORT_TIME_BUDGET_US = 600_000
+
+
+def import_times(statement: str) -> dict[str, int]:
+    """Returns the cumulative import time in microseconds of every module imported by `statement` in a new interpreter."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, module = line.split("|")
+        if cumulative.strip().isdigit():
+            times[module.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize(
+    "statement,module",
+    [
+        ("import mellea", "mellea"),
+        ("from mellea import start_session", "mellea"),
+        ("import cli.m", "cli.m"),
+    ],
+)
+def test_import_is_lazy(statement, module):
+    times = import_times(statement)
+    imported = [m for m in times if m.split(".")[0] in HEAVY_MODULES]
+    assert imported == [], f"`{statement}` imports {imported}"
+    assert times[module] < IMPORT_TIME_BUDGET_US
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])